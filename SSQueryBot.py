@@ -5,19 +5,34 @@ This is a discord bot for responding to queries regarding matching times that
 are found from reading Screenshots of the leaderboard table.
 """
 
+import io
 import os
 import re
-
-from discord import File, Embed
+import shutil
+import tempfile
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+# perf_counter is imported on its own, since the !time command function is called time
+from time import perf_counter
+
+from discord import File, Embed, Intents
 from discord.ext import commands
 from dotenv import load_dotenv
 
-import csv
-
 from datetime import datetime, timedelta
 import pytz
 import shlex
 
+import team_store
+import query_cache
+import message_sender
+import upcoming_schedule
+import watch_scheduler
+import metrics
+import spreadsheet_export
+import team_charts
+from timezone_resolver import get_official_tz, get_timezone_shortcuts, write_timezone_shortcuts, official_timezones, suggestion_string
+
 # Make sure the cwd (Current Working Directory) is the same file directory for saving files in the same place
 abspath = os.path.abspath(__file__)
 dname = os.path.dirname(abspath)
@@ -26,37 +41,40 @@ os.chdir(dname)
 # Load the .env file to get secret token and guild ID for the bot
 load_dotenv()
 TOKEN = os.getenv('QUERY_DISCORD_TOKEN')
-# We're using Discord bot commands framework for this bot
-bot = commands.Bot(command_prefix='!')
+# We're using Discord bot commands framework for this bot.
+# The commands are read from the text of messages, which needs the message content intent.
+intents = Intents.default()
+intents.message_content = True
+bot = commands.Bot(command_prefix='!', intents=intents)
+# File reading and writing and the heavier searches are run on this pool, so one slow command doesn't hold up the rest
+query_executor = ThreadPoolExecutor(max_workers=int(os.getenv('QUERY_WORKERS', 4)))
+# Only one timezone shortcut can be added at a time, so two !add_tz commands can't overwrite each other's shortcut
+timezone_lock = asyncio.Lock()
+# Local port the metrics are served on, 0 (or left out) to not serve them
+metrics_port = int(os.getenv('QUERY_METRICS_PORT') or 0)
+# Server whose leaderboards carry on from the spreadsheet and name corrections in the bots' folder
+team_store.configure(int(os.getenv('LEGACY_GUILD_ID') or 0) or None)
 
 
-nameCorrectionPath = "team_name_corrections.csv"
-nameCorrectionContainsPath = "team_name_contains_corrections.csv"
-nameCorrectionRegexPath = "team_name_regex_corrections.csv"
-timezoneShortcutsPath = "timezone_shortcuts.csv"
-teamEndTimesPath = "team_end_times.csv"
-
 # Global variables that can easily be changed later
 match_length = timedelta(days=2)
 datetime_format = "%Y-%m-%dT%H:%M"
 time_format = "%H:%M"
 utc_tz = pytz.timezone("UTC")
+# Default number of hours ahead searched by !upcoming, the most it can search and how many teams are shown on each page
+upcoming_default_hours = 3
+upcoming_max_hours = 48
+upcoming_page_size = 15
+# Default number of days of history shown by !chart and the most it can show
+chart_default_days = 14
+chart_max_days = 365
+# Largest file that can be uploaded to a channel outside a server, since servers have their own limits
+default_upload_limit = 8 * 1024 * 1024
 embed_success_color = 0x29AB29
 embed_failure_color = 0xFF0000
 embed_nodata_color = 0xFF9900
 
 
-def get_timezone_shortcuts():
-    """Return a dictionary of timezone name shortcuts from file."""
-    # Read from the csv file for timezone shortcuts and add to the dictionary
-    shortcut = {}
-    with open(timezoneShortcutsPath, newline='', encoding="utf-8") as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            shortcut[row["shortcut"]] = row["timezone"]
-    return shortcut
-
-
 def try_parsing_date(text, tz):
     """Used for validation of user input for creating a datetime object."""
     # Loop over allowed formats to try and find a match (2 available right now)
@@ -83,22 +101,6 @@ def try_parsing_date(text, tz):
     return False
 
 
-def get_official_tz(user_tz):
-    """Take a timezone string and return a pytz object for use with datetime."""
-    official_tz = user_tz
-    # Get the list of saved shortcuts from file
-    tz_shortcuts = get_timezone_shortcuts()
-    # Replace the timezone string with what's saved as the official string for that shortcut
-    if official_tz in tz_shortcuts:
-        official_tz = tz_shortcuts[user_tz]
-
-    # Return the timezone object if it exists in pytz
-    if official_tz in pytz.all_timezones:
-        return pytz.timezone(official_tz)
-    # Return False if it doesn't exist in pytz
-    return False
-
-
 def split_backtick_aware(inp):
     """Split a string by whitespace, excluding any whitespace enclosed in backticks. Return a list of split strings."""
     lexer = shlex.shlex(inp)
@@ -121,11 +123,64 @@ def split_backtick_aware(inp):
     return outp
 
 
+def get_export_options(split, partition):
+    """Get the export options for !get_spreadsheet from the parts of the command, each in the format option=value.
+    Return an error string and None if any of them are invalid, otherwise an empty string and the options."""
+    options = spreadsheet_export.new_export_options()
+    values = {}
+    for part in split:
+        key, _, value = part.partition('=')
+        values[key.lower()] = value
+    unknown = [key for key in values if key not in ("since", "sweeps", "tz", "positions", "name", "format", "gzip")]
+    if len(unknown) > 0:
+        return "Unknown option " + unknown[0] + ". Consult the instructions for more info.", None
+
+    # Timestamps given with since are in the timezone given, or UTC if there isn't one
+    tz_string = values.get("tz") or "UTC"
+    tz = get_official_tz(tz_string)
+    if not tz:
+        return "Invalid timezone specified." + suggestion_string(tz_string) + " Please check the instructions and use a valid timezone.", None
+    if "since" in values:
+        dt = try_parsing_date(values["since"], tz)
+        if not dt:
+            return "Invalid since timestamp. It has to be in the format Year-Month-DayTHour:Minute or Hour:Minute.", None
+        options["since"] = dt.astimezone(utc_tz).strftime(datetime_format)
+    # sweeps=3 gives the teams that changed in the last 3 sweeps, by using the time of the 3rd last sweep
+    if "sweeps" in values:
+        if not values["sweeps"].isdigit() or int(values["sweeps"]) == 0:
+            return "The number of sweeps has to be a whole number above 0.", None
+        sweep_history = sorted(team_store.get_sweep_history(partition))
+        if len(sweep_history) > 0:
+            since = sweep_history[-min(int(values["sweeps"]), len(sweep_history))]
+            # Use the later time if since was given as well
+            options["since"] = max(since, options["since"] or since)
+    # Teams that joined or moved are found by comparing with their positions in the last sweep before since
+    if options["since"] is not None:
+        options["previous positions"] = team_store.get_positions_before(partition, options["since"])
+    if "positions" in values:
+        positions = re.fullmatch(r"(\d+)(?:-(\d+))?", values["positions"])
+        if positions is None:
+            return "Positions have to be a range like 1-100, or a single position.", None
+        first = int(positions.group(1))
+        options["positions"] = (first, int(positions.group(2) or first))
+    # The name is matched as plain text, since a RegEx pattern could take forever on a query thread that can't be stopped
+    if "name" in values:
+        options["name"] = values["name"].lower()
+    if "format" in values:
+        if values["format"].lower() not in spreadsheet_export.export_formats:
+            return "The format has to be one of " + ", ".join(spreadsheet_export.export_formats) + ".", None
+        options["format"] = values["format"].lower()
+    # gzip can be given on its own, without a value
+    options["gzip"] = "gzip" in values and values["gzip"].lower() not in ("no", "false", "0")
+    return "", options
+
+
 def add_tz_func(user_tz, official_tz):
     """Add a custom timezone to the timezone_shortcuts file to make specifying future timestamps easier."""
     # First make sure that the official_tz entered is a valid timezone in pytz. Return a warning string if not. 
-    if official_tz not in pytz.all_timezones:
-        return embed_failure_color, official_tz + " is not an official timezone. Consult the instructions for more info."
+    if official_tz not in official_timezones:
+        return (embed_failure_color, official_tz + " is not an official timezone." + suggestion_string(official_tz) +
+                " Consult the instructions for more info.")
     # Also make sure that the user_tz entered doesn't contain the illegal comma character. Return a warning string if not. 
     if ',' in user_tz:
         return embed_failure_color, "Comma (,) characters are not allowed."
@@ -133,53 +188,24 @@ def add_tz_func(user_tz, official_tz):
     tz_shortcuts = get_timezone_shortcuts()
     # Add the new shortcut to the dictionary
     tz_shortcuts[user_tz] = official_tz
-    # Open the file in write mode and write the whole list of shortcut info to the file
-    with open(timezoneShortcutsPath, mode='w', newline='', encoding="utf-8") as tz_data:
-        tz_writer = csv.writer(tz_data, delimiter=',')
-        # Write the table headings
-        tz_writer.writerow(["shortcut", "timezone"])
-        # Write the table data for each row
-        for key, value in tz_shortcuts.items():
-            tz_writer.writerow([key, value])
+    # Write the whole list of shortcut info to the file, which also updates the shortcuts kept in memory
+    write_timezone_shortcuts(tz_shortcuts)
 
     ret_str = "Successfully added timezone shortcut " + user_tz + " for " + official_tz
     # Return success feedback string
     return embed_success_color, ret_str
 
 
-def get_team_end_times_from_file():
-    """Get the data from the spreadsheet into a list of dictionaries and return the list."""
-    teamEndTimes = []
-    with open(teamEndTimesPath, newline='', encoding="utf-8") as csvfile:
-        reader = csv.DictReader(csvfile)
-        for i, row in enumerate(reader):
-            # Append an empty dictionary to the list to be filled with column heading: value pairs
-            teamEndTimes.append({})
-            # Add each column heading: value pair to the current iteration dictionary that was just appended
-            teamEndTimes[i]["position"] = row["position"]
-            teamEndTimes[i]["name"] = row["name"]
-            teamEndTimes[i]["cups"] = row["cups"]
-            teamEndTimes[i]["match against"] = row["match against"]
-            teamEndTimes[i]["cup change"] = row["cup change"]
-            teamEndTimes[i]["timestamp prior"] = row["timestamp prior"]
-            teamEndTimes[i]["timestamp checked"] = row["timestamp checked"]
-            teamEndTimes[i]["timestamp changed"] = row["timestamp changed"]
-    # Return the list of dictionaries
-    return teamEndTimes
+async def run_in_executor(func, *args):
+    """Run a blocking function on the query executor and wait for its result without blocking the bot."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(query_executor, func, *args)
 
 
-def write_new_spreadsheet_data(teamEndTimes):
-    """Write the new updated data to the spreadsheet, overwriting the old data."""
-    with open(teamEndTimesPath, mode='w', newline='', encoding="utf-8") as team_data:
-        team_writer = csv.writer(team_data, delimiter=',')
-        # Write the table headings
-        team_writer.writerow(["position", "name", "cups", "match against",
-                              "cup change", "timestamp prior", "timestamp checked", "timestamp changed"])
-        # Write the table data for each row
-        for row in teamEndTimes:
-            team_writer.writerow([row["position"], row["name"], row["cups"],
-                                 row["match against"], row["cup change"], row["timestamp prior"],
-                                 row["timestamp checked"], row["timestamp changed"]])
+def get_ctx_partition(ctx):
+    """Get the partition holding the data for the leaderboard of the channel a command was sent in."""
+    guild_id = ctx.guild.id if ctx.guild else None
+    return team_store.get_partition(guild_id, ctx.channel.id)
 
 
 def generate_out(t_data, char_lim=2000):
@@ -219,12 +245,13 @@ def generate_out(t_data, char_lim=2000):
     return out_list
 
 
-def get_teams_by_time(dt_string, tz_string):
+def get_teams_by_time(dt_string, tz_string, partition):
     """Get every team that finishes at the specified timezone and return as a string."""
     # Get the timezone object from the timezone string and return a warning if it's an invalid timezone
     tz = get_official_tz(tz_string)
     if not tz:
-        return embed_failure_color, "Invalid timezone specified. Please check the instructions and use a valid timezone."
+        return (embed_failure_color, "Invalid timezone specified." + suggestion_string(tz_string) +
+                " Please check the instructions and use a valid timezone.")
 
     # Get the datetime object from the datetime string and timezone object and return a warning if it's an invalid string format
     dt = try_parsing_date(dt_string, tz)
@@ -238,8 +265,16 @@ def get_teams_by_time(dt_string, tz_string):
     # Get the datetime as UTC for generalisation to work with the data that is stored as UTC
     dt_utc = dt.astimezone(utc_tz)
 
-    # Get the spreadsheet data as a list of dictionaries
-    teamEndTimes = get_team_end_times_from_file()
+    # Use the cached response if the same time has been asked for since the data last changed.
+    # The time is cached after it's been parsed, since times without a date depend on the current day.
+    cache_key = ("time", partition["key"], dt_utc.strftime(datetime_format), tz.zone, tz_string,
+                 team_store.get_data_version(partition))
+    cached = query_cache.get_cached(cache_key)
+    if cached is not None:
+        return cached
+
+    # Get the leaderboard's spreadsheet data as a list of dictionaries
+    teamEndTimes = team_store.get_team_end_times(partition)
 
     # Create a list of teams that are within the required range for timestamp changed 
     teamsInRange = []
@@ -295,19 +330,27 @@ def get_teams_by_time(dt_string, tz_string):
         out_color = embed_nodata_color
         out_string = "No top teams due to end within the specified time."
 
-    # Return the output string
+    # Cache and return the output string
+    query_cache.store(cache_key, (out_color, out_string))
     return out_color, out_string
 
 
-def get_time_by_team(team_name, tz_string):
+def get_time_by_team(team_name, tz_string, partition):
     """Get the time a given team finishes at the specified timezone and return as a string."""
     # Get the timezone object from the timezone string and return a warning if it's an invalid timezone
     tz = get_official_tz(tz_string)
     if not tz:
-        return embed_failure_color, "Invalid timezone specified. Please check the instructions and use a valid timezone."
+        return (embed_failure_color, "Invalid timezone specified." + suggestion_string(tz_string) +
+                " Please check the instructions and use a valid timezone.")
+
+    # Use the cached response if the same team has been searched for since the data last changed
+    cache_key = ("team", partition["key"], team_name.lower(), tz.zone, tz_string, team_store.get_data_version(partition))
+    cached = query_cache.get_cached(cache_key)
+    if cached is not None:
+        return cached
 
-    # Get the spreadsheet data as a list of dictionaries
-    teamEndTimes = get_team_end_times_from_file()
+    # Get the leaderboard's spreadsheet data as a list of dictionaries
+    teamEndTimes = team_store.get_team_end_times(partition)
 
     # Check which teams match the searched team_name by searching every team name in the spreadsheet.
     # Search  by looking for names that contain the searched name and add the team to the list of matching_teams  
@@ -315,6 +358,13 @@ def get_time_by_team(team_name, tz_string):
     for team in teamEndTimes:
         if team_name.lower() in team["name"].lower():
             matching_teams.append(team)
+    # If the team isn't on the leaderboard anymore, search the teams that have dropped out of it instead
+    archived = False
+    if len(matching_teams) == 0:
+        for team in team_store.get_archived_teams(partition):
+            if team_name.lower() in team["name"].lower():
+                matching_teams.append(team)
+        archived = len(matching_teams) > 0
 
     # If any teams were found in the name search, generate the output string
     if len(matching_teams) > 0:
@@ -358,16 +408,81 @@ def get_time_by_team(team_name, tz_string):
             tabledata.append([team["position"], team["name"], team["cup change"], match_against, ts_from, ts_to, tz_string])
 
         out_string = generate_out(tabledata)
+        # Let the user know the teams found are from the archive, so their data is out of date
+        if archived:
+            out_string[0] = "*No current top teams found with that name, these teams have dropped out of the leaderboard:*\n\n" + out_string[0]
     # Otherwise, there aren't any teams that match the search and the output string should reflect that
     else:
         # Initiate the output colour as the command has succeeded but with no data
         out_color = embed_nodata_color
         out_string = "No top teams found with that name."
     
-    # Return the output string
+    # Cache and return the output string
+    query_cache.store(cache_key, (out_color, out_string))
     return out_color, out_string
 
 
+def get_upcoming_teams(hours_string, tz_string, page_string, partition):
+    """Get every team predicted to end within the given number of hours, one page at a time, and return as a string."""
+    # Check the number of hours and page number are whole numbers in range, returning a warning if not
+    if not hours_string.isdigit() or not 0 < int(hours_string) <= upcoming_max_hours:
+        return embed_failure_color, f"The number of hours must be a whole number from 1 to {upcoming_max_hours}."
+    if not page_string.isdigit() or int(page_string) < 1:
+        return embed_failure_color, "The page number must be a whole number from 1."
+    # Get the timezone object from the timezone string and return a warning if it's an invalid timezone
+    tz = get_official_tz(tz_string)
+    if not tz:
+        return (embed_failure_color, "Invalid timezone specified." + suggestion_string(tz_string) +
+                " Please check the instructions and use a valid timezone.")
+
+    # Find the teams predicted to end between now and the given number of hours from now using the leaderboard's schedule
+    now_utc = pytz.utc.localize(datetime.utcnow())
+    upcoming_teams = upcoming_schedule.get_upcoming(partition["key"], team_store.get_data_version(partition),
+                                                    lambda: team_store.get_team_end_times(partition), match_length,
+                                                    now_utc, now_utc + timedelta(hours=int(hours_string)))
+    if len(upcoming_teams) == 0:
+        return embed_nodata_color, f"No top teams due to end within the next {hours_string} hours."
+
+    # Only show the teams on the requested page
+    page_count = (len(upcoming_teams) + upcoming_page_size - 1) // upcoming_page_size
+    page = int(page_string)
+    if page > page_count:
+        return embed_nodata_color, f"There are only {page_count} pages of teams due to end within the next {hours_string} hours."
+    tabledata = []
+    for team in upcoming_teams[(page - 1) * upcoming_page_size:page * upcoming_page_size]:
+        # The team's next match ends one match length after the period its last match was found to have ended in
+        next_from = (try_parsing_date(team["timestamp prior"], utc_tz) + match_length).astimezone(tz)
+        next_to = (try_parsing_date(team["timestamp changed"], utc_tz) + match_length).astimezone(tz)
+        match_against = "-"
+        if team["match against"] != "N/A":
+            match_against = ', '.join(team["match against"].split("¦"))
+        tabledata.append([team["position"], team["name"], team["cup change"], match_against,
+                          next_from.strftime(time_format), next_to.strftime(time_format), tz_string])
+
+    out_string = generate_out(tabledata)
+    # Let the user know which page they're on and how to get the next one
+    out_string[0] = f"*Page {page} of {page_count}, {len(upcoming_teams)} teams due to end within the next {hours_string} hours.*\n\n" + out_string[0]
+    if page < page_count:
+        out_string[-1] += f"\n\n*Use !upcoming {hours_string} {tz_string} {page + 1} for the next page.*"
+    return embed_success_color, out_string
+
+
+async def notify_watchers(subscribers, team_name, predicted_end):
+    """Mention every subscriber of a team in the channel they subscribed from, shortly before it's due to end."""
+    # Subscribers in the same channel and timezone are mentioned together in one message
+    groups = {}
+    for subscriber in subscribers:
+        groups.setdefault((subscriber["channel"], subscriber["timezone"]), []).append(subscriber["user"])
+    for (channel_id, tz_string), user_ids in groups.items():
+        channel = bot.get_channel(channel_id)
+        tz = get_official_tz(tz_string) or utc_tz
+        if channel is None:
+            continue
+        mentions = " ".join(f"<@{user_id}>" for user_id in user_ids)
+        await channel.send(f"{mentions} {team_name} is due to end between {predicted_end[0].astimezone(tz).strftime(time_format)} "
+                           f"and {predicted_end[1].astimezone(tz).strftime(time_format)} {tz_string}.")
+
+
 def update_spreadsheet_with_correction(teamEndTimes, wrong_name, correct_name, correction_type):
     """Update the spreadsheet list given with a correction that should be made."""
     teams_to_delete = []
@@ -491,7 +606,7 @@ def update_spreadsheet_with_correction(teamEndTimes, wrong_name, correct_name, c
     return teamEndTimes
 
 
-def add_correction_exact(wrong_name, correct_name):
+def add_correction_exact(wrong_name, correct_name, partition):
     """Add a team name correction based on exact match to file and correct any currently in spreadsheet."""
     # Remove illegal characters
     wrong_name = wrong_name.replace(',', '')
@@ -500,22 +615,20 @@ def add_correction_exact(wrong_name, correct_name):
     correct_name = correct_name.replace('¦', '')
     wrong_name = wrong_name.replace('`', '')
     correct_name = correct_name.replace('`', '')
-    # Open the file in append mode and write the correction info to the end of the file
-    with open(nameCorrectionPath, mode='a', newline='', encoding="utf-8") as csvfile:
-        correction_writer = csv.writer(csvfile, delimiter=',')
-        correction_writer.writerow([wrong_name, correct_name])
+    # Write the correction info to the end of the leaderboard's file
+    team_store.add_name_correction(partition, "exact", wrong_name, correct_name)
 
     # Get the spreadsheet data, update it with the corrections using exact type and write the updated list to the spreadsheet
-    teamEndTimes = get_team_end_times_from_file()
+    teamEndTimes = team_store.get_team_end_times(partition)
     teamEndTimes = update_spreadsheet_with_correction(teamEndTimes, wrong_name, correct_name, "exact")
-    write_new_spreadsheet_data(teamEndTimes)
+    team_store.write_team_end_times(partition, teamEndTimes)
 
     # Return the output string notifying of the user of successfully adding the correction
     ret_str = "Successfully added exact correction " + wrong_name + " to " + correct_name
     return embed_success_color, ret_str
 
 
-def add_correction_contains(wrong_name, correct_name):
+def add_correction_contains(wrong_name, correct_name, partition):
     """Add a team name correction based on exact match to file and correct any currently in spreadsheet."""
     # Remove illegal characters
     wrong_name = wrong_name.replace(',', '')
@@ -524,22 +637,20 @@ def add_correction_contains(wrong_name, correct_name):
     correct_name = correct_name.replace('¦', '')
     wrong_name = wrong_name.replace('`', '')
     correct_name = correct_name.replace('`', '')
-    # Open the file in append mode and write the correction info to the end of the file
-    with open(nameCorrectionContainsPath, mode='a', newline='', encoding="utf-8") as csvfile:
-        correction_writer = csv.writer(csvfile, delimiter=',')
-        correction_writer.writerow([wrong_name, correct_name])
+    # Write the correction info to the end of the leaderboard's file
+    team_store.add_name_correction(partition, "contains", wrong_name, correct_name)
 
     # Get the spreadsheet data, update it with the corrections using contains type and write the updated list to the spreadsheet
-    teamEndTimes = get_team_end_times_from_file()
+    teamEndTimes = team_store.get_team_end_times(partition)
     teamEndTimes = update_spreadsheet_with_correction(teamEndTimes, wrong_name, correct_name, "contains")
-    write_new_spreadsheet_data(teamEndTimes)
+    team_store.write_team_end_times(partition, teamEndTimes)
 
     # Return the output string notifying of the user of successfully adding the correction
     ret_str = 'Successfully added "contains" correction ' + wrong_name + " to " + correct_name
     return embed_success_color, ret_str
 
 
-def add_correction_regex(pattern, correct_name):
+def add_correction_regex(pattern, correct_name, partition):
     """Add a team name correction based on exact match to file and correct any currently in spreadsheet."""
     # Remove illegal characters
     correct_name = correct_name.replace(',', '')
@@ -547,25 +658,59 @@ def add_correction_regex(pattern, correct_name):
     correct_name = correct_name.replace('¦', '')
     pattern = pattern.replace('`', '')
     correct_name = correct_name.replace('`', '')
-    # Open the file in append mode and write the correction info to the end of the file
-    with open(nameCorrectionRegexPath, mode='a', newline='', encoding="utf-8") as csvfile:
-        correction_writer = csv.writer(csvfile, delimiter='¦')
-        correction_writer.writerow([pattern, correct_name])
+    # Write the correction info to the end of the leaderboard's file
+    team_store.add_name_correction(partition, "regex", pattern, correct_name)
 
     # Get the spreadsheet data, update it with the corrections using regex type and write the updated list to the spreadsheet
-    teamEndTimes = get_team_end_times_from_file()
+    teamEndTimes = team_store.get_team_end_times(partition)
     teamEndTimes = update_spreadsheet_with_correction(teamEndTimes, pattern, correct_name, "regex")
-    write_new_spreadsheet_data(teamEndTimes)
+    team_store.write_team_end_times(partition, teamEndTimes)
 
     # Return the output string notifying of the user of successfully adding the correction
     ret_str = "Successfully added RegEx correction for " + pattern + " to " + correct_name
     return embed_success_color, ret_str
 
 
+# Metrics collected by this bot
+metrics.describe("hcr2_command_seconds", "histogram", "Time taken to handle each command.")
+metrics.describe("hcr2_query_cache_lookups_total", "counter", "Query cache lookups, by whether the response was cached.")
+metrics.describe("hcr2_query_cache_evictions_total", "counter", "Responses dropped from the full query cache.")
+metrics.describe("hcr2_embeds_sent_total", "counter", "Embeds sent by the outbound message sender.")
+metrics.describe("hcr2_messages_sent_total", "counter", "Messages the outbound message sender needed to send its embeds.")
+
+
+def collect_metrics():
+    """Update the metrics that are read from other modules just before they're served."""
+    metrics.set_gauge("hcr2_query_cache_lookups_total", query_cache.cache_stats["hits"], {"result": "hit"})
+    metrics.set_gauge("hcr2_query_cache_lookups_total", query_cache.cache_stats["misses"], {"result": "miss"})
+    metrics.set_gauge("hcr2_query_cache_evictions_total", query_cache.cache_stats["evictions"])
+    metrics.set_gauge("hcr2_embeds_sent_total", message_sender.sender_stats["embeds"])
+    metrics.set_gauge("hcr2_messages_sent_total", message_sender.sender_stats["messages"])
+
+
+metrics.register_collector(collect_metrics)
+
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    """Note when a command started, so how long it took can be worked out once it's finished."""
+    ctx.command_start = perf_counter()
+
+
+@bot.after_invoke
+async def stop_command_timer(ctx):
+    """Add how long a command took to the metrics, whether or not it succeeded."""
+    metrics.observe("hcr2_command_seconds", perf_counter() - ctx.command_start, {"command": ctx.command.name})
+
+
 @bot.event
 async def on_ready():
     """Check that connection to the Discord server has been established."""
     print(f'{bot.user.name} has connected to Discord!')
+    # Start notifying the subscribers of watched teams
+    watch_scheduler.start_scheduler(notify_watchers, match_length)
+    # Serve the metrics if a port has been set for them
+    await metrics.start_server(metrics_port)
 
 
 @bot.command(name="time", help="""Search for top teams supposedly ending at a specified time.\n
@@ -578,21 +723,23 @@ async def time(ctx, *, arg):
     out_string = ("!time command must be in the format !time timestamp timezone(optional). " +
                   "Consult the instructions for more info.")
     out_color = embed_failure_color
-    # Use UTC timezone if timezone not specified
-    if len(split) == 1:
-        out_color, out_string = get_teams_by_time(split[0], "UTC")
-    # Otherwise, use the specified timezone
-    elif len(split) == 2:
-        out_color, out_string = get_teams_by_time(split[0], split[1])
+    # Use UTC timezone if timezone not specified, otherwise, use the specified timezone
+    if len(split) in (1, 2):
+        tz_string = split[1] if len(split) == 2 else "UTC"
+        partition = get_ctx_partition(ctx)
+        # Search the spreadsheet on the executor, alongside any other queries but not while a correction is changing it
+        async with team_store.reading(partition):
+            out_color, out_string = await run_in_executor(get_teams_by_time, split[0], tz_string, partition)
     # The output could be a simple string or list of strings if it's possible that the Discord character limit could be exceeded
     # The list of string represents a list of messages, so output each item in a loop
+    # The messages are queued together so they can be packed into as few Discord messages as possible
     if isinstance(out_string, str):
         embed_block = Embed(description=out_string, color=out_color)
-        await ctx.send(embed=embed_block)
+        message_sender.queue_embed(ctx.channel, embed_block)
     else:
         for string in out_string:
             embed_block = Embed(description=string, color=out_color)
-            await ctx.send(embed=embed_block)
+            message_sender.queue_embed(ctx.channel, embed_block)
 
 
 @bot.command(name="team", help="""Search for top teams by name to find when they last ended.\n
@@ -605,21 +752,164 @@ async def team(ctx, *, arg):
     out_string = ("!team command must be in the format !team `team name` timezone(optional)." +
                   "Consult the instructions for more info.")
     out_color = embed_failure_color
-    # Use UTC timezone if timezone not specified
-    if len(split) == 1:
-        out_color, out_string = get_time_by_team(split[0], "UTC")
-    # Otherwise, use the specified timezone
-    elif len(split) == 2:
-        out_color, out_string = get_time_by_team(split[0], split[1])
+    # Use UTC timezone if timezone not specified, otherwise, use the specified timezone
+    if len(split) in (1, 2):
+        tz_string = split[1] if len(split) == 2 else "UTC"
+        partition = get_ctx_partition(ctx)
+        # Search the spreadsheet on the executor, alongside any other queries but not while a correction is changing it
+        async with team_store.reading(partition):
+            out_color, out_string = await run_in_executor(get_time_by_team, split[0], tz_string, partition)
     # The output could be a simple string or list of strings if it's possible that the Discord character limit could be exceeded
     # The list of string represents a list of messages, so output each item in a loop
+    # The messages are queued together so they can be packed into as few Discord messages as possible
+    if isinstance(out_string, str):
+        embed_block = Embed(description=out_string, color=out_color)
+        message_sender.queue_embed(ctx.channel, embed_block)
+    else:
+        for string in out_string:
+            embed_block = Embed(description=string, color=out_color)
+            message_sender.queue_embed(ctx.channel, embed_block)
+
+
+@bot.command(name="upcoming", help="""Show top teams predicted to end within the next few hours, soonest first.\n
+Format: !upcoming hours(optional) timezone(optional) page(optional)""")
+async def upcoming(ctx, *, arg=""):
+    """Handle the !upcoming command."""
+    # Use a normal split of space to get each part of the command, filling in the defaults for any left out
+    split = arg.split()
+    defaults = [str(upcoming_default_hours), "UTC", "1"]
+    # Prepare the failure output string and color
+    out_string = ("!upcoming command must be in the format !upcoming hours(optional) timezone(optional) page(optional). " +
+                  "Consult the instructions for more info.")
+    out_color = embed_failure_color
+    if len(split) <= 3:
+        split += defaults[len(split):]
+        partition = get_ctx_partition(ctx)
+        # Search the schedule on the executor, alongside any other queries but not while a correction is changing it
+        async with team_store.reading(partition):
+            out_color, out_string = await run_in_executor(get_upcoming_teams, split[0], split[1], split[2], partition)
+    # The output could be a simple string or list of strings if it's possible that the Discord character limit could be exceeded
     if isinstance(out_string, str):
         embed_block = Embed(description=out_string, color=out_color)
-        await ctx.send(embed=embed_block)
+        message_sender.queue_embed(ctx.channel, embed_block)
     else:
         for string in out_string:
             embed_block = Embed(description=string, color=out_color)
-            await ctx.send(embed=embed_block)
+            message_sender.queue_embed(ctx.channel, embed_block)
+
+
+@bot.command(name="watch", help="""Get mentioned shortly before a top team is due to end.\n
+Format: !watch `team name` timezone(optional)""")
+async def watch(ctx, *, arg):
+    """Handle the !watch command."""
+    # Use a backtick aware split to get each part of the command with whitespace within backticks ignored
+    split = split_backtick_aware(arg)
+    # Prepare the failure output string and colour
+    out_string = ("!watch command must be in the format !watch `team name` timezone(optional). " +
+                  "Consult the instructions for more info.")
+    out_color = embed_failure_color
+    if len(split) in (1, 2):
+        tz_string = split[1] if len(split) == 2 else "UTC"
+        partition = get_ctx_partition(ctx)
+        async with team_store.reading(partition):
+            team_name = await run_in_executor(watch_scheduler.find_team_name, partition, split[0])
+        if not get_official_tz(tz_string):
+            out_string = ("Invalid timezone specified." + suggestion_string(tz_string) +
+                          " Please check the instructions and use a valid timezone.")
+        elif team_name is None:
+            out_color = embed_nodata_color
+            out_string = "No top team found with that exact name. Use !team to find the team's full name."
+        else:
+            guild_id = ctx.guild.id if ctx.guild else None
+            watch_scheduler.add_subscription(guild_id, ctx.channel.id, ctx.author.id, team_name, tz_string)
+            watch_scheduler.write_subscriptions()
+            # Schedule the team straight away rather than waiting for the next check for changes
+            await watch_scheduler.refresh_partition(partition, match_length)
+            out_color = embed_success_color
+            out_string = (f"You'll be mentioned here shortly before {team_name} is due to end. " +
+                          "Use !unwatch `" + team_name + "` to stop.")
+    embed_block = Embed(description=out_string, color=out_color)
+    message_sender.queue_embed(ctx.channel, embed_block)
+
+
+@bot.command(name="unwatch", help="""Stop being mentioned before a top team is due to end.\n
+Format: !unwatch `team name`""")
+async def unwatch(ctx, *, arg):
+    """Handle the !unwatch command."""
+    # Use a backtick aware split to get each part of the command with whitespace within backticks ignored
+    split = split_backtick_aware(arg)
+    # Prepare the failure output string and colour
+    out_string = "!unwatch command must be in the format !unwatch `team name`. Consult the instructions for more info."
+    out_color = embed_failure_color
+    if len(split) == 1:
+        guild_id = ctx.guild.id if ctx.guild else None
+        out_color = embed_nodata_color
+        out_string = "You aren't watching a team with that name. Use !watching to see the teams you're watching."
+        if watch_scheduler.remove_subscription(guild_id, ctx.channel.id, ctx.author.id, split[0]):
+            out_color = embed_success_color
+            out_string = "You won't be mentioned about " + split[0] + " anymore."
+    embed_block = Embed(description=out_string, color=out_color)
+    message_sender.queue_embed(ctx.channel, embed_block)
+
+
+@bot.command(name="watching", help="""List the top teams you're watching.\n
+Format: !watching""")
+async def watching(ctx):
+    """Handle the !watching command."""
+    guild_id = ctx.guild.id if ctx.guild else None
+    team_names = watch_scheduler.get_user_subscriptions(guild_id, ctx.channel.id, ctx.author.id)
+    if len(team_names) > 0:
+        embed_block = Embed(description="You're watching: " + ", ".join(team_names), color=embed_success_color)
+    else:
+        embed_block = Embed(description="You aren't watching any teams.", color=embed_nodata_color)
+    message_sender.queue_embed(ctx.channel, embed_block)
+
+
+@bot.command(name="chart", help="""Show a chart of a top team's cups and position over time.\n
+Format: !chart `team name` days(optional) timezone(optional)""")
+async def chart(ctx, *, arg):
+    """Handle the !chart command."""
+    # Use a backtick aware split to get each part of the command with whitespace within backticks ignored
+    split = split_backtick_aware(arg)
+    # Prepare the failure output string and colour
+    out_string = ("!chart command must be in the format !chart `team name` days(optional) timezone(optional). " +
+                  "Consult the instructions for more info.")
+    out_color = embed_failure_color
+    days_string = split[1] if len(split) >= 2 else str(chart_default_days)
+    tz_string = split[2] if len(split) == 3 else "UTC"
+    tz = get_official_tz(tz_string)
+    if not team_charts.charts_available():
+        out_string = "Charts aren't available, as matplotlib isn't installed for the query bot."
+    elif len(split) not in (1, 2, 3):
+        pass
+    elif not days_string.isdigit() or not 1 <= int(days_string) <= chart_max_days:
+        out_string = f"The number of days has to be a whole number from 1 to {chart_max_days}."
+    elif not tz:
+        out_string = ("Invalid timezone specified." + suggestion_string(tz_string) +
+                      " Please check the instructions and use a valid timezone.")
+    else:
+        partition = get_ctx_partition(ctx)
+        # Charts are cached until a sweep or correction changes the data, which changes its version
+        cache_key = (partition["key"], split[0].lower(), int(days_string), tz.zone, team_store.get_data_version(partition))
+        png = team_charts.get_cached_chart(cache_key)
+        if png is None:
+            since = (datetime.utcnow() - timedelta(days=int(days_string))).strftime(datetime_format)
+            # Read the history on the executor, alongside any other queries but not while a correction is changing it
+            async with team_store.reading(partition):
+                team_name, history = await run_in_executor(team_store.get_team_history, partition, split[0], since)
+            if len(history) > 0:
+                # Draw the chart in its own process, so the bot carries on handling other commands meanwhile
+                png = await team_charts.render_chart(team_name, history, tz.zone)
+                team_charts.store_chart(cache_key, png)
+            else:
+                out_color = embed_nodata_color
+                out_string = (f"{split[0]} wasn't found in any sweep in the last {days_string} days. " +
+                              "The team name has to be its full name (upper or lower case doesn't matter).")
+        if png is not None:
+            await ctx.send(file=File(io.BytesIO(png), filename="chart.png"))
+            return
+    embed_block = Embed(description=out_string, color=out_color)
+    message_sender.queue_embed(ctx.channel, embed_block)
 
 
 @bot.command(name="add_tz", help="""Add a new timezone shortcut that uses an official timezone from tz database.\n
@@ -634,9 +924,10 @@ async def add_tz(ctx, *, arg):
     out_color = embed_failure_color
     # Only accept 2 arguments with new_shortcut and official_timezone
     if len(split) == 2:
-        out_color, out_string = add_tz_func(split[0], split[1])
+        async with timezone_lock:
+            out_color, out_string = await run_in_executor(add_tz_func, split[0], split[1])
     embed_block = Embed(description=out_string, color=out_color)
-    await ctx.send(embed=embed_block)
+    message_sender.queue_embed(ctx.channel, embed_block)
 
 
 @bot.command(name="correct", help="""Add a new team name 'exact' correction and update the spreadsheet with the correction.\n
@@ -651,9 +942,12 @@ async def correct(ctx, *, arg):
     out_color = embed_failure_color
     # Only accept 2 arguments with `wrong team name` and `correct team name`
     if len(split) == 2:
-        out_color, out_string = add_correction_exact(split[0], split[1])
+        partition = get_ctx_partition(ctx)
+        # Correct the spreadsheet on the executor, once any queries already reading it have finished
+        async with team_store.writing(partition):
+            out_color, out_string = await run_in_executor(add_correction_exact, split[0], split[1], partition)
     embed_block = Embed(description=out_string, color=out_color)
-    await ctx.send(embed=embed_block)
+    message_sender.queue_embed(ctx.channel, embed_block)
 
 
 @bot.command(name="correct_contains", help="""Add a new team name 'contains' correction and update the spreadsheet with the 
@@ -669,9 +963,12 @@ async def correct_contains(ctx, *, arg):
     out_color = embed_failure_color
     # Only accept 2 arguments with `wrong team name` and `correct team name`
     if len(split) == 2:
-        out_color, out_string = add_correction_contains(split[0], split[1])
+        partition = get_ctx_partition(ctx)
+        # Correct the spreadsheet on the executor, once any queries already reading it have finished
+        async with team_store.writing(partition):
+            out_color, out_string = await run_in_executor(add_correction_contains, split[0], split[1], partition)
     embed_block = Embed(description=out_string, color=out_color)
-    await ctx.send(embed=embed_block)
+    message_sender.queue_embed(ctx.channel, embed_block)
 
 
 @bot.command(name="correct_regex", help="""Add a new team name 'RegEx' correction and update the spreadsheet with the 
@@ -687,17 +984,53 @@ async def correct_regex(ctx, *, arg):
     out_color = embed_failure_color
     # Only accept 2 arguments with `pattern` and `correct team name`
     if len(split) == 2:
-        out_color, out_string = add_correction_regex(split[0], split[1])
+        partition = get_ctx_partition(ctx)
+        # Correct the spreadsheet on the executor, once any queries already reading it have finished
+        async with team_store.writing(partition):
+            out_color, out_string = await run_in_executor(add_correction_regex, split[0], split[1], partition)
     embed_block = Embed(description=out_string, color=out_color)
-    await ctx.send(embed=embed_block)
-
-
-@bot.command(name="get_spreadsheet", help="""Send the spreadsheet file in its current state.\n
-Format: !get_spreadsheet""")
-async def get_spreadsheet(ctx):
-    """Handle the !get_spreadsheet command to send a copy of the spreadsheet."""
-    # Send the csv file in the Discord channel that the original message was sent
-    await ctx.send(file=File(teamEndTimesPath))
+    message_sender.queue_embed(ctx.channel, embed_block)
+
+
+@bot.command(name="cache_stats", help="""Show how often !time and !team queries are answered from the cache.\n
+Format: !cache_stats""")
+async def cache_stats(ctx):
+    """Handle the !cache_stats command to show the query cache's hit and miss counters."""
+    out_string = query_cache.stats_to_string() + "\n" + team_charts.stats_to_string() + "\n" + message_sender.stats_to_string()
+    embed_block = Embed(description=out_string, color=embed_success_color)
+    message_sender.queue_embed(ctx.channel, embed_block)
+
+
+@bot.command(name="get_spreadsheet", help="""Send the spreadsheet file for this channel's leaderboard, or only the teams matching the options.\n
+Format: !get_spreadsheet since=timestamp(optional) sweeps=count(optional) tz=timezone(optional) positions=first-last(optional) name=`text`(optional) format=csv/jsonl(optional) gzip(optional)""")
+async def get_spreadsheet(ctx, *, arg=""):
+    """Handle the !get_spreadsheet command to send a copy of the spreadsheet, or the teams matching the options given."""
+    partition = get_ctx_partition(ctx)
+    # Reading the options needs the sweep history file, so it's done on the executor
+    out_string, options = await run_in_executor(get_export_options, split_backtick_aware(arg), partition)
+    if options is None:
+        embed_block = Embed(description=out_string, color=embed_failure_color)
+        message_sender.queue_embed(ctx.channel, embed_block)
+        return
+    with tempfile.TemporaryDirectory() as folder:
+        copy_path = os.path.join(folder, "spreadsheet.csv")
+        export_path = os.path.join(folder, spreadsheet_export.export_file_name(options))
+        # Copy the file while nothing is correcting it, so a complete copy is exported.
+        # Copying is much quicker than the export, so corrections and sweeps aren't held up while it's written.
+        async with team_store.reading(partition):
+            await run_in_executor(shutil.copyfile, partition["teamEndTimesPath"], copy_path)
+        # Write the export a row at a time on the executor, so a large spreadsheet doesn't hold up other commands
+        team_count = await run_in_executor(spreadsheet_export.export_teams, copy_path, export_path, options)
+        export_size = os.path.getsize(export_path)
+        upload_limit = ctx.guild.filesize_limit if ctx.guild else default_upload_limit
+        # Send the file in the Discord channel that the original message was sent, if it isn't too large for Discord
+        if export_size > upload_limit:
+            out_string = (f"The export of {team_count} teams is too large to send ({export_size / 1024 / 1024:.1f}MB). "
+                          "Use gzip, or since, sweeps, positions or name to export fewer teams.")
+            embed_block = Embed(description=out_string, color=embed_failure_color)
+            message_sender.queue_embed(ctx.channel, embed_block)
+        else:
+            await ctx.send(content=f"{team_count} teams exported.", file=File(export_path))
 
 
 # @bot.command(name="test_text", help="""For testing: test what typing in certain text gets you.\n
@@ -708,5 +1041,6 @@ async def get_spreadsheet(ctx):
 #     print(arg)
 
 
-# Run the bot using the Discord bot interface and bot token
-bot.run(TOKEN)
+# Run the bot using the Discord bot interface and bot token, unless the commands are being imported (like by load_test.py)
+if __name__ == "__main__":
+    bot.run(TOKEN)
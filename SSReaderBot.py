@@ -7,19 +7,34 @@ spreadsheet csv file.
 
 import os
 import re
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 import discord
 from dotenv import load_dotenv
 
-from PIL import Image
 import cv2
 import numpy as np
 
 import pytesseract
-import csv
+
+import digit_recogniser
+import ocr_backend
+from row_segmenter import find_row_bands
+from column_detector import find_column_boxes, find_column_bands, position_merge_radius
+from row_dedup import row_hash, is_seen_row
+from screenshot_precheck import precheck_screenshot
+import reader_sessions
+import reader_jobs
+import team_store
+import message_sender
+import metrics
+import ocr_workers
+import debug_artifacts
+from timezone_resolver import get_official_tz, suggestion_string
 
 import aiohttp
-import io
 
 from datetime import datetime
 import pytz
@@ -32,13 +47,10 @@ os.chdir(dname)
 # Add the directory for Tesseract
 tesseractPath = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
 pytesseract.pytesseract.tesseract_cmd = tesseractPath
+# Tesseract in process (tesserocr, if installed) uses the same languages as tesseract.exe
+if os.path.isdir(os.path.join(os.path.dirname(tesseractPath), "tessdata")):
+    ocr_backend.configure(os.path.join(os.path.dirname(tesseractPath), "tessdata"))
 
-# Change the name corrections and spreadsheet file locations here if necessary
-nameCorrectionPath = "team_name_corrections.csv"
-nameCorrectionContainsPath = "team_name_contains_corrections.csv"
-nameCorrectionRegexPath = "team_name_regex_corrections.csv"
-timezoneShortcutsPath = "timezone_shortcuts.csv"
-teamEndTimesPath = "team_end_times.csv"
 
 # The main format for using both date and time
 datetime_format = "%Y-%m-%dT%H:%M"
@@ -50,8 +62,53 @@ embed_nodata_color = 0xFF9900
 # Load the .env file to get secret token and guild ID for the bot
 load_dotenv()
 TOKEN = os.getenv('READER_DISCORD_TOKEN')
-# We're using Discord client framework for this bot so we can use on_message
-client = discord.Client()
+# Number of sweeps that can be processed at the same time
+reader_workers = int(os.getenv('READER_WORKERS', 2))
+# Number of sweeps a team can be missing from before it's moved out of the spreadsheet into the archive
+retention_sweeps = int(os.getenv('RETENTION_SWEEPS', 12))
+# Local port the metrics are served on, 0 (or left out) to not serve them
+metrics_port = int(os.getenv('READER_METRICS_PORT') or 0)
+# Port and address remote OCR workers connect to (0 or left out to only read screenshots locally), and their token
+ocr_port = int(os.getenv('READER_OCR_PORT') or 0)
+ocr_host = os.getenv('READER_OCR_HOST') or "127.0.0.1"
+ocr_token = os.getenv('OCR_WORKER_TOKEN', "")
+# Which screenshots have their debug images saved (off, failures, sample or all), the fraction of them sampled
+# and the most megabytes the saved images can take up
+debug_artifacts.configure(os.getenv('DEBUG_ARTIFACTS') or "off", float(os.getenv('DEBUG_ARTIFACT_SAMPLE_RATE') or 0.1),
+                          int(float(os.getenv('DEBUG_ARTIFACT_MAX_MB') or 100) * 1024 * 1024))
+# Server whose leaderboards carry on from the spreadsheet and name corrections in the bots' folder
+team_store.configure(int(os.getenv('LEGACY_GUILD_ID') or 0) or None)
+# We're using Discord client framework for this bot so we can use on_message.
+# The bot reads the text of messages for its commands, which needs the message content intent.
+intents = discord.Intents.default()
+intents.message_content = True
+client = discord.Client(intents=intents)
+# Rebuild the screenshot sessions that were open when the bot last stopped
+reader_sessions.load_sessions()
+
+
+# Metrics collected by this bot
+metrics.describe("hcr2_command_seconds", "histogram", "Time taken to handle each command.")
+metrics.describe("hcr2_sweep_stage_seconds", "histogram", "Time taken by each stage of processing a sweep.")
+metrics.describe("hcr2_ocr_row_seconds", "histogram", "Time taken to read the cells of one leaderboard row.")
+metrics.describe("hcr2_screenshots_total", "counter", "Screenshots processed in sweeps, by whether they could be read.")
+metrics.describe("hcr2_rows_dropped_total", "counter", "Rows removed for being out of order, by the column checked.")
+metrics.describe("hcr2_job_queue_depth", "gauge", "Sweep jobs waiting in the queue.")
+metrics.describe("hcr2_jobs", "gauge", "Sweep jobs remembered for !status, by status.")
+metrics.describe("hcr2_embeds_sent_total", "counter", "Embeds sent by the outbound message sender.")
+metrics.describe("hcr2_messages_sent_total", "counter", "Messages the outbound message sender needed to send its embeds.")
+
+
+def collect_metrics():
+    """Update the metrics that are read from other modules just before they're served."""
+    metrics.set_gauge("hcr2_job_queue_depth", reader_jobs.get_queue_depth())
+    for status in ("queued", "running", "done", "cancelled", "failed"):
+        metrics.set_gauge("hcr2_jobs", sum(job["status"] == status for job in reader_jobs.jobs.values()), {"status": status})
+    metrics.set_gauge("hcr2_embeds_sent_total", message_sender.sender_stats["embeds"])
+    metrics.set_gauge("hcr2_messages_sent_total", message_sender.sender_stats["messages"])
+
+
+metrics.register_collector(collect_metrics)
 
 
 # The following functions will be used to correct OCR data as much as possible
@@ -96,9 +153,99 @@ def change_reserved_characters(string):
     return string
 
 
+# Rows read with a confidence (0-100) lower than this are given a second, slower attempt
+min_ocr_confidence = 60
+# psm 7 is used for a single line of text, including only number digits (and . for positions) in result,
+# while also using the specificaly trained HCR2 font as primary language
+positions_ocr_config = '--psm 7 -c tessedit_char_whitelist=0123456789. -l HCR2+eng'
+cups_ocr_config = '--psm 7 -c tessedit_char_whitelist=0123456789 -l HCR2'
+# Thread pool used to read rows in parallel, as each Tesseract call either runs as a separate process or
+# (with tesserocr) lets the other threads run while it reads
+ocr_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+
+def ocr_cell(cell_img, config):
+    """Use Tesseract to read a single row cell, returning its text and lowest word confidence."""
+    words = []
+    confidence = 0.0
+    for word, word_confidence in ocr_backend.read_words(cell_img, config):
+        word = remove_formfeed(word).strip()
+        if word == "":
+            continue
+        confidence = word_confidence if len(words) == 0 else min(confidence, word_confidence)
+        words.append(word)
+    return " ".join(words), confidence
+
+
+def upscale_cell(cell_img):
+    """Upscale a binarised cell image for a second reading attempt."""
+    upscaled = cv2.resize(cell_img, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
+    # Binarise the cell again, since the interpolation leaves grey pixels at the edges of characters
+    _, upscaled = cv2.threshold(upscaled, 127, 255, cv2.THRESH_BINARY)
+    return upscaled
+
+
+def read_name_cell(cell_img):
+    """Read a team name cell with Tesseract, giving it a second, slower attempt if it wasn't read confidently."""
+    # psm 7 is used for a single line of text, while using the specificaly trained HCR2 font as primary language
+    config = '--psm 7 -l HCR2+eng'
+    text, confidence = ocr_cell(cell_img, config)
+    if confidence < min_ocr_confidence:
+        retry_text, retry_confidence = ocr_cell(upscale_cell(cell_img), config)
+        if retry_confidence > confidence:
+            text = retry_text
+    # Change reserved characters that will need to be used for post processing only
+    return change_reserved_characters(text)
+
+
+def read_digit_cell(cell_img, config):
+    """Read a digit cell with the HCR2 font recogniser, only using Tesseract if the recogniser isn't confident."""
+    text, confidence = digit_recogniser.recognise_row(cell_img < 128)
+    if confidence < digit_recogniser.min_confidence:
+        retry_text, retry_confidence = ocr_cell(upscale_cell(cell_img), config)
+        if retry_confidence > confidence:
+            text = retry_text
+    # Remove the extra unwanted characters in the output
+    return remove_dotNcomma(remove_space(text))
+
+
+def read_row(cups_cell, names_cell, positions_cell):
+    """Read the cells of a single row and return them as a team dictionary, or None if the row can't be read."""
+    with metrics.timed("hcr2_ocr_row_seconds"):
+        position = read_digit_cell(positions_cell, positions_ocr_config)
+        cups = read_digit_cell(cups_cell, cups_ocr_config)
+        # Skip the row if the numbers couldn't be read as numbers, as the name won't be any use without them
+        if not position.isdigit() or not cups.isdigit():
+            return None
+        name = read_name_cell(names_cell)
+        if name == "":
+            return None
+        return {"position": position, "name": name, "cups": cups}
+
+
 # The main image processing function that uses Tesseract OCR to get text from image
-async def SS_extract_text(imgcv):
-    """Take an OpenCV image and extract the text from the columns."""
+async def SS_extract_text(imgcv, seen_rows=None, artifact_name=None):
+    """Take an OpenCV image and extract the text from the columns.
+    Rows whose hash is close to one in seen_rows are skipped. Return the rows that were read along with
+    each row's hash, so the caller can add the hashes of the rows it keeps to seen_rows.
+    artifact_name names the screenshot's debug images, if they're being saved."""
+    if seen_rows is None:
+        seen_rows = []
+    # Collect the images made while reading, they're only saved if debug images are on and this screenshot is chosen
+    capture = debug_artifacts.start_capture(artifact_name)
+    debug_artifacts.add(capture, "screenshot", imgcv)
+    try:
+        team_row_list, team_row_hashes = await extract_columns_text(imgcv, seen_rows, capture)
+    except Exception:
+        debug_artifacts.finish(capture, failed=True)
+        raise
+    debug_artifacts.finish(capture, failed=False)
+    return team_row_list, team_row_hashes
+
+
+async def extract_columns_text(imgcv, seen_rows, capture):
+    """Find the columns in an OpenCV image and read the text from each row, adding the column images to capture.
+    Return the rows read and their hashes."""
     # Get the height and width of the image to crop it
     height, width = imgcv.shape[:2]
 
@@ -113,256 +260,157 @@ async def SS_extract_text(imgcv):
     # Threshold the image to binarise the image for only black or white pixels
     _, BWcv2img = cv2.threshold(grayImage, 110, 255, cv2.THRESH_BINARY)
 
-    # Get the new height and width of the cropped image
-    height, width = BWcv2img.shape[:2]
-    # Invert the image to prepare for dilation
-    BWcv2imgInv = cv2.bitwise_not(BWcv2img)
-    # Use a 5*5 kernel to dilate the image
-    kernel = np.ones((5, 5), np.uint8)
-    # Dilate the image using the kernel, doing so with a tested 10 iterations to mix characters together
-    dilated = cv2.dilate(BWcv2imgInv, kernel, iterations=10)
-    # Also use a kernel to mix together the rows to make one long column
-    # Kernel stretches vertically by height/8 as there should be 9 rows, making it stretch by slightly more than 1 row height
-    vertical_row_mix_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, ksize=(1, int(height / 8)))
-
-    # Dilate the already dilated image with the vertical stretching kernel to mix rows into long columns
-    colCheckDilate = cv2.dilate(dilated, vertical_row_mix_kernel)
-
-    # Find the contours in the column check dilated image to verify it's a column we're looking for
-    colCheckContours, _ = cv2.findContours(colCheckDilate, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-
-    # Loop through every proposed column and add to mid point in the x direction of every column that's at least 90%
-    # of the image height to a list for checking later
-    colMidPts = []
-    for col in colCheckContours:
-        x, y, w, h = cv2.boundingRect(col)
-        if h > (0.9 * height):
-            leftSide = x
-            rightSide = x + w
-            midPt = (leftSide + rightSide) / 2
-            colMidPts.append(midPt)
-
-    # Make a vertical kernel that's sure to span the entire height of the image even if the pixel is at the top/bottom of image
-    vertical_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, ksize=(1, 2 * height))
-    # Dilate the image using the new vertical kernel to get every possible column
-    dilated = cv2.dilate(dilated, vertical_kernel)
-    # Get the contours of this new dilated image of columns
-    contours, _ = cv2.findContours(dilated, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-
-    goodCol = False
+    # Find the columns from the ink in each pixel column, ordered from right to left
     cntNum = 0
-    # Loop through each contour representing a column and decide if it should be used
-    for cnt in contours:
-        # Get the bounds of the contour
-        x, y, w, h = cv2.boundingRect(cnt)
-        # Make sure this is an acceptable column by checking the mid points of acceptable columns is within
-        # the bounds of the contour along the x axis
-        for Pt in colMidPts:
-            if Pt > x and Pt < (x + w):
-                goodCol = True
-                break
-        # Once identified as a good column, process each one individually, depending column number
-        if goodCol:
-            # First column is the team cups
-            if cntNum == 0:
-                # Crop contour size out of binary image and put into variable as image
-                cups_img = BWcv2img[y:y+h, x:x+w]
-                cntNum += 1
-            # Second column is images of a cup, so should be ignored
-            elif cntNum == 1:
-                cntNum += 1
-            # Third column is team names
-            elif cntNum == 2:
-                # Crop contour size out of binary image and put into variable as image
-                names_img = BWcv2img[y:y+h, x:x+w]
-                # Inverse black and white in the image
-                names_img_inv = cv2.bitwise_not(names_img)
-                # Make a new kernel for full horizontal dilation of image. 7 px height was chosen through testing
-                horizontal_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, ksize=(2 * w, 7))
-                # Dilate using the horizintal kernel to get each row as a contour
-                names_img_rows = cv2.dilate(names_img_inv, horizontal_kernel)
-                # Extract the contours out of the dilated image to find each row's bounds
-                NameRowContours, _ = cv2.findContours(names_img_rows, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-                # Reverse to get each row from top to bottom rather than bottom to top
-                NameRowContours.reverse()
-                # Generate a list of bad row contours to remove
-                rowCntsToRemove = []
-                for row in NameRowContours:
-                    # Get the row's height from the top and bottom most pixel y-axis coordinates
-                    rowTop = tuple(row[row[:, :, 1].argmin()][0])
-                    rowBottom = tuple(row[row[:, :, 1].argmax()][0])
-                    rowHeight = rowBottom[1] - rowTop[1]
-                    # Add to the list of contours to remove if the row's height is less than 2% of the image's total height
-                    if (rowHeight/height)*100 < 2:
-                        rowCntsToRemove.append(row)
-                # Remove each row contour that has been marked for removal
-                for removeRow in rowCntsToRemove:
-                    NameRowContours.remove(removeRow)
-
-                # Create the blank mask to be written to with all contours to be removed
-                cleanupMask = np.ones(names_img.shape[:2], dtype="uint8") * 255
-                # Get every contour (letter/shape) in the names_img
-                NameContours, _ = cv2.findContours(names_img_inv, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-                # Reverse to get the contours in the right order
-                NameContours.reverse()
-
-                # Loop through each contour found and find the left, right, top and bottom most pixel locations of that contour
-                charLocation = []
-                for charCnt in NameContours:
-                    charLeft = tuple(charCnt[charCnt[:, :, 0].argmin()][0])
-                    charRight = tuple(charCnt[charCnt[:, :, 0].argmax()][0])
-                    charTop = tuple(charCnt[charCnt[:, :, 1].argmin()][0])
-                    charBottom = tuple(charCnt[charCnt[:, :, 1].argmax()][0])
-                    # Loop through each row found by contour and get the top and bottom most pixels of that row contour
-                    for row in NameRowContours:
-                        rowTop = tuple(row[row[:, :, 1].argmin()][0])
-                        rowBottom = tuple(row[row[:, :, 1].argmax()][0])
-                        # Add the character contour extreme bounds to the list, with the top and bottom bounds of the row it's in
-                        if charTop[1] >= rowTop[1] and charTop[1] <= rowBottom[1]:
-                            charLocation.append((charLeft, charRight, charTop, charBottom, rowTop, rowBottom))
-
-                # Loop through each contour again, just like before, to decide if it should be removed this time
-                for charCnt in NameContours:
-                    charLeft = tuple(charCnt[charCnt[:, :, 0].argmin()][0])
-                    charRight = tuple(charCnt[charCnt[:, :, 0].argmax()][0])
-                    charTop = tuple(charCnt[charCnt[:, :, 1].argmin()][0])
-                    charBottom = tuple(charCnt[charCnt[:, :, 1].argmax()][0])
-                    # Loop though each identified character contour found earlier
-                    for idenCharRow in charLocation:
-                        # Make sure it's not the same character contour being examined
-                        if charLeft != idenCharRow[0] and charRight != idenCharRow[1] and charTop != idenCharRow[2] and charBottom != idenCharRow[3]:
-                            # Find out if it's an overlapping contour on right side
-                            # Within same row \ right side of character overlaps another character \
-                            # less than 2 pixels wider on either side than other character
-                            if charTop[1] >= idenCharRow[4][1] and charBottom[1] <= idenCharRow[5][1] \
-                                    and charRight[0] >= idenCharRow[0][0] and charRight[0] <= idenCharRow[1][0] \
-                                    and (charLeft[0] < idenCharRow[0][0] - 2 or charRight[0] > idenCharRow[1][0] + 2):
-                                cv2.drawContours(cleanupMask, [charCnt], -1, 0, -1)
-
-                # Add the mask to the original image
-                names_img_inv = cv2.bitwise_and(names_img_inv, names_img_inv, mask=cleanupMask)
-
-                # Find tiny pixels left over and remove them (with area less than 5)
-                NameContours, _ = cv2.findContours(names_img_inv, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-                for nameCnt in NameContours:
-                    area = cv2.contourArea(nameCnt)
-                    if area < 5:
-                        cv2.drawContours(cleanupMask, [nameCnt], -1, 0, -1)
-                # Add this mask to the original image
-                names_img_inv = cv2.bitwise_and(names_img_inv, names_img_inv, mask=cleanupMask)
-
-                # Find first pixel location for each row
-                firstPxRow = []
-                for row in NameRowContours:
-                    # Get the top and bottom most pixels of the row contour
-                    rowTop = tuple(row[row[:, :, 1].argmin()][0])
-                    rowBottom = tuple(row[row[:, :, 1].argmax()][0])
-                    # Crop out the row to use
-                    array = names_img_inv[rowTop[1]:rowBottom[1], 0:w]
-                    # Rotate it so that the first relevant pixel is found by column
-                    array = np.rot90(array, 3)
-                    # Find the first white pixel in the inversed image
-                    white_pixels = np.array(np.where(array == 255))
-                    first_white_pixelX = white_pixels[:, 0][0]
-                    # Add this pixel location's x coordinate to the list
-                    firstPxRow.append(first_white_pixelX)
-
-                # Perform cluster analysis to find the most common first x coordinate within a certain range
-                maxgap = 3
-                firstPxRow.sort()
-                groups = [[firstPxRow[0]]]
-                for x in firstPxRow[1:]:
-                    if abs(x - groups[-1][-1]) <= maxgap:
-                        groups[-1].append(x)
-                    else:
-                        groups.append([x])
-                # Get the index of the largest group in the groups list
-                lists_len = [len(i) for i in groups]
-                groups_index = np.argmax(np.array(lists_len))
-
-                # Get the first most common pixel found earlier
-                firstPx = min(groups[groups_index])
-                # Create a mask covering until the first most common pixel
-                rectMask = np.ones(names_img.shape[:2], dtype="uint8") * 255
-                cv2.rectangle(rectMask, (0, 0), (firstPx, h), 0, -1)
-                # Add this mask to the original image
-                names_img_inv = cv2.bitwise_and(names_img_inv, names_img_inv, mask=rectMask)
-
-                # Return the image to black text on white background
-                names_img = cv2.bitwise_not(names_img_inv)
-
-                cntNum += 1
-            # Fourth column is team position number
-            elif cntNum == 3:
-                # Crop contour size out of binary image and put into variable as image
-                positions_img = BWcv2img[y:y+h, x:x+w]
-                # Remove the team badges
-
-                # Inverse the image ready for dilation
-                positions_imgInv = cv2.bitwise_not(positions_img)
-                # Dilate using the normal kernel to merge characters
-                posDilated = cv2.dilate(positions_imgInv, kernel)
-                # Dilate using the vertical kernel to get separate columns
-                posDilated = cv2.dilate(posDilated, vertical_kernel)
-                # Find the contours of each column
-                posContours, _ = cv2.findContours(posDilated, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-                # Get the column bounds for the first coumn as second column is just team badges
-                x, y, w, h = cv2.boundingRect(posContours[0])
-                # Crop out and use the contour bounds for the image as the positions_img
-                positions_img = positions_img[y:y+h, x:x+w]
-                cntNum += 1
-        # Reset the identification of a good column
-        goodCol = False
-
-    color_coverted = cv2.cvtColor(cups_img, cv2.COLOR_BGR2RGB)
-    cups_img = Image.fromarray(color_coverted)
-    color_coverted = cv2.cvtColor(names_img, cv2.COLOR_BGR2RGB)
-    names_img = Image.fromarray(color_coverted)
-    names_img.save("names_img.png")
-    color_coverted = cv2.cvtColor(positions_img, cv2.COLOR_BGR2RGB)
-    positions_img = Image.fromarray(color_coverted)
-    positions_img.save("positions_img.png")
-
-    # Get the text from the positions image, using psm 6 for vertical block of text,
-    # including only number digits and . in result, while also using the specificaly trained HCR2 font as primary language
-    positions_txt = pytesseract.image_to_string(positions_img, config='--psm 6 -c tessedit_char_whitelist=0123456789. -l HCR2+eng')
-    # Remove the extra unwanted characters in the output
-    positions_txt = remove_formfeed(positions_txt)
-    positions_txt = remove_space(positions_txt)
-    positions_txt = remove_dotNcomma(positions_txt)
-    # Put the result in a list by splitting the string by newlines
-    positions_list = positions_txt.splitlines()
-
-    # Get the text from the names image, using psm 6 for vertical block of text,
-    # while using the specificaly trained HCR2 font as primary language
-    names_txt = pytesseract.image_to_string(names_img, config='--psm 6 -l HCR2+eng')
-    # Remove the extra unwanted characters in the output
-    names_txt = remove_formfeed(names_txt)
-    names_txt = remove_extra_newline(names_txt)
-    # Change reserved characters that will need to be used for post processing only
-    names_txt = change_reserved_characters(names_txt)
-    # Put the result in a list by splitting the string by newlines
-    names_list = names_txt.splitlines()
-
-    # Get the text from the cups image, using psm 6 for vertical block of text,
-    # including only number digits in result, while also using the specificaly trained HCR2 font as primary language
-    cups_txt = pytesseract.image_to_string(cups_img, config='--psm 6 -c tessedit_char_whitelist=0123456789 -l HCR2')
-    # Remove the extra unwanted characters in the output
-    cups_txt = remove_formfeed(cups_txt)
-    cups_txt = remove_space(cups_txt)
-    # Put the result in a list by splitting the string by newlines
-    cups_list = cups_txt.splitlines()
+    for x, y, w, h in find_column_boxes(BWcv2img):
+        # First column is the team cups
+        if cntNum == 0:
+            # Crop contour size out of binary image and put into variable as image
+            cups_img = BWcv2img[y:y+h, x:x+w]
+            cntNum += 1
+        # Second column is images of a cup, so should be ignored
+        elif cntNum == 1:
+            cntNum += 1
+        # Third column is team names
+        elif cntNum == 2:
+            # Crop contour size out of binary image and put into variable as image
+            names_img = BWcv2img[y:y+h, x:x+w]
+            # Inverse black and white in the image
+            names_img_inv = cv2.bitwise_not(names_img)
+            # Find the row bands once from the names column, to be used for cropping every column into rows
+            row_bands = find_row_bands(names_img)
+
+            # Create the blank mask to be written to with all contours to be removed
+            cleanupMask = np.ones(names_img.shape[:2], dtype="uint8") * 255
+            # Get every contour (letter/shape) in the names_img
+            NameContours, _ = cv2.findContours(names_img_inv, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+            # Reverse to get the contours in the right order
+            NameContours.reverse()
+
+            # Loop through each contour found and find the left, right, top and bottom most pixel locations of that contour
+            charLocation = []
+            for charCnt in NameContours:
+                charLeft = tuple(charCnt[charCnt[:, :, 0].argmin()][0])
+                charRight = tuple(charCnt[charCnt[:, :, 0].argmax()][0])
+                charTop = tuple(charCnt[charCnt[:, :, 1].argmin()][0])
+                charBottom = tuple(charCnt[charCnt[:, :, 1].argmax()][0])
+                # Loop through each row band and get the top and bottom most pixels of that row
+                for rowTop, rowBottom in row_bands:
+                    # Add the character contour extreme bounds to the list, with the top and bottom bounds of the row it's in
+                    if charTop[1] >= rowTop and charTop[1] <= rowBottom:
+                        charLocation.append((charLeft, charRight, charTop, charBottom, rowTop, rowBottom))
+
+            # Loop through each contour again, just like before, to decide if it should be removed this time
+            for charCnt in NameContours:
+                charLeft = tuple(charCnt[charCnt[:, :, 0].argmin()][0])
+                charRight = tuple(charCnt[charCnt[:, :, 0].argmax()][0])
+                charTop = tuple(charCnt[charCnt[:, :, 1].argmin()][0])
+                charBottom = tuple(charCnt[charCnt[:, :, 1].argmax()][0])
+                # Loop though each identified character contour found earlier
+                for idenCharRow in charLocation:
+                    # Make sure it's not the same character contour being examined
+                    if charLeft != idenCharRow[0] and charRight != idenCharRow[1] and charTop != idenCharRow[2] and charBottom != idenCharRow[3]:
+                        # Find out if it's an overlapping contour on right side
+                        # Within same row \ right side of character overlaps another character \
+                        # less than 2 pixels wider on either side than other character
+                        if charTop[1] >= idenCharRow[4] and charBottom[1] <= idenCharRow[5] \
+                                and charRight[0] >= idenCharRow[0][0] and charRight[0] <= idenCharRow[1][0] \
+                                and (charLeft[0] < idenCharRow[0][0] - 2 or charRight[0] > idenCharRow[1][0] + 2):
+                            cv2.drawContours(cleanupMask, [charCnt], -1, 0, -1)
+
+            # Add the mask to the original image
+            names_img_inv = cv2.bitwise_and(names_img_inv, names_img_inv, mask=cleanupMask)
+
+            # Find tiny pixels left over and remove them (with area less than 5)
+            NameContours, _ = cv2.findContours(names_img_inv, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+            for nameCnt in NameContours:
+                area = cv2.contourArea(nameCnt)
+                if area < 5:
+                    cv2.drawContours(cleanupMask, [nameCnt], -1, 0, -1)
+            # Add this mask to the original image
+            names_img_inv = cv2.bitwise_and(names_img_inv, names_img_inv, mask=cleanupMask)
+
+            # Find first pixel location for each row
+            firstPxRow = []
+            for rowTop, rowBottom in row_bands:
+                # Crop out the row to use
+                array = names_img_inv[rowTop:rowBottom, 0:w]
+                # Rotate it so that the first relevant pixel is found by column
+                array = np.rot90(array, 3)
+                # Find the first white pixel in the inversed image
+                white_pixels = np.array(np.where(array == 255))
+                first_white_pixelX = white_pixels[:, 0][0]
+                # Add this pixel location's x coordinate to the list
+                firstPxRow.append(first_white_pixelX)
+
+            # Perform cluster analysis to find the most common first x coordinate within a certain range
+            maxgap = 3
+            firstPxRow.sort()
+            groups = [[firstPxRow[0]]]
+            for x in firstPxRow[1:]:
+                if abs(x - groups[-1][-1]) <= maxgap:
+                    groups[-1].append(x)
+                else:
+                    groups.append([x])
+            # Get the index of the largest group in the groups list
+            lists_len = [len(i) for i in groups]
+            groups_index = np.argmax(np.array(lists_len))
+
+            # Get the first most common pixel found earlier
+            firstPx = min(groups[groups_index])
+            # Create a mask covering until the first most common pixel
+            rectMask = np.ones(names_img.shape[:2], dtype="uint8") * 255
+            cv2.rectangle(rectMask, (0, 0), (firstPx, h), 0, -1)
+            # Add this mask to the original image
+            names_img_inv = cv2.bitwise_and(names_img_inv, names_img_inv, mask=rectMask)
+
+            # Return the image to black text on white background
+            names_img = cv2.bitwise_not(names_img_inv)
+
+            cntNum += 1
+        # Fourth column is team position number
+        elif cntNum == 3:
+            # Crop contour size out of binary image and put into variable as image
+            positions_img = BWcv2img[y:y+h, x:x+w]
+            # Remove the team badges
+
+            # Find the columns within it, only merging characters, and use the last one as the other is just team badges
+            left, right = find_column_bands(positions_img, position_merge_radius)[-1]
+            # Crop out the column as the positions_img, keeping the full height so the rows line up with the other columns
+            positions_img = positions_img[:, left:right]
+            cntNum += 1
+
+    debug_artifacts.add(capture, "cups", cups_img)
+    debug_artifacts.add(capture, "names", names_img)
+    debug_artifacts.add(capture, "positions", positions_img)
+
+    # Read every row's cells separately and in parallel, since each one only needs a single line of text read
+    loop = asyncio.get_running_loop()
+    row_reads = []
+    row_hashes = []
+    for top, bottom in row_bands:
+        # Skip any row that was already read from an earlier screenshot, as the screenshots often overlap
+        hash_bits = row_hash(cups_img[top:bottom], names_img[top:bottom], positions_img[top:bottom])
+        if is_seen_row(hash_bits, seen_rows):
+            continue
+        row_hashes.append(hash_bits)
+        row_reads.append(loop.run_in_executor(ocr_executor, read_row,
+                                              cups_img[top:bottom], names_img[top:bottom], positions_img[top:bottom]))
+    # Only rows that could be read in every column are kept, along with their hashes
+    team_row_list = []
+    team_row_hashes = []
+    for hash_bits, team in zip(row_hashes, await asyncio.gather(*row_reads)):
+        if team is not None:
+            team_row_list.append(team)
+            team_row_hashes.append(hash_bits)
 
     # Handle the function output
-    # The number of lines for each column needs to match, otherwise an error needs to be returned
-    if len(positions_list) == len(names_list) == len(cups_list):
-        # Merge all 3 columns into one list of dictionaries specifying each column name as key and instance as value
-        team_row_list = []
-        for teamNum in range(0, len(positions_list)):
-            team_row_list.append({"position": positions_list[teamNum], "name": names_list[teamNum], "cups": cups_list[teamNum]})
-        return team_row_list
+    # There needs to be at least one complete row, unless every row had already been read before,
+    # otherwise an error needs to be returned
+    if len(team_row_list) > 0 or len(row_reads) == 0:
+        return team_row_list, team_row_hashes
     else:
-        raise Exception("Uneven rows were found.")
+        raise Exception("No complete rows were found.")
 
 
 def fixDupTeamNames(team_list, num=1, name="N/A"):
@@ -455,6 +503,7 @@ def remove_inconsecutive_in_list(l, dict_key, descending=False):
     removing all incorrect data. The removal of data can be used instead as a last resort."""
     # Use the function above to find the indices of elements that should be removed
     remove_list = find_inconsecutive_in_dict_list(l, dict_key, descending)
+    metrics.inc("hcr2_rows_dropped_total", {"column": dict_key}, len(remove_list))
     out_list = l
     # Remove any indicies from the original list
     for i in remove_list:
@@ -463,14 +512,9 @@ def remove_inconsecutive_in_list(l, dict_key, descending=False):
     return out_list
 
 
-def get_name_corrections_regex(team_list):
-    """Correct the team list using RegEx from file."""
-    # Read from the csv file for name corrections in regex format and add to the list
-    nameCorrectionRegex = []
-    with open(nameCorrectionRegexPath, newline='', encoding="utf-8") as csvfile:
-        reader = csv.DictReader(csvfile, delimiter='¦')
-        for row in reader:
-            nameCorrectionRegex.append((row["Pattern"], row["Correct name"]))
+def get_name_corrections_regex(team_list, partition):
+    """Correct the team list using the leaderboard's RegEx corrections."""
+    nameCorrectionRegex = team_store.get_name_corrections(partition)["regex"]
     # Correct team names based on the regex of names submitted by the user
     for line in team_list:
         for pattern, value in nameCorrectionRegex:
@@ -480,14 +524,9 @@ def get_name_corrections_regex(team_list):
     return team_list
 
 
-def get_name_corrections_contains(team_list):
-    """Correct the team list using substring containment from file."""
-    # Read from the csv file for name corrections that contain a keyword and add to the dictionary
-    nameCorrectionContains = {}
-    with open(nameCorrectionContainsPath, newline='', encoding="utf-8") as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            nameCorrectionContains[row["Identified name"]] = row["Correct name"]
+def get_name_corrections_contains(team_list, partition):
+    """Correct the team list using the leaderboard's substring containment corrections."""
+    nameCorrectionContains = team_store.get_name_corrections(partition)["contains"]
     # Correct team names based on user submitted preferences of names containing keywords
     for line in team_list:
         for key in nameCorrectionContains:
@@ -497,14 +536,9 @@ def get_name_corrections_contains(team_list):
     return team_list
 
 
-def get_name_corrections_exact(team_list):
-    """Correct the team list using exact matching strings from file."""
-    # Read from the csv file for name corrections and add to the dictionary
-    nameCorrection = {}
-    with open(nameCorrectionPath, newline='', encoding="utf-8") as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            nameCorrection[row["Identified name"]] = row["Correct name"]
+def get_name_corrections_exact(team_list, partition):
+    """Correct the team list using the leaderboard's exact matching string corrections."""
+    nameCorrection = team_store.get_name_corrections(partition)["exact"]
     # Correct team names based on user submitted preferences
     for line in team_list:
         if line["name"] in nameCorrection:
@@ -513,25 +547,6 @@ def get_name_corrections_exact(team_list):
     return team_list
 
 
-def get_team_end_times_from_file():
-    """Get the data from the spreadsheet into a list of dictionaries and return the list."""
-    teamEndTimes = []
-    with open(teamEndTimesPath, newline='', encoding="utf-8") as csvfile:
-        reader = csv.DictReader(csvfile)
-        for i, row in enumerate(reader):
-            teamEndTimes.append({})
-            teamEndTimes[i]["position"] = row["position"]
-            teamEndTimes[i]["name"] = row["name"]
-            teamEndTimes[i]["cups"] = row["cups"]
-            teamEndTimes[i]["match against"] = row["match against"]
-            teamEndTimes[i]["cup change"] = row["cup change"]
-            teamEndTimes[i]["timestamp prior"] = row["timestamp prior"]
-            teamEndTimes[i]["timestamp checked"] = row["timestamp checked"]
-            teamEndTimes[i]["timestamp changed"] = row["timestamp changed"]
-    # Return the list of dictionaries
-    return teamEndTimes
-
-
 def update_spreadsheet(team_list, teamEndTimes, timestamp):
     """Update the spreadsheet list with the new SS data."""
     # First, use the previous timestamp saved in "timestamp checked" to update the prior timestamp
@@ -603,31 +618,6 @@ def update_spreadsheet(team_list, teamEndTimes, timestamp):
     return teamEndTimes
 
 
-def write_new_spreadsheet_data(teamEndTimes):
-    """Write the new updated data to the spreadsheet, overwriting the old data."""
-    with open(teamEndTimesPath, mode='w', newline='', encoding="utf-8") as team_data:
-        team_writer = csv.writer(team_data, delimiter=',')
-        # Write the table headings
-        team_writer.writerow(["position", "name", "cups", "match against",
-                              "cup change", "timestamp prior", "timestamp checked", "timestamp changed"])
-        # Write the table data for each row
-        for row in teamEndTimes:
-            team_writer.writerow([row["position"], row["name"], row["cups"],
-                                 row["match against"], row["cup change"], row["timestamp prior"],
-                                 row["timestamp checked"], row["timestamp changed"]])
-
-
-def get_timezone_shortcuts():
-    """Return a dictionary of timezone name shortcuts from file."""
-    # Read from the csv file for timezone shortcuts and add to the dictionary
-    shortcut = {}
-    with open(timezoneShortcutsPath, newline='', encoding="utf-8") as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            shortcut[row["shortcut"]] = row["timezone"]
-    return shortcut
-
-
 def try_parsing_date(text, tz):
     """Used for validation of user input for creating a datetime object."""
     # Loop over allowed formats to try and find a match (2 available right now)
@@ -654,22 +644,6 @@ def try_parsing_date(text, tz):
     return False
 
 
-def get_official_tz(user_tz):
-    """Take a timezone string and return a pytz object for use with datetime."""
-    official_tz = user_tz
-    # Get the list of saved shortcuts from file
-    tz_shortcuts = get_timezone_shortcuts()
-    # Replace the timezone string with what's saved as the official string for that shortcut
-    if official_tz in tz_shortcuts:
-        official_tz = tz_shortcuts[user_tz]
-
-    # Return the timezone object if it exists in pytz
-    if official_tz in pytz.all_timezones:
-        return pytz.timezone(official_tz)
-    # Return False if it doesn't exist in pytz
-    return False
-
-
 def get_datetime_from_string(input_string):
     """Get a datetime object from the user input string and return feedback string if invalid string."""
     # Split the string by space to get each part of the command
@@ -691,7 +665,7 @@ def get_datetime_from_string(input_string):
                     # Set the output string to an informative error for the user
                     out_string = "Invalid timestamp format in command."
             else:
-                out_string = "Invalid timezone in command."
+                out_string = "Invalid timezone in command." + suggestion_string(split[2])
         # If timezone doesn't exist, use UTC timezone with the timestamp string
         else:
             dt = try_parsing_date(split[1], pytz.timezone("UTC"))
@@ -705,143 +679,354 @@ def get_datetime_from_string(input_string):
     return out_string, dt
 
 
+async def download_image(session, url):
+    """Download an image from a URL and return it as an OpenCV image, or None if it couldn't be downloaded."""
+    async with session.get(url) as response:
+        # A successful download produces a status code of 200
+        if response.status != 200:
+            return None
+        data = await response.read()
+    # Convert the image into an OpenCV image, which will be None if the attachment isn't an image
+    return cv2.imdecode(np.frombuffer(data, np.uint8), 1)
+
+
+# Problems the pre-check found in each uploaded screenshot by URL, kept for !end,
+# up to the most screenshots that are remembered before the oldest are forgotten
+precheck_results = {}
+max_precheck_results = 1000
+
+
+def remember_precheck(url, problems):
+    """Keep the problems the pre-check found in an uploaded screenshot, so it doesn't need checking again at !end."""
+    precheck_results[url] = problems
+    # Forget the oldest results once there are too many, as dictionaries keep the order they were added in
+    while len(precheck_results) > max_precheck_results:
+        del precheck_results[next(iter(precheck_results))]
+
+
+def get_precheck_problems(url, img):
+    """Get the problems the pre-check found in a screenshot when it was uploaded, checking it now if it wasn't."""
+    # Screenshots uploaded before the bot last started haven't been checked by this run of the bot
+    if url not in precheck_results:
+        remember_precheck(url, precheck_screenshot(img))
+    return precheck_results[url]
+
+
+def record_attachments(message):
+    """Add a message's attachments to its channel's open session, returning False if there isn't an open session."""
+    for attachment in message.attachments:
+        if not reader_sessions.add_attachment(message.channel.id, message.id, attachment.url):
+            return False
+    return len(message.attachments) > 0
+
+
+async def read_screenshot(img, seen_rows, artifact_name=None):
+    """Read the teams from one OpenCV screenshot, skipping any rows in seen_rows, and return them as a list.
+    The hashes of the rows returned are added to seen_rows. artifact_name names the screenshot's debug images,
+    like sweep/screenshot."""
+    # Read the screenshot on a remote OCR worker if any are registered, otherwise it's read here
+    rows, row_hashes = await ocr_workers.extract_text(img, seen_rows, SS_extract_text, artifact_name)
+    # Nothing to check if every row in the screenshot had already been read
+    if len(rows) == 0:
+        return rows
+    # Make sure only correct data passes to the final list
+    # This is done on each SS individually, rather than the whole list of data to improve accuracy,
+    # as in position numbers having an extra number in one of the rows wouldn't place it at the end
+    # of the list but somewhere in the middle, making it impossible to find with the method being used.
+    l = remove_inconsecutive_in_list(list(rows), "position", descending=False)
+    l = remove_inconsecutive_in_list(l, "cups", descending=True)
+    # Only the rows that passed both checks are remembered as seen, so a team in a misread row that was removed
+    # can still be read from the next screenshot
+    kept = {id(team) for team in l}
+    seen_rows.extend(hash_bits for team, hash_bits in zip(rows, row_hashes) if id(team) in kept)
+    return l
+
+
+def correct_team_list(team_list, partition):
+    """Flatten the list of teams read from each screenshot into one list and correct the team names."""
+    # Flatten the team list so that each team entry is a separate item in one list
+    team_list = [item for sublist in team_list for item in sublist]
+    
+    # Correct team names using RegEx
+    team_list = get_name_corrections_regex(team_list, partition)
+    # Correct team names using substring containment
+    team_list = get_name_corrections_contains(team_list, partition)
+    # Correct team names using exact matching strings
+    team_list = get_name_corrections_exact(team_list, partition)
+    
+    # There may be duplicate team names from the resulting screenshots,
+    # so just add an extra number to the end to fix them
+    return fixDupTeamNames(team_list)
+
+
+def merge_sweep(team_list, partition, timestamp_string):
+    """Merge a sweep's corrected team list into the leaderboard's spreadsheet. The partition must be locked for writing."""
+    # Get the data from the spreadsheet into a separate list of dictionaries
+    teamEndTimes = team_store.get_team_end_times(partition)
+    # The archive only grows, so it's only read and rewritten when teams are moved into or out of it
+    archivedTeams = None
+    archive_changed = False
+
+    # Bring back any archived teams that are on the leaderboard again, so their cup changes carry on.
+    # Only teams that aren't already in the spreadsheet can be in the archive.
+    active_names = {team["name"] for team in teamEndTimes}
+    if any(team["name"] not in active_names for team in team_list):
+        archivedTeams = team_store.get_archived_teams(partition)
+        remainingTeams = team_store.reactivate_archived_teams(team_list, teamEndTimes, archivedTeams)
+        archive_changed = len(remainingTeams) != len(archivedTeams)
+        archivedTeams = remainingTeams
+
+    # Update the spreadsheet list using the new SS data
+    teamEndTimes = update_spreadsheet(team_list, teamEndTimes, timestamp_string)
+
+    # Move teams that haven't been seen for a while into the archive, keeping the spreadsheet small
+    team_store.record_sweep(partition, timestamp_string)
+    # Keep every team's position and cups from the sweep for charts
+    team_store.record_team_history(partition, team_list, timestamp_string)
+    teamEndTimes, droppedTeams = team_store.compact_team_end_times(
+        teamEndTimes, team_store.get_sweep_history(partition), retention_sweeps)
+    if len(droppedTeams) > 0:
+        if archivedTeams is None:
+            archivedTeams = team_store.get_archived_teams(partition)
+        # Newly archived teams go first, so the most recent record for a name is found first
+        archivedTeams = droppedTeams + archivedTeams
+        archive_changed = True
+
+    # Sort the spreadsheet data by position number
+    teamEndTimes.sort(key=lambda team: int(team["position"]))
+
+    # Rewrite the spreadsheet and, if teams moved into or out of it, the archive with the new updated data
+    team_store.write_team_end_times(partition, teamEndTimes)
+    if archive_changed:
+        team_store.write_archived_teams(partition, archivedTeams)
+
+
+async def process_sweep(job, channel, session, dt, partition):
+    """Download and read every screenshot in an ended session, then merge the teams into the leaderboard's spreadsheet."""
+    job["screenshots"] = len(session["attachments"])
+    img_list = []
+    # Problems with individual screenshots are collected up and sent together in one summary
+    screenshot_problems = []
+    # Get the images from the attachment URLs, in order of upload
+    download_start = time.perf_counter()
+    async with aiohttp.ClientSession() as http_session:
+        # Start the counter for the image number at 1 (useful for error analysis)
+        for imageNum, (_, url) in enumerate(session["attachments"], 1):
+            # Download the image from URL of the attachment
+            img = await download_image(http_session, url)
+            if img is None:
+                # Let the user know the message can't be downloaded
+                screenshot_problems.append(f"Could not download image {imageNum}.")
+            else:
+                job["downloaded"] += 1
+            # Add the image and its URL to the img_list, with None as a placeholder if it couldn't be downloaded
+            img_list.append((url, img))
+    metrics.observe("hcr2_sweep_stage_seconds", time.perf_counter() - download_start, {"stage": "download"})
+
+    if len(img_list) > 0:
+        # Get one long list by taking data from each image to construct the dictionary table of teams
+        team_list = []
+        # Hashes of the rows read so far, so rows that overlap between screenshots are only read once
+        seen_rows = []
+        # Debug images are saved in a folder for each sweep, named after its time and job
+        sweep_name = f"{dt.astimezone(pytz.utc):%Y-%m-%dT%H-%M}_job{job['id']}"
+        read_start = time.perf_counter()
+        # Start with an iterator value of 1 for easier error readability and loop through each image
+        for i, (url, img) in enumerate(img_list, 1):
+            # Images that couldn't be downloaded have already been reported
+            if img is None:
+                continue
+            # Flag anything the upload check found covering the screenshot, but still read it, as the check can't be
+            # sure and the rows it can read are better than none
+            warnings = get_precheck_problems(url, img)
+            # Expect an error out of each image, so use exception handling
+            try:
+                # If all goes well, add the team info to the main team list
+                team_list.append(await read_screenshot(img, seen_rows, f"{sweep_name}/screenshot{i}"))
+                metrics.inc("hcr2_screenshots_total", {"result": "read"})
+            except Exception as e:
+                # If an individual screenshot had any issues, this is shown to the user
+                screenshot_problems.append(f"Problem with screenhot {i}: {e}")
+                metrics.inc("hcr2_screenshots_total", {"result": "failed"})
+            finally:
+                job["read"] += 1
+            if len(warnings) > 0:
+                screenshot_problems.append(f"Screenshot {i} may not have been read fully: {' '.join(warnings)}")
+        metrics.observe("hcr2_sweep_stage_seconds", time.perf_counter() - read_start, {"stage": "read"})
+        # Show the user every problem with the screenshots at once
+        if len(screenshot_problems) > 0:
+            message_sender.queue_summary(channel, f"{len(screenshot_problems)} screenshots had problems:",
+                                         screenshot_problems, embed_failure_color)
+        # Flatten the team list and correct the team names
+        with metrics.timed("hcr2_sweep_stage_seconds", {"stage": "correct"}):
+            team_list = correct_team_list(team_list, partition)
+        # Nothing can be added to the spreadsheet if no teams could be read from any of the screenshots
+        if len(team_list) == 0:
+            embed_block = discord.Embed(description="No teams could be read from the screenshots, so nothing was added "
+                                                    "to the spreadsheet.", color=embed_nodata_color)
+            message_sender.queue_embed(channel, embed_block)
+            return
+        
+        # Let the user know which position numbers were successfully added to the spreadsheet
+        position_nums = []
+        for team in team_list:
+            position_nums.append(int(team["position"]))
+        embed_block = discord.Embed(description=consectutive_group_to_string(position_nums), color=embed_success_color)
+        message_sender.queue_embed(channel, embed_block)
+        
+        # Get the datetime object as a UTC timestamp
+        dt_utc = dt.astimezone(pytz.timezone("UTC"))
+        timestamp_string = dt_utc.strftime(datetime_format)
+
+        # Lock the leaderboard's spreadsheet so another sweep can't change it between reading and rewriting it,
+        # sweeps for other leaderboards have their own spreadsheets and locks so they don't need to wait
+        async with team_store.writing(partition):
+            with metrics.timed("hcr2_sweep_stage_seconds", {"stage": "merge"}):
+                merge_sweep(team_list, partition, timestamp_string)
+        job["merged"] = len(team_list)
+    # Since no images were uploaded if there aren't any in the list, let the user know
+    else:
+        out_string = "No screenshot images were uploaded."
+        embed_block = discord.Embed(description=out_string, color=embed_nodata_color)
+        message_sender.queue_embed(channel, embed_block)
+
+
+def report_job_failure(channel):
+    """Make a function that tells a channel when one of its sweep jobs has failed."""
+    def on_failure(job, e):
+        out_string = (f"Job {job['id']} failed: {e}\n"
+                      "Delete its !end message and send it again to process the screenshots again.")
+        message_sender.queue_embed(channel, discord.Embed(description=out_string, color=embed_failure_color))
+    return on_failure
+
+
 @client.event
 async def on_ready():
     """Check that connection to the Discord server has been established."""
     print(f'{client.user.name} has connected to Discord!')
+    # Start the workers that process the sweeps in the background
+    reader_jobs.start_workers(reader_workers)
+    # Serve the metrics if a port has been set for them
+    await metrics.start_server(metrics_port)
+    # Accept remote OCR workers if a port has been set for them
+    await ocr_workers.start_coordinator(ocr_port, ocr_host, ocr_token)
 
 
 @client.event
 async def on_message(message):
+    """Handle a message, timing how long each command or screenshot upload takes."""
+    command = message.content.split(' ')[0]
+    # Only known commands are used as labels, so the metrics can't be filled with anything a user types
+    if command not in ("!start", "!end", "!status", "!cancel"):
+        command = "upload" if len(message.attachments) > 0 else None
+    if command is None or message.author == client.user:
+        await handle_message(message)
+    else:
+        with metrics.timed("hcr2_command_seconds", {"command": command}):
+            await handle_message(message)
+
+
+async def handle_message(message):
     """Retreives the image from Discord."""
     # Make sure the bot isn't replying to itself
     if message.author == client.user:
         return
-    # !end command initiates the bot to find screenshots uploaded and process them
+    # !start command opens a new session in the channel for the screenshots uploaded after it
+    elif message.content.startswith("!start"):
+        reader_sessions.start_session(message.channel.id, message.id, message.content)
+        record_attachments(message)
+    # !end command initiates the bot to process the screenshots uploaded since !start
     elif message.content.startswith("!end"):
-        found_start = False
+        # Screenshots attached to the !end message itself are part of the session too
+        record_attachments(message)
         # Attempt to get a datetime object from the end command, otherwise it will be taken from !start
         out_error, dt = get_datetime_from_string(message.content)
-        # Get the channel history to find uploaded images and !start command
-        history = await message.channel.history().flatten()
-        get_SS_from_msg_before = 0
-        # Iterate over every message in history to find a message beginning with !start
-        for i, msg in enumerate(history):
-            # To prevent old images from being used, stop when the previous
-            # !end command is reached unless it's the current message
-            if msg.content.startswith("!end") and msg != message:
-                break
-            # When a start command is found, indicate this, save the message number
-            # to know where to stop using the list of messages and try to get a datetime
-            # object from the message if not already found.
-            elif msg.content.startswith("!start"):
-                found_start = True
-                get_SS_from_msg_before = i
-                if not dt:
-                    out_error, dt = get_datetime_from_string(msg.content)
-                break
+        # Get the session opened by the !start command, which holds the screenshots uploaded since
+        session = reader_sessions.get_open_session(message.channel.id)
+        found_start = session is not None
+        # Try to get a datetime object from the !start message if not already found
+        if found_start and not dt:
+            out_error, dt = get_datetime_from_string(session["start content"])
         # Set the output error message if the !start command couldn't be found
         if not found_start:
             out_error = "Could not find start of screenshots! Please make sure to use !start before uploading any screenshots."
         # !start found and datetime object parsed sucessfully
         if found_start and dt:
-            # Trim the message history to get only until !start command was found
-            history = history[:get_SS_from_msg_before + 1]
-            # Reverse the history to get screenshots in order of upload
-            history.reverse()
-            imageNum = 0
-            img_list = []
-            # Loop over every message in the history of interest
-            for msg in history:
-                # Get the images from the attachment URL
-                async with aiohttp.ClientSession() as session:
-                    # Loop over every image in the message attachments
-                    for attachment in msg.attachments:
-                        # Increase the counter for the image number (useful for error analysis)
-                        imageNum += 1
-                        # Download the image from URL of the attachment
-                        async with session.get(attachment.url) as response:
-                            # A successful download produces a status code of 200
-                            if response.status != 200:
-                                # Use a placeholder for the image in the list since the actual one can't be downloaded
-                                img_list.append(False)
-                                # Let the user know the message can't be downloaded
-                                out_string = f"Could not download image {imageNum}."
-                                embed_block = discord.Embed(description=out_string, color=embed_failure_color)
-                                await message.channel.send(embed=embed_block)
-                            # Convert the image into an OpenCV image
-                            data = io.BytesIO(await response.read())
-                            img = cv2.imdecode(np.frombuffer(data.read(), np.uint8), 1)
-                            # Add the image to the img_list
-                            img_list.append(img)
-            
-            if len(img_list) > 0:
-                # Get one long list by taking data from each image to construct the dictionary table of teams
-                team_list = []
-                # Start with an iterator value of 1 for easier error readability and loop through each image
-                for i, img in enumerate(img_list, 1):
-                    # Expect an error out of each image, so use exception handling
-                    try:
-                        # If all goes well, add the team info to the main team list
-                        l = await SS_extract_text(img)
-                        # Make sure only correct data passes to the final list
-                        # This is done on each SS individually, rather than the whole list of data to improve accuracy,
-                        # as in position numbers having an extra number in one of the rows wouldn't place it at the end
-                        # of the list but somewhere in the middle, making it impossible to find with the method being used.
-                        l = remove_inconsecutive_in_list(l, "position", descending=False)
-                        l = remove_inconsecutive_in_list(l, "cups", descending=True)
-                        team_list.append(l)
-                    except Exception as e:
-                        # If an individual screenshot had any issues, this is shown to the user
-                        out_string = f"Problem with screenhot {i}: {e}"
-                        embed_block = discord.Embed(description=out_string, color=embed_failure_color)
-                        await message.channel.send(embed=embed_block)
-                # Flatten the team list so that each team entry is a separate item in one list
-                team_list = [item for sublist in team_list for item in sublist]
-                
-                # Correct team names using RegEx
-                team_list = get_name_corrections_regex(team_list)
-                # Correct team names using substring containment
-                team_list = get_name_corrections_contains(team_list)
-                # Correct team names using exact matching strings
-                team_list = get_name_corrections_exact(team_list)
-                
-                # There may be duplicate team names from the resulting screenshots,
-                # so just add an extra number to the end to fix them
-                team_list = fixDupTeamNames(team_list)
-                
-                # Let the user know which position numbers were successfully added to the spreadsheet
-                position_nums = []
-                for team in team_list:
-                    position_nums.append(int(team["position"]))
-                embed_block = discord.Embed(description=consectutive_group_to_string(position_nums), color=embed_success_color)
-                await message.channel.send(embed=embed_block)
-                
-                # Get the data from the spreadsheet into a separate list of dictionaries
-                teamEndTimes = get_team_end_times_from_file()
-                
-                # Get the datetime object as a UTC timestamp
-                dt_utc = dt.astimezone(pytz.timezone("UTC"))
-                timestamp_string = dt_utc.strftime(datetime_format)
-                
-                # Update the spreadsheet list using the new SS data
-                teamEndTimes = update_spreadsheet(team_list, teamEndTimes, timestamp_string)
-                
-                # Sort the spreadsheet data by position number
-                teamEndTimes.sort(key=lambda team: int(team["position"]))
-                
-                # Rewrite the spreadsheet file with the new updated data
-                write_new_spreadsheet_data(teamEndTimes)
-            # Since no images were uploaded if there aren't any in the list, let the user know
-            else:
-                out_string = "No screenshot images were uploaded."
-                embed_block = discord.Embed(description=out_string, color=embed_nodata_color)
-                await message.channel.send(embed=embed_block)
+            # Close the session so new screenshots need a new !start, it will be reopened if this !end is deleted.
+            # A failed !end leaves the session open so it can simply be sent again.
+            reader_sessions.end_session(message.channel.id, message.id)
+            # Find the leaderboard this channel's screenshots are for
+            guild_id = message.guild.id if message.guild else None
+            partition = team_store.get_partition(guild_id, message.channel.id)
+            # Process the screenshots in the background so the bot can keep handling other messages
+            job = reader_jobs.submit_job(message.channel.id, f"sweep for the {partition['leaderboard']} leaderboard",
+                                         lambda job: process_sweep(job, message.channel, session, dt, partition),
+                                         report_job_failure(message.channel))
+            out_string = (f"Started job {job['id']} to process {len(session['attachments'])} screenshots. "
+                          "Use !status to check its progress or !cancel " + str(job['id']) + " to stop it.")
+            embed_block = discord.Embed(description=out_string, color=embed_success_color)
+            message_sender.queue_embed(message.channel, embed_block)
         # Let the user know what went wrong with their upload command
         else:
             embed_block = discord.Embed(description=out_error, color=embed_failure_color)
-            await message.channel.send(embed=embed_block)
+            message_sender.queue_embed(message.channel, embed_block)
+    # !status command shows the progress of the channel's sweep jobs
+    elif message.content.startswith("!status"):
+        channel_jobs = reader_jobs.get_channel_jobs(message.channel.id)
+        if len(channel_jobs) > 0:
+            out_string = "\n".join(reader_jobs.job_to_string(job) for job in channel_jobs)
+            out_string += "\n" + message_sender.stats_to_string()
+            out_string += "\n" + ocr_workers.workers_to_string()
+            embed_block = discord.Embed(description=out_string, color=embed_success_color)
+        else:
+            embed_block = discord.Embed(description="No jobs have been started in this channel.", color=embed_nodata_color)
+        message_sender.queue_embed(message.channel, embed_block)
+    # !cancel command stops a queued or running sweep job
+    elif message.content.startswith("!cancel"):
+        split = message.content.split(' ')
+        out_string = "!cancel command must be in the format !cancel job_id. Use !status to find the job ID."
+        out_color = embed_failure_color
+        if len(split) == 2 and split[1].isdigit():
+            job = reader_jobs.jobs.get(int(split[1]))
+            # Only jobs from the same channel can be cancelled
+            if job is not None and job["channel"] == message.channel.id and reader_jobs.cancel_job(job["id"]):
+                out_string = (f"Cancelled job {job['id']}. "
+                              "Delete its !end message and send it again if the screenshots need processing again.")
+                out_color = embed_success_color
+            else:
+                out_string = f"There is no unfinished job {split[1]} in this channel."
+        embed_block = discord.Embed(description=out_string, color=out_color)
+        message_sender.queue_embed(message.channel, embed_block)
+    # Record screenshots in the open session and check them as soon as they're uploaded,
+    # so the user can replace a bad one before sending !end
+    elif len(message.attachments) > 0 and record_attachments(message):
+        screenshot_problems = []
+        async with aiohttp.ClientSession() as session:
+            for imageNum, attachment in enumerate(message.attachments, 1):
+                img = await download_image(session, attachment.url)
+                # Only images are checked, anything else that was attached is ignored
+                if img is None:
+                    continue
+                problems = precheck_screenshot(img)
+                # The result is kept for !end, so the screenshot isn't checked twice
+                remember_precheck(attachment.url, problems)
+                if len(problems) > 0:
+                    screenshot_problems.append(f"Screenshot {imageNum}: {' '.join(problems)}")
+        # Warn the user about every screenshot in the message that may not be readable at once
+        if len(screenshot_problems) > 0:
+            message_sender.queue_summary(message.channel,
+                                         "Some screenshots in this message may not be fully readable. They'll still "
+                                         "be read at !end, but if something is covering the leaderboard, you can "
+                                         "delete the message and upload clearer screenshots before using !end.",
+                                         screenshot_problems, embed_nodata_color)
+
+
+@client.event
+async def on_raw_message_delete(payload):
+    """Update the channel's sessions when a message is deleted, including when an !end is deleted to be sent again."""
+    reader_sessions.delete_message(payload.channel_id, payload.message_id)
 
 
-# Run the bot using the Discord client and bot token
-client.run(TOKEN)
+# Run the bot using the Discord client and bot token, unless the functions are being imported (like by backfill.py)
+if __name__ == "__main__":
+    client.run(TOKEN)
@@ -0,0 +1,241 @@
+"""
+Screenshot backfill for HCR2.
+
+Reads folders of old screenshots straight into a leaderboard's spreadsheet without going through Discord, for when the
+reader bot was down or a new leaderboard is being started. Each folder holds the screenshots of one sweep and is named
+after the time they were taken, like 2021-04-14T20-00. Sweeps are read in parallel by a pool of processes and merged
+in time order, and each merged sweep is recorded so an interrupted backfill carries on where it left off. A merge
+that was stopped part way through is undone the next time, so the sweep is merged again from the start. Sweeps from
+before the leaderboard's latest sweep are skipped, since the spreadsheet can only be moved forwards in time.
+
+Usage: python backfill.py folder --guild guild_id [--tz timezone] [--channel channel_id] [--workers count]
+                          [--threads count]
+"""
+
+import os
+import csv
+import json
+import time
+import shutil
+import asyncio
+import argparse
+from datetime import datetime
+from multiprocessing import Pool
+
+# Folders given on the command line are relative to where it was run from, which importing the reader bot changes
+launch_dir = os.getcwd()
+
+import cv2
+import pytz
+
+import SSReaderBot
+import team_store
+import ocr_worker
+import debug_artifacts
+from screenshot_precheck import precheck_screenshot
+from timezone_resolver import get_official_tz, suggestion_string
+
+# Screenshot file types that are read, anything else in a sweep folder is ignored
+image_extensions = (".png", ".jpg", ".jpeg")
+# Formats the sweep folders can be named in, since colons aren't allowed in folder names on Windows
+sweep_folder_formats = ("%Y-%m-%dT%H-%M", "%Y-%m-%dT%H%M", "%Y-%m-%dT%H:%M")
+# File inside the backfill folder that records which sweeps have been merged
+backfillProgressName = "backfill_done.csv"
+# File inside the backfill folder recording the sweep being merged, so the merge can be undone if it's stopped
+backfillJournalName = "backfill_merging.json"
+
+
+def parse_sweep_time(folder_name, tz):
+    """Get the UTC datetime of a sweep from its folder name in the given timezone, or None if it isn't a sweep folder."""
+    for fmt in sweep_folder_formats:
+        try:
+            return tz.localize(datetime.strptime(folder_name, fmt)).astimezone(pytz.utc)
+        except ValueError:
+            pass
+    return None
+
+
+def find_sweeps(root, tz):
+    """Find every sweep folder in the backfill folder and return a list of (UTC datetime, folder path) in time order."""
+    sweeps = []
+    for folder_name in os.listdir(root):
+        sweep_path = os.path.join(root, folder_name)
+        dt = parse_sweep_time(folder_name, tz)
+        if dt is not None and os.path.isdir(sweep_path):
+            sweeps.append((dt, sweep_path))
+        elif os.path.isdir(sweep_path):
+            print(f"Skipping {folder_name}, its name isn't a time like 2021-04-14T20-00.")
+    sweeps.sort()
+    return sweeps
+
+
+def read_sweep(sweep_path):
+    """Read every screenshot in a sweep folder in name order, the same way the reader bot reads an uploaded sweep.
+    Runs in a worker process. Return the teams read from each screenshot, the problems found and the time taken."""
+    start = time.perf_counter()
+    image_names = sorted(name for name in os.listdir(sweep_path) if name.lower().endswith(image_extensions))
+    team_list = []
+    problems = []
+    # Hashes of the rows read so far, so rows that overlap between screenshots are only read once
+    seen_rows = []
+    for i, image_name in enumerate(image_names, 1):
+        img = cv2.imread(os.path.join(sweep_path, image_name))
+        if img is None:
+            problems.append(f"Could not open screenshot {image_name}.")
+            continue
+        # Flag anything that may be covering the screenshot, but still read it
+        warnings = precheck_screenshot(img)
+        try:
+            artifact_name = f"backfill_{os.path.basename(sweep_path)}/{os.path.splitext(image_name)[0]}"
+            team_list.append(asyncio.run(SSReaderBot.read_screenshot(img, seen_rows, artifact_name)))
+        except Exception as e:
+            problems.append(f"Problem with screenshot {image_name}: {e}")
+        if len(warnings) > 0:
+            problems.append(f"Screenshot {image_name} may not have been read fully: {' '.join(warnings)}")
+    # Make sure the debug images are written before the worker process can be stopped
+    debug_artifacts.flush()
+    return sweep_path, len(image_names), team_list, problems, time.perf_counter() - start
+
+
+def load_done_sweeps(progress_path):
+    """Get the names of the sweep folders that have already been merged."""
+    if not os.path.exists(progress_path):
+        return set()
+    with open(progress_path, newline='', encoding="utf-8") as csvfile:
+        reader = csv.DictReader(csvfile)
+        return {row["sweep"] for row in reader}
+
+
+def record_done_sweep(progress_path, sweep_name, timestamp_string):
+    """Add a sweep folder to the list of merged sweeps."""
+    # Write the table headings if the file is new
+    write_headings = not os.path.exists(progress_path)
+    with open(progress_path, mode='a', newline='', encoding="utf-8") as csvfile:
+        progress_writer = csv.writer(csvfile, delimiter=',')
+        if write_headings:
+            progress_writer.writerow(["sweep", "timestamp"])
+        progress_writer.writerow([sweep_name, timestamp_string])
+
+
+def begin_merge(journal_path, partition, sweep_name):
+    """Record what's needed to undo a sweep's merge into the partition, before any of its files are changed."""
+    journal = {"sweep": sweep_name, "sizes": {}, "backups": {}}
+    # The history files are only ever added to, so they're undone by cutting them back to their size before the merge
+    for path in (partition["sweepHistoryPath"], partition["teamHistoryPath"]):
+        journal["sizes"][path] = os.path.getsize(path) if os.path.exists(path) else None
+    # The spreadsheet and archive are rewritten, so they're copied
+    for path in (partition["teamEndTimesPath"], partition["teamArchivePath"]):
+        journal["backups"][path] = None
+        if os.path.exists(path):
+            shutil.copyfile(path, path + ".backfill")
+            journal["backups"][path] = path + ".backfill"
+    # Write the journal to a temporary file first and swap it in, so it's never half written
+    with open(journal_path + ".tmp", mode='w', encoding="utf-8") as journal_file:
+        json.dump(journal, journal_file)
+    os.replace(journal_path + ".tmp", journal_path)
+
+
+def finish_merge(journal_path):
+    """Forget the undo information of a sweep once it has been merged and recorded as done."""
+    with open(journal_path, encoding="utf-8") as journal_file:
+        journal = json.load(journal_file)
+    for backup_path in journal["backups"].values():
+        if backup_path is not None and os.path.exists(backup_path):
+            os.remove(backup_path)
+    os.remove(journal_path)
+
+
+def undo_unfinished_merge(journal_path, done_sweeps):
+    """Put the partition's files back how they were before a merge that was stopped part way through."""
+    if not os.path.exists(journal_path):
+        return
+    with open(journal_path, encoding="utf-8") as journal_file:
+        journal = json.load(journal_file)
+    # A sweep that was recorded as done finished merging, only its undo information was left behind
+    if journal["sweep"] not in done_sweeps:
+        print(f"Undoing the unfinished merge of {journal['sweep']}, it will be merged again.")
+        for path, size in journal["sizes"].items():
+            if size is None:
+                if os.path.exists(path):
+                    os.remove(path)
+            elif os.path.exists(path):
+                with open(path, mode='r+b') as history_file:
+                    history_file.truncate(size)
+        for path, backup_path in journal["backups"].items():
+            if backup_path is None:
+                if os.path.exists(path):
+                    os.remove(path)
+            else:
+                os.replace(backup_path, path)
+    finish_merge(journal_path)
+
+
+def main():
+    """Backfill a leaderboard's spreadsheet from the sweep folders given on the command line."""
+    parser = argparse.ArgumentParser(description="Read folders of old screenshots into a leaderboard's spreadsheet. "
+                                                 "Stop the reader bot first, or backfill a leaderboard it isn't using.")
+    parser.add_argument("folder", help="folder holding a folder of screenshots for each sweep, named after its time")
+    parser.add_argument("--tz", default="UTC", help="timezone or shortcut the folder names are in (default UTC)")
+    # There's no default server, since leaving it out would quietly backfill the direct messages leaderboard
+    parser.add_argument("--guild", type=int, required=True, help="server ID of the leaderboard to backfill")
+    parser.add_argument("--channel", type=int, default=None, help="reader channel ID of the leaderboard to backfill")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of sweeps read at the same time")
+    parser.add_argument("--threads", type=int, default=1, help="number of rows of each screenshot read at the same time")
+    args = parser.parse_args()
+
+    tz = get_official_tz(args.tz)
+    if not tz:
+        parser.error(f"Invalid timezone {args.tz}.{suggestion_string(args.tz)}")
+    root = os.path.join(launch_dir, args.folder)
+    progress_path = os.path.join(root, backfillProgressName)
+    journal_path = os.path.join(root, backfillJournalName)
+    partition = team_store.get_partition(args.guild, args.channel)
+
+    # Skip the sweeps that were merged by an earlier run, after undoing any merge it was stopped part way through
+    done_sweeps = load_done_sweeps(progress_path)
+    undo_unfinished_merge(journal_path, done_sweeps)
+    sweeps = [(dt, path) for dt, path in find_sweeps(root, tz) if os.path.basename(path) not in done_sweeps]
+    # Merging a sweep older than the leaderboard's latest one would move its timestamps backwards, so they're skipped
+    sweep_history = team_store.get_sweep_history(partition)
+    if len(sweep_history) > 0:
+        latest_sweep = max(sweep_history)
+        for dt, path in sweeps:
+            if dt.strftime(SSReaderBot.datetime_format) <= latest_sweep:
+                print(f"Skipping {os.path.basename(path)}, the leaderboard already has a sweep from {latest_sweep}.")
+        sweeps = [(dt, path) for dt, path in sweeps if dt.strftime(SSReaderBot.datetime_format) > latest_sweep]
+    print(f"Backfilling {len(sweeps)} sweeps into the {partition['leaderboard']} leaderboard "
+          f"({len(done_sweeps)} already done) with {args.workers} workers.")
+
+    start = time.perf_counter()
+    screenshot_count = 0
+    team_count = 0
+    # Each process reads its own sweep, so it only gets a few threads for reading rows rather than one for every CPU core
+    with Pool(max(1, args.workers), initializer=ocr_worker.use_row_threads, initargs=(max(1, args.threads),)) as pool:
+        sweep_times = {path: dt for dt, path in sweeps}
+        # Sweeps are read in parallel, but imap gives back the results in order so they're merged in time order
+        for sweep_path, images, team_list, problems, read_time in pool.imap(read_sweep, [path for _, path in sweeps]):
+            sweep_name = os.path.basename(sweep_path)
+            timestamp_string = sweep_times[sweep_path].strftime(SSReaderBot.datetime_format)
+            team_list = SSReaderBot.correct_team_list(team_list, partition)
+            # The backfill is the only thing writing to the spreadsheet, so it doesn't need locking
+            begin_merge(journal_path, partition, sweep_name)
+            if len(team_list) > 0:
+                SSReaderBot.merge_sweep(team_list, partition, timestamp_string)
+            record_done_sweep(progress_path, sweep_name, timestamp_string)
+            finish_merge(journal_path)
+
+            screenshot_count += images
+            team_count += len(team_list)
+            for problem in problems:
+                print(f"  {problem}")
+            elapsed = time.perf_counter() - start
+            print(f"{sweep_name}: {images} screenshots, {len(team_list)} teams merged, read in {read_time:.1f}s. "
+                  f"Overall {screenshot_count / elapsed:.2f} screenshots/s.")
+
+    elapsed = time.perf_counter() - start
+    print(f"Finished {len(sweeps)} sweeps in {elapsed:.1f}s: {screenshot_count} screenshots and {team_count} teams, "
+          f"{screenshot_count / max(elapsed, 1e-9):.2f} screenshots/s.")
+
+
+if __name__ == "__main__":
+    main()
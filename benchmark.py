@@ -0,0 +1,257 @@
+"""
+Processing benchmarks for HCR2.
+
+Times the functions that clean up OCR text and process the spreadsheet on made up tables of 100 to 100,000 teams, so
+the effect of optimising them can be measured. Results can be saved as a baseline, and later runs are compared with it
+and fail when a function has become slower than the baseline by more than the allowed ratio. Larger sizes are skipped
+for a function once they would take too long, since some of these functions slow down with the square of the size.
+
+Usage: python benchmark.py [--save] [--max-ratio ratio] [--only name] [--sizes 100,1000] [--time-limit seconds]
+"""
+
+import os
+import sys
+import copy
+import json
+import math
+import random
+import argparse
+from time import perf_counter
+
+# The baselines file given on the command line is relative to where it was run from, which importing the bots changes
+launch_dir = os.getcwd()
+
+import pytz
+
+import SSReaderBot
+import SSQueryBot
+
+# Number of teams in each made up table, smallest first
+default_sizes = (100, 1000, 10000, 100000)
+# Each timing is the median of this many measurements, and each measurement calls the function enough times
+# to take at least this many seconds
+repeats = 5
+min_measure_time = 0.02
+# Characters used in made up team names
+name_characters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 |-_'"
+# Sweep times the made up spreadsheet rows were checked and changed at
+sweep_times = ["2021-04-14T20:00", "2021-04-14T22:00", "2021-04-15T00:00", "2021-04-15T02:00"]
+
+
+def make_name(rng):
+    """Make up a team name."""
+    return "".join(rng.choice(name_characters) for _ in range(rng.randint(4, 14))).strip() or "TEAM"
+
+
+def make_team_list(size, rng, duplicate_rate=0.01, out_of_order_rate=0.0):
+    """Make up a list of teams as read from screenshots, in position order with their cups going down."""
+    teams = []
+    cups = 10 * size + 5000
+    for position in range(1, size + 1):
+        cups -= rng.randint(1, 20)
+        # Some names are read the same as an earlier team's name
+        if len(teams) > 0 and rng.random() < duplicate_rate:
+            name = rng.choice(teams)["name"]
+        else:
+            name = make_name(rng)
+        teams.append({"position": str(position), "name": name, "cups": str(cups)})
+    # Some rows are misread, so their position or cups are out of order
+    for team in teams:
+        if rng.random() < out_of_order_rate:
+            team[rng.choice(["position", "cups"])] = str(rng.randint(1, 10 * size + 5000))
+    return teams
+
+
+def make_team_end_times(size, rng):
+    """Make up a spreadsheet of teams with unique names, some of which have had their cups change."""
+    teamEndTimes = []
+    for i, team in enumerate(make_team_list(size, rng, duplicate_rate=0)):
+        changed = rng.random() < 0.5
+        teamEndTimes.append({"position": team["position"],
+                             # Add the row number so every name is unique, like in a real spreadsheet
+                             "name": team["name"] + str(i),
+                             "cups": team["cups"],
+                             "match against": "N/A",
+                             "cup change": str(rng.randint(-60, 60)) if changed else "N/A",
+                             "timestamp prior": sweep_times[-3],
+                             "timestamp checked": sweep_times[-2],
+                             "timestamp changed": rng.choice(sweep_times[:-1]) if changed else "N/A"})
+    return teamEndTimes
+
+
+def make_sweep(teamEndTimes, rng):
+    """Make up a sweep of the teams in a spreadsheet, with most teams still on the leaderboard and a few cups changed."""
+    team_list = []
+    for team in teamEndTimes:
+        # A few teams have dropped off the leaderboard and a few new ones have joined
+        if rng.random() < 0.05:
+            team_list.append({"position": team["position"], "name": make_name(rng), "cups": team["cups"]})
+        else:
+            cups = int(team["cups"]) + (rng.randint(-60, 60) if rng.random() < 0.2 else 0)
+            team_list.append({"position": team["position"], "name": team["name"], "cups": str(cups)})
+    return team_list
+
+
+def make_ocr_text(size, rng):
+    """Make up the text Tesseract reads from a column of team names, with blank lines between some rows."""
+    return "".join(make_name(rng) + ("\n\n" if rng.random() < 0.5 else "\n") for _ in range(size))
+
+
+def make_table_data(size, rng):
+    """Make up the rows of a query's output table, the same as the query bot passes to generate_out."""
+    return [[str(position), make_name(rng), str(rng.randint(-60, 60)),
+             "¦".join(make_name(rng) for _ in range(rng.randint(0, 2))) or "-",
+             "20:00", "22:00", "Europe/London"] for position in range(1, size + 1)]
+
+
+def make_date_strings(size, rng):
+    """Make up a mix of the timestamps users give to !time and the ones stored in the spreadsheet."""
+    return [rng.choice([f"{rng.randrange(24):02}:{rng.randrange(60):02}", rng.choice(sweep_times), "N/A"])
+            for _ in range(size)]
+
+
+def parse_dates(parse_func, texts, tz):
+    """Parse every timestamp in a list with a try_parsing_date function."""
+    for text in texts:
+        parse_func(text, tz)
+
+
+def sweep_args(size, rng):
+    """Make up a spreadsheet and a new sweep of its teams, with the timestamp of the sweep."""
+    teamEndTimes = make_team_end_times(size, rng)
+    return (make_sweep(teamEndTimes, rng), teamEndTimes, sweep_times[-1])
+
+
+def correction_args(size, rng):
+    """Make up a spreadsheet with a misread team name, and the correction for it to an existing team's name."""
+    teamEndTimes = make_team_end_times(size, rng)
+    wrong = copy.copy(rng.choice(teamEndTimes))
+    correct_name = wrong["name"]
+    wrong["name"] = correct_name + "I"
+    wrong["timestamp checked"] = sweep_times[-1]
+    teamEndTimes.append(wrong)
+    return (teamEndTimes, wrong["name"], correct_name, "exact")
+
+
+# Every benchmark by name, with the function being timed and a function making up its arguments for a size.
+# The arguments are made up before timing and a fresh copy is used for every call, since most of these functions
+# change the lists they're given.
+benchmarks = {
+    "remove_extra_newline": (SSReaderBot.remove_extra_newline,
+                             lambda size, rng: (make_ocr_text(size, rng),)),
+    "fixDupTeamNames": (SSReaderBot.fixDupTeamNames,
+                        lambda size, rng: (make_team_list(size, rng),)),
+    "find_inconsecutive_in_dict_list": (SSReaderBot.find_inconsecutive_in_dict_list,
+                                        lambda size, rng: (make_team_list(size, rng, out_of_order_rate=0.01),
+                                                           "position", False)),
+    "update_spreadsheet": (SSReaderBot.update_spreadsheet, sweep_args),
+    "update_spreadsheet_with_correction": (SSQueryBot.update_spreadsheet_with_correction, correction_args),
+    "generate_out": (SSQueryBot.generate_out,
+                     lambda size, rng: (make_table_data(size, rng),)),
+    "try_parsing_date": (parse_dates,
+                         lambda size, rng: (SSQueryBot.try_parsing_date, make_date_strings(size, rng),
+                                            pytz.timezone("Europe/London"))),
+}
+
+
+def time_calls(func, args, number):
+    """Time calling a function a number of times, each with a fresh copy of the arguments. Return seconds per call."""
+    copies = [copy.deepcopy(args) for _ in range(number)]
+    start = perf_counter()
+    for call_args in copies:
+        func(*call_args)
+    return (perf_counter() - start) / number
+
+
+def run_benchmark(func, make_args, size, single_call=False):
+    """Time a function on a made up table of the given size. Return the median seconds per call, or the time of one
+    call if single_call is set, for sizes that are too slow to time several calls of."""
+    args = make_args(size, random.Random(size))
+    # Time a single call first to work out how many calls make a measurement long enough to be accurate
+    single = time_calls(func, args, 1)
+    if single_call:
+        return single
+    number = max(1, min(1000, int(min_measure_time / max(single, 1e-9))))
+    timings = sorted(time_calls(func, args, number) for _ in range(repeats))
+    return timings[len(timings) // 2]
+
+
+def expected_time(timings, size):
+    """Work out how long a call at a larger size will take from the timings at the sizes run so far."""
+    last_size, last_seconds = timings[-1]
+    # Use how quickly the time grew between the last two sizes, somewhere between linear and the square of the size.
+    # The square is assumed after only one size, to be safe.
+    growth = 2.0
+    if len(timings) > 1 and timings[-2][1] > 0:
+        growth = math.log(last_seconds / timings[-2][1]) / math.log(last_size / timings[-2][0])
+        growth = min(2.0, max(1.0, growth))
+    return last_seconds * (size / last_size) ** growth
+
+
+def load_baselines(path):
+    """Get the saved baseline timings by benchmark name and size, or an empty dictionary if none have been saved."""
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as baseline_file:
+        return json.load(baseline_file)
+
+
+def main():
+    """Run the benchmarks, compare them with the baselines and optionally save them as the new baselines."""
+    parser = argparse.ArgumentParser(description="Benchmark the OCR clean up and spreadsheet processing functions.")
+    parser.add_argument("--baselines", default="benchmark_baselines.json", help="file the baseline timings are kept in")
+    parser.add_argument("--save", action="store_true", help="save this run's timings as the new baselines")
+    parser.add_argument("--max-ratio", type=float, default=1.5,
+                        help="fail if a timing is more than this many times the baseline (default 1.5)")
+    parser.add_argument("--only", action="append", choices=list(benchmarks), help="only run this benchmark")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in default_sizes),
+                        help="comma separated table sizes to run")
+    parser.add_argument("--time-limit", type=float, default=5.0,
+                        help="skip larger sizes without a baseline once a call is expected to take longer than "
+                             "this many seconds, sizes with a baseline are timed with one call instead")
+    args = parser.parse_args()
+    baselines_path = os.path.join(launch_dir, args.baselines)
+    sizes = sorted(int(size) for size in args.sizes.split(","))
+
+    baselines = load_baselines(baselines_path)
+    regressions = []
+    print(f"{'benchmark':<36}{'size':>8}{'per call':>12}{'baseline':>12}{'ratio':>8}")
+    for name in args.only or benchmarks:
+        func, make_args = benchmarks[name]
+        timings = []
+        for size in sizes:
+            baseline = baselines.get(name, {}).get(str(size))
+            slow = len(timings) > 0 and expected_time(timings, size) > args.time_limit
+            # Skip sizes that would take too long, so a slow function doesn't hold up the whole run. Sizes with a
+            # baseline are still timed with a single call, otherwise a slowdown would only push them past the limit
+            # and never be compared with their baseline.
+            if slow and baseline is None:
+                print(f"{name:<36}{size:>8}  skipped, expected to take over {args.time_limit}s")
+                continue
+            seconds = run_benchmark(func, make_args, size, single_call=slow)
+            timings.append((size, seconds))
+            row = f"{name:<36}{size:>8}{seconds * 1000:>10.3f}ms"
+            if baseline is not None:
+                ratio = seconds / baseline
+                row += f"{baseline * 1000:>10.3f}ms{ratio:>8.2f}"
+                if ratio > args.max_ratio:
+                    row += "  REGRESSED"
+                    regressions.append(f"{name} at {size} teams")
+            if slow:
+                row += "  (1 call)"
+            print(row)
+            if args.save:
+                baselines.setdefault(name, {})[str(size)] = seconds
+
+    if args.save:
+        with open(baselines_path, mode='w', encoding="utf-8") as baseline_file:
+            json.dump(baselines, baseline_file, indent=1, sort_keys=True)
+        print(f"Saved the timings as the baselines in {args.baselines}.")
+    if len(regressions) > 0:
+        print(f"{len(regressions)} benchmarks took over {args.max_ratio}x their baseline time: "
+              + ", ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+Column detector check for HCR2.
+
+Checks that the projection profile column detector finds the same column boxes as the dilation based detector it
+replaced, and times both. Runs on a folder of real screenshots, on made up leaderboard images, or both, and fails if
+any image gives different boxes.
+
+Usage: python column_check.py [--screenshots folder] [--generate count] [--seed seed]
+"""
+
+import os
+import sys
+import random
+import argparse
+from time import perf_counter
+
+# Folders given on the command line are relative to where it was run from
+launch_dir = os.getcwd()
+
+import cv2
+import numpy as np
+
+from column_detector import find_column_boxes, find_column_bands, position_merge_radius
+from screenshot_precheck import top_trim_ratio, binary_threshold
+
+# Screenshot file types that are read, anything else in the folder is ignored
+image_extensions = (".png", ".jpg", ".jpeg")
+
+
+def binarise_screenshot(imgcv):
+    """Trim and binarise a screenshot the same way the reader bot does before finding its columns."""
+    height = imgcv.shape[0]
+    imgcv = imgcv[int(top_trim_ratio * height):]
+    gray = cv2.cvtColor(cv2.bitwise_not(imgcv), cv2.COLOR_BGR2GRAY)
+    _, binary = cv2.threshold(gray, binary_threshold, 255, cv2.THRESH_BINARY)
+    return binary
+
+
+def dilation_columns(binary):
+    """Find the column boxes and the positions column's bounds the way the reader bot did before the column detector.
+    Return (boxes from right to left, (left, right) of the position numbers or None)."""
+    height = binary.shape[0]
+    inverted = cv2.bitwise_not(binary)
+    kernel = np.ones((5, 5), np.uint8)
+    dilated = cv2.dilate(inverted, kernel, iterations=10)
+    # Columns whose rows merge into something at least 90% of the image height are the leaderboard's columns
+    vertical_row_mix_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, ksize=(1, int(height / 8)))
+    colCheckContours, _ = cv2.findContours(cv2.dilate(dilated, vertical_row_mix_kernel),
+                                           cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    colMidPts = []
+    for col in colCheckContours:
+        x, y, w, h = cv2.boundingRect(col)
+        if h > (0.9 * height):
+            colMidPts.append((x + x + w) / 2)
+    vertical_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, ksize=(1, 2 * height))
+    contours, _ = cv2.findContours(cv2.dilate(dilated, vertical_kernel), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    boxes = []
+    for cnt in contours:
+        x, y, w, h = cv2.boundingRect(cnt)
+        if any(x < Pt < x + w for Pt in colMidPts):
+            boxes.append((x, y, w, h))
+    positions = None
+    if len(boxes) >= 4:
+        x, y, w, h = boxes[3]
+        posDilated = cv2.dilate(cv2.dilate(cv2.bitwise_not(binary[y:y+h, x:x+w]), kernel), vertical_kernel)
+        posContours, _ = cv2.findContours(posDilated, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+        x, _, w, _ = cv2.boundingRect(posContours[0])
+        positions = (x, x + w)
+    return boxes, positions
+
+
+def profile_columns(binary):
+    """Find the column boxes and the positions column's bounds with the column detector, the same as dilation_columns."""
+    boxes = find_column_boxes(binary)
+    positions = None
+    if len(boxes) >= 4:
+        x, y, w, h = boxes[3]
+        positions = find_column_bands(binary[y:y+h, x:x+w], position_merge_radius)[-1]
+    return boxes, positions
+
+
+def make_leaderboard(rng):
+    """Draw a made up binarised leaderboard at a random size, with positions, badges, names, cup icons and cups."""
+    width = rng.randint(900, 2400)
+    height = int(width * rng.uniform(0.4, 0.7))
+    img = np.full((height, width), 255, np.uint8)
+    scale = width / 1600
+    thickness = max(1, int(2 * scale))
+    row_height = height / 9.3
+    for row in range(rng.randint(6, 9)):
+        bottom = int((row + 0.8) * row_height)
+        name = "".join(rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefgh ") for _ in range(rng.randint(3, 13)))
+        cv2.putText(img, str(rng.randint(1, 500)), (int(60 * scale), bottom), cv2.FONT_HERSHEY_SIMPLEX,
+                    1.1 * scale, 0, thickness)
+        cv2.rectangle(img, (int(200 * scale), bottom - int(35 * scale)), (int(250 * scale), bottom + int(5 * scale)), 0, -1)
+        cv2.putText(img, name, (int(320 * scale), bottom), cv2.FONT_HERSHEY_SIMPLEX, 1.1 * scale, 0, thickness)
+        cv2.circle(img, (int(1200 * scale), bottom - int(15 * scale)), int(18 * scale), 0, -1)
+        cv2.putText(img, str(rng.randint(100, 9999)), (int(1300 * scale), bottom), cv2.FONT_HERSHEY_SIMPLEX,
+                    1.1 * scale, 0, thickness)
+    # Sometimes add a speck of noise, or a strip down the edge like a scroll bar
+    if rng.random() < 0.5:
+        x, y = rng.randrange(width - 5), rng.randrange(height - 5)
+        img[y:y+4, x:x+4] = 0
+    if rng.random() < 0.3:
+        img[:, -3:] = 0
+    # The text is drawn with grey edges, so binarise it again like a real screenshot
+    _, img = cv2.threshold(img, 127, 255, cv2.THRESH_BINARY)
+    return img
+
+
+def compare(label, binary, totals):
+    """Find the columns of one binarised image with both detectors, adding their times to totals.
+    Return True if they found the same boxes."""
+    start = perf_counter()
+    expected = dilation_columns(binary)
+    totals["dilation"] += perf_counter() - start
+    start = perf_counter()
+    found = profile_columns(binary)
+    totals["profile"] += perf_counter() - start
+    if expected != found:
+        print(f"{label}: dilation found {expected}, profile found {found}")
+        return False
+    return True
+
+
+def main():
+    """Compare the column detectors on the screenshots and made up images given on the command line."""
+    parser = argparse.ArgumentParser(description="Check the column detector finds the same columns as the old dilation.")
+    parser.add_argument("--screenshots", help="folder of leaderboard screenshots to check")
+    parser.add_argument("--generate", type=int, default=0, help="number of made up leaderboard images to check")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the made up images, so a run can be repeated")
+    args = parser.parse_args()
+    if args.screenshots is None and args.generate == 0:
+        parser.error("Give a --screenshots folder, a --generate count or both.")
+
+    images = 0
+    differences = 0
+    totals = {"dilation": 0.0, "profile": 0.0}
+    if args.screenshots is not None:
+        folder = os.path.join(launch_dir, args.screenshots)
+        for root, _, file_names in os.walk(folder):
+            for file_name in sorted(file_names):
+                if not file_name.lower().endswith(image_extensions):
+                    continue
+                img = cv2.imread(os.path.join(root, file_name))
+                if img is None:
+                    print(f"Could not open {file_name}.")
+                    continue
+                images += 1
+                differences += not compare(os.path.relpath(os.path.join(root, file_name), folder),
+                                           binarise_screenshot(img), totals)
+    rng = random.Random(args.seed)
+    for i in range(args.generate):
+        images += 1
+        differences += not compare(f"Generated image {i} (seed {args.seed})", make_leaderboard(rng), totals)
+
+    print(f"{images - differences}/{images} images gave the same columns. Per image: dilation "
+          f"{totals['dilation'] / max(images, 1) * 1000:.1f}ms, profile {totals['profile'] / max(images, 1) * 1000:.1f}ms.")
+    if differences > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
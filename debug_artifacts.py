@@ -0,0 +1,144 @@
+"""
+Debug images for HCR2.
+
+Saves the images made while reading a screenshot (the screenshot itself and the cropped columns) so problems with
+reading can be looked into afterwards. It's off by default, and can be set to save every screenshot, a random sample
+of them or only the ones that couldn't be read. Images are written by a background thread so reading isn't slowed
+down, each screenshot's images are named after its sweep and number so they're never overwritten by another
+screenshot, and the oldest images are deleted once they take up more than the allowed space.
+"""
+
+import os
+import queue
+import random
+import itertools
+import threading
+from datetime import datetime
+
+import cv2
+
+# Folder the debug images are saved in, with a folder for each sweep
+debugArtifactsPath = "debug_artifacts"
+# Which screenshots have their images saved: off, failures, sample or all
+artifact_modes = ("off", "failures", "sample", "all")
+artifact_mode = "off"
+# Fraction of screenshots that have their images saved in sample mode
+sample_rate = 0.1
+# Most space the saved images can take up before the oldest are deleted, in bytes
+max_artifact_bytes = 100 * 1024 * 1024
+# Most screenshots waiting to have their images written, any more are dropped rather than slowing down reading
+max_queued_captures = 64
+
+# Screenshots waiting for their images to be written
+_write_queue = queue.Queue(maxsize=max_queued_captures)
+# The background thread writing the images, started when the first images are queued
+_writer = None
+_writer_lock = threading.Lock()
+# Numbers for screenshots that weren't given a name
+_capture_numbers = itertools.count(1)
+
+
+def configure(mode, rate, max_bytes):
+    """Set which screenshots have their images saved, the fraction sampled and the most space the images can take up."""
+    global artifact_mode, sample_rate, max_artifact_bytes
+    if mode not in artifact_modes:
+        raise Exception(f"Debug artifact mode must be one of {', '.join(artifact_modes)}, not {mode}.")
+    artifact_mode = mode
+    sample_rate = rate
+    max_artifact_bytes = max_bytes
+
+
+def start_capture(name=None):
+    """Start collecting the images for a screenshot, named like sweep/screenshot. Return None if images are off,
+    so nothing is collected."""
+    if artifact_mode == "off":
+        return None
+    if name is None:
+        name = f"unnamed/{datetime.utcnow():%Y-%m-%dT%H-%M-%S}_{os.getpid()}_{next(_capture_numbers)}"
+    # Whether the screenshot is sampled is decided now, but it's only saved once it's known whether it failed
+    sampled = artifact_mode == "all" or (artifact_mode == "sample" and random.random() < sample_rate)
+    return {"name": name, "sampled": sampled, "images": []}
+
+
+def add(capture, part, img):
+    """Add an image to a screenshot's capture. The image is kept as it is, so it mustn't be changed afterwards."""
+    if capture is not None and img is not None:
+        capture["images"].append((part, img))
+
+
+def finish(capture, failed):
+    """Queue a screenshot's images to be written if it was sampled, or if it failed and failures are being saved."""
+    if capture is None or len(capture["images"]) == 0:
+        return
+    if not capture["sampled"] and not (failed and artifact_mode == "failures"):
+        return
+    start_writer()
+    try:
+        _write_queue.put_nowait(capture)
+    except queue.Full:
+        print(f"Dropped the debug images for {capture['name']}, too many are waiting to be written.")
+
+
+def list_artifacts():
+    """Get every saved image as a list of (modified time, path, size), oldest first."""
+    artifacts = []
+    for folder, _, file_names in os.walk(debugArtifactsPath):
+        for file_name in file_names:
+            path = os.path.join(folder, file_name)
+            stat = os.stat(path)
+            artifacts.append((stat.st_mtime_ns, path, stat.st_size))
+    artifacts.sort()
+    return artifacts
+
+
+def delete_oldest(artifacts, total_bytes):
+    """Delete the oldest images until they take up no more than the allowed space. Return the space left in use."""
+    while total_bytes > max_artifact_bytes and len(artifacts) > 0:
+        _, path, size = artifacts.pop(0)
+        try:
+            os.remove(path)
+            # Remove the sweep's folder once all of its images are gone
+            if len(os.listdir(os.path.dirname(path))) == 0:
+                os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+        total_bytes -= size
+    return total_bytes
+
+
+def write_artifacts():
+    """Write the queued screenshots' images as PNG files, forever. Runs on the background thread."""
+    # The images already saved count towards the space allowed, oldest first so they're deleted first
+    artifacts = list_artifacts()
+    total_bytes = sum(size for _, _, size in artifacts)
+    while True:
+        capture = _write_queue.get()
+        try:
+            for part, img in capture["images"]:
+                path = os.path.join(debugArtifactsPath, f"{capture['name']}_{part}.png")
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if cv2.imwrite(path, img):
+                    size = os.path.getsize(path)
+                    artifacts.append((os.stat(path).st_mtime_ns, path, size))
+                    total_bytes += size
+            total_bytes = delete_oldest(artifacts, total_bytes)
+        except Exception as e:
+            print(f"Could not write the debug images for {capture['name']}: {e}")
+        finally:
+            _write_queue.task_done()
+
+
+def start_writer():
+    """Start the background thread writing the images, unless it's already running."""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            # A daemon thread doesn't stop the bot from closing
+            _writer = threading.Thread(target=write_artifacts, name="debug artifact writer", daemon=True)
+            _writer.start()
+
+
+def flush():
+    """Wait until every queued image has been written, for processes that are about to finish."""
+    if _writer is not None:
+        _write_queue.join()
@@ -0,0 +1,161 @@
+"""
+Digit recogniser check for HCR2.
+
+Compares the digit recogniser with Tesseract on the cups and positions cells in the Training folder, which were
+cropped from real leaderboard screenshots, reading every cell both ways and timing them. The recogniser's templates
+come from those same cells, so the cells are split into folds and each fold is read with templates made from the
+other folds only. Shows how accurate and how quick reading is when cells under each confidence are passed on to
+Tesseract, the same way the reader bot does, so digit_recogniser.min_confidence can be chosen.
+
+Usage: python digit_check.py [--folds count] [--tessdata folder] [--lang languages]
+"""
+
+import re
+import sys
+import argparse
+from time import perf_counter
+
+import numpy as np
+from PIL import Image, ImageSequence
+
+import SSReaderBot
+import ocr_backend
+import digit_recogniser
+from row_segmenter import find_row_bands
+
+# Confidences tried as min_confidence
+confidence_steps = range(40, 100, 5)
+
+
+def load_cells():
+    """Load every training page holding only digits as a binarised cell cropped to its row, the way the reader bot
+    crops them. Return a list of (page number, cell image, text it should be read as, whether it's a position)."""
+    labels = {}
+    with open(digit_recogniser.trainingBoxPath, encoding="utf-8") as boxfile:
+        for line in boxfile:
+            fields = line.split()
+            if len(fields) == 6:
+                labels[int(fields[5])] = labels.get(int(fields[5]), "") + fields[0]
+    cells = []
+    with Image.open(digit_recogniser.trainingImagePath) as tif:
+        for page_number, page in enumerate(ImageSequence.Iterator(tif)):
+            label = labels.get(page_number, "")
+            # Pages with letters on them are team names, which the recogniser doesn't read
+            if label == "" or any(char not in "0123456789." for char in label):
+                continue
+            cell = np.where(np.array(page.convert("L")) < 128, 0, 255).astype(np.uint8)
+            rows = find_row_bands(cell)
+            if len(rows) == 0:
+                continue
+            # Positions end in a dot, which the reader bot removes
+            cells.append((page_number, cell[rows[0][0]:rows[-1][1]], label.replace(".", ""), "." in label))
+    return cells
+
+
+def read_with_tesseract(cell, config):
+    """Read a cell with Tesseract the way the reader bot read it before the recogniser, retrying it upscaled if it
+    wasn't read confidently. Return the text of both attempts, their confidences and times, and the final text."""
+    start = perf_counter()
+    text, confidence = SSReaderBot.ocr_cell(cell, config)
+    plain_time = perf_counter() - start
+    start = perf_counter()
+    upscaled_text, upscaled_confidence = SSReaderBot.ocr_cell(SSReaderBot.upscale_cell(cell), config)
+    upscaled_time = perf_counter() - start
+    final_text, final_time = text, plain_time
+    if confidence < SSReaderBot.min_ocr_confidence:
+        final_time += upscaled_time
+        if upscaled_confidence > confidence:
+            final_text = upscaled_text
+    return {"text": clean_text(final_text), "time": final_time,
+            "upscaled text": clean_text(upscaled_text), "upscaled confidence": upscaled_confidence,
+            "upscaled time": upscaled_time}
+
+
+def clean_text(text):
+    """Remove the characters the reader bot removes from what's read from a digit cell."""
+    return SSReaderBot.remove_dotNcomma(SSReaderBot.remove_space(text))
+
+
+def main():
+    """Read the training cells with the recogniser and Tesseract and compare them."""
+    parser = argparse.ArgumentParser(description="Compare the digit recogniser with Tesseract on the training cells.")
+    parser.add_argument("--folds", type=int, default=5, help="number of folds the cells are split into (default 5)")
+    parser.add_argument("--tessdata", help="folder holding HCR2.traineddata, if not the one next to tesseract.exe")
+    parser.add_argument("--lang", help="Tesseract languages to use instead of the reader bot's, like HCR2")
+    args = parser.parse_args()
+    if args.tessdata is not None:
+        ocr_backend.configure(args.tessdata)
+    configs = {True: SSReaderBot.positions_ocr_config, False: SSReaderBot.cups_ocr_config}
+    if args.lang is not None:
+        configs = {position: re.sub(r"-l \S+", "-l " + args.lang, config) for position, config in configs.items()}
+
+    cells = load_cells()
+    samples, labels, sample_pages = digit_recogniser.read_glyph_samples()
+    positions = sum(1 for cell in cells if cell[3])
+    print(f"{len(cells)} cells ({positions} positions, {len(cells) - positions} cups), read with {args.folds} folds "
+          f"and Tesseract through {ocr_backend.backend_name()}.")
+
+    results = []
+    for fold in range(args.folds):
+        # Templates from every page outside of this fold
+        fold_templates = digit_recogniser.build_glyph_templates(
+            [sample for sample, page in zip(samples, sample_pages) if page % args.folds != fold],
+            [label for label, page in zip(labels, sample_pages) if page % args.folds != fold])
+        for page_number, cell, expected, position in cells:
+            if page_number % args.folds != fold:
+                continue
+            start = perf_counter()
+            text, confidence = digit_recogniser.recognise_row(cell < 128, fold_templates)
+            recogniser_time = perf_counter() - start
+            result = read_with_tesseract(cell, configs[position])
+            result.update({"expected": expected, "recogniser text": text, "confidence": confidence,
+                           "recogniser time": recogniser_time})
+            results.append(result)
+
+    count = len(results)
+    tesseract_correct = sum(result["text"] == result["expected"] for result in results)
+    tesseract_time = sum(result["time"] for result in results) / count * 1000
+    recogniser_correct = sum(result["recogniser text"] == result["expected"] for result in results)
+    recogniser_time = sum(result["recogniser time"] for result in results) / count * 1000
+    print(f"Tesseract:  {tesseract_correct}/{count} correct ({tesseract_correct / count:.1%}), "
+          f"{tesseract_time:.2f}ms per cell.")
+    print(f"Recogniser: {recogniser_correct}/{count} correct ({recogniser_correct / count:.1%}), "
+          f"{recogniser_time:.2f}ms per cell.")
+    # Cells the recogniser reads with less confidence than its least confident correct reading are best passed on
+    correct_confidences = [result["confidence"] for result in results if result["recogniser text"] == result["expected"]]
+    print(f"Least confident correct recogniser reading: {min(correct_confidences, default=0.0):.1f}%.")
+    for result in results:
+        if result["text"] != result["expected"] or result["recogniser text"] != result["expected"]:
+            print(f"  {result['expected']}: Tesseract read {result['text'] or '(nothing)'}, recogniser read "
+                  f"{result['recogniser text'] or '(nothing)'} with {result['confidence']:.0f}% confidence")
+
+    print("Recogniser with Tesseract for cells under each confidence (* is min_confidence):")
+    print("  confidence  by recogniser  correct          ms per cell")
+    current_correct = 0
+    for min_confidence in confidence_steps:
+        correct = 0
+        total_time = 0.0
+        by_recogniser = 0
+        for result in results:
+            text = result["recogniser text"]
+            total_time += result["recogniser time"]
+            # The same as read_digit_cell, Tesseract's upscaled reading is only used if it's more confident
+            if result["confidence"] < min_confidence:
+                total_time += result["upscaled time"]
+                if result["upscaled confidence"] > result["confidence"]:
+                    text = result["upscaled text"]
+            else:
+                by_recogniser += 1
+            correct += text == result["expected"]
+        marker = "*" if min_confidence == digit_recogniser.min_confidence else " "
+        print(f"  {min_confidence:>9}{marker}  {by_recogniser / count:>13.1%}  {correct:>4}/{count} ({correct / count:.1%})"
+              f"  {total_time / count * 1000:>8.2f}")
+        if min_confidence == digit_recogniser.min_confidence:
+            current_correct = correct
+    # Fail if the recogniser at the current confidence reads fewer cells correctly than Tesseract on its own
+    if current_correct < tesseract_correct:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Digit recogniser for HCR2.
+
+Reads the cups and positions columns of the leaderboard screenshots using the HCR2 font glyph
+samples in the Training folder, so that Tesseract is only needed when the recogniser isn't confident.
+"""
+
+import numpy as np
+import cv2
+
+from PIL import Image, ImageSequence
+
+from row_segmenter import find_bands
+
+# Change the training data file locations here if necessary
+trainingImagePath = "Training/num.font.exp0.tif"
+trainingBoxPath = "Training/num.font.exp0.box"
+
+# Characters the recogniser is able to read
+digit_chars = "0123456789"
+# Every glyph is scaled to this height (keeping its aspect ratio) and padded to this width before comparing
+glyph_height = 28
+glyph_width = 24
+# Lowest correlation score (as a percentage, the same scale Tesseract uses) for a row to be trusted,
+# anything under this makes the row fall back to Tesseract (80 is just under the least confident correct reading
+# in digit_check.py, as every wrong reading there was over 95 the threshold only catches cells it can't read)
+min_confidence = 80
+# Samples correlating at least this well with a template already kept for their digit are left out, since they
+# add nothing but time to every row (0.98 halves the templates without reading any training cell differently)
+max_template_correlation = 0.98
+# Glyphs shorter than this fraction of the row height are dots or noise rather than digits
+min_glyph_height_ratio = 0.5
+
+# The glyph templates are only loaded once, the first time they are needed
+_glyph_templates = None
+
+
+def normalise_glyph(glyph):
+    """Take a boolean array of a single glyph's ink and return it as a flat, zero mean, unit length vector."""
+    # Trim the glyph to the bounds of its ink
+    rows = np.flatnonzero(glyph.any(axis=1))
+    cols = np.flatnonzero(glyph.any(axis=0))
+    glyph = glyph[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1]
+    # Scale to the glyph height while keeping the aspect ratio so narrow digits like 1 stay narrow
+    height, width = glyph.shape
+    new_width = min(glyph_width, max(1, int(round(width * glyph_height / height))))
+    scaled = cv2.resize(glyph.astype(np.float32), (new_width, glyph_height), interpolation=cv2.INTER_AREA)
+    # Centre the scaled glyph in a box of the fixed template size
+    box = np.zeros((glyph_height, glyph_width), dtype=np.float32)
+    left = (glyph_width - new_width) // 2
+    box[:, left:left + new_width] = scaled
+    # Zero mean and unit length so a dot product between two glyphs gives their correlation
+    vector = box.ravel()
+    vector -= vector.mean()
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector /= norm
+    return vector
+
+
+def read_glyph_samples():
+    """Read every digit sample from the training image and box files.
+    Return their glyph vectors, their digits and the page of the training image each one came from."""
+    # Each page of the training tif is a separate image the box file refers to by page number
+    with Image.open(trainingImagePath) as tif:
+        pages = [np.array(page.convert("L")) for page in ImageSequence.Iterator(tif)]
+
+    samples = []
+    labels = []
+    sample_pages = []
+    with open(trainingBoxPath, encoding="utf-8") as boxfile:
+        for line in boxfile:
+            fields = line.split()
+            # Only digits are used as templates, any other character in the training data is skipped
+            if len(fields) != 6 or fields[0] not in digit_chars:
+                continue
+            left, bottom, right, top, page = (int(field) for field in fields[1:])
+            # Box files measure y from the bottom of the page, so flip it to get array rows
+            page_height = pages[page].shape[0]
+            glyph = pages[page][page_height - top:page_height - bottom, left:right] < 128
+            if glyph.any():
+                samples.append(normalise_glyph(glyph))
+                labels.append(fields[0])
+                sample_pages.append(page)
+    return samples, labels, sample_pages
+
+
+def build_glyph_templates(samples, labels):
+    """Group glyph samples into a template matrix by digit, one template per column. Return the templates, the digits
+    and the index of each digit's first template."""
+    kept = {}
+    for sample, label in zip(samples, labels):
+        digit_templates = kept.setdefault(label, [])
+        # Skip samples that are all but the same as one of the digit's templates
+        if len(digit_templates) == 0 or (np.array(digit_templates) @ sample).max() < max_template_correlation:
+            digit_templates.append(sample)
+    # Group the templates by digit so the best score for each digit can be found with a single reduction
+    template_labels = np.array(sorted(kept))
+    template_starts = np.cumsum([0] + [len(kept[label]) for label in template_labels[:-1]])
+    # Stored with a template in each column, as multiplying by a transposed view is a few times slower
+    templates = np.ascontiguousarray(np.array([sample for label in template_labels for sample in kept[label]],
+                                              dtype=np.float32).T)
+    return templates, template_labels, template_starts
+
+
+def load_glyph_templates():
+    """Load every digit sample from the training image and box files into a template matrix, grouped by digit."""
+    global _glyph_templates
+    if _glyph_templates is None:
+        samples, labels, _ = read_glyph_samples()
+        _glyph_templates = build_glyph_templates(samples, labels)
+    return _glyph_templates
+
+
+def recognise_row(ink, glyph_templates=None):
+    """Read the digits from a boolean array of a single row's ink, returning the text and its lowest confidence.
+    The templates loaded from the training data are used unless others are given."""
+    if glyph_templates is None:
+        glyph_templates = load_glyph_templates()
+    templates, template_labels, template_starts = glyph_templates
+    row_height = ink.shape[0]
+
+    glyphs = []
+    for left, right in find_bands(ink.sum(axis=0)):
+        glyph = ink[:, left:right]
+        rows = np.flatnonzero(glyph.any(axis=1))
+        # Skip the dots after position numbers and any specks left over from binarisation
+        if rows[-1] - rows[0] + 1 < min_glyph_height_ratio * row_height:
+            continue
+        glyphs.append(normalise_glyph(glyph))
+
+    if len(glyphs) == 0:
+        return "", 0.0
+
+    # Correlate every glyph in the row against every template at once and keep the best score for each digit
+    scores = np.array(glyphs) @ templates
+    digit_scores = np.maximum.reduceat(scores, template_starts, axis=1)
+    best = digit_scores.argmax(axis=1)
+    confidence = digit_scores[np.arange(len(glyphs)), best]
+    return "".join(template_labels[best]), float(confidence.min()) * 100
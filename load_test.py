@@ -0,0 +1,363 @@
+"""
+Load test harness for HCR2.
+
+Replays scripted traffic against both bots without connecting to Discord, to see how the query commands hold up while
+a sweep is being processed. Each message in a scenario file is handed straight to the reader bot's on_message or the
+query bot's command handlers at its scheduled time, using fake channels that record when the replies are sent, and
+screenshot attachments are downloaded from a local web server instead of Discord. Everything the bots write goes into
+a temporary folder, so the real spreadsheets are never touched. Reports the throughput, the latency percentiles of
+each command and how long the event loop was blocked for.
+
+Usage: python load_test.py scenario.json [--screenshots folder] [--speed factor]
+       python load_test.py scenario.json --generate --screenshots folder [--users 50] [--queries 10] [--duration 60]
+"""
+
+import os
+import math
+import json
+import random
+import shutil
+import asyncio
+import inspect
+import argparse
+import itertools
+import tempfile
+from time import perf_counter
+from urllib.parse import quote
+
+# Files given on the command line are relative to where it was run from, which importing the bots changes
+launch_dir = os.getcwd()
+
+from aiohttp import web
+
+import SSReaderBot
+import SSQueryBot
+import team_store
+import reader_jobs
+import reader_sessions
+import watch_scheduler
+import message_sender
+import timezone_resolver
+
+# Screenshot file types that are served as attachments
+image_extensions = (".png", ".jpg", ".jpeg")
+# Discord allows this many attachments on one message, so generated uploads are split up into messages of this size
+attachments_per_message = 10
+# How often the event loop is checked for being blocked, and how late a check has to be to count as blocked, in seconds
+loop_check_interval = 0.005
+loop_block_threshold = 0.05
+# How long to wait for a command's reply to be sent before giving up on it, in seconds
+reply_timeout = 60
+# Channel IDs used by generated scenarios, every query user gets a channel of their own after the query channel ID
+reader_channel_id = 1000
+query_channel_id = 2000
+guild_id = 1
+
+# Message IDs given to the fake messages, in the order they're sent
+_message_ids = itertools.count(1)
+
+
+class FakeUser:
+    """Stand-in for a Discord user, only holding what the bots use."""
+
+    def __init__(self, user_id):
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.mention = f"<@{user_id}>"
+
+
+class FakeGuild:
+    """Stand-in for a Discord server."""
+
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+
+class FakeAttachment:
+    """Stand-in for a message attachment, pointing at the local attachment server."""
+
+    def __init__(self, url, filename):
+        self.url = url
+        self.filename = filename
+
+
+class FakeChannel:
+    """Stand-in for a Discord channel that records when each embed sent to it arrives, instead of sending it."""
+
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.messages_sent = 0
+        # Futures for the embeds being waited for by their ID, set when the embed is sent
+        self.waiting = {}
+
+    async def send(self, content=None, embed=None, embeds=None, file=None):
+        """Record a message being sent, with the embeds in it."""
+        self.messages_sent += 1
+        for sent_embed in (embeds or []) + ([embed] if embed is not None else []):
+            future = self.waiting.pop(id(sent_embed), None)
+            if future is not None and not future.done():
+                future.set_result(perf_counter())
+
+    def wait_for_embed(self, embed):
+        """Get a future that's set to the time the embed is sent."""
+        return self.waiting.setdefault(id(embed), asyncio.get_event_loop().create_future())
+
+
+class FakeMessage:
+    """Stand-in for a Discord message."""
+
+    def __init__(self, content, author, channel, guild, attachments):
+        self.id = next(_message_ids)
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = guild
+        self.attachments = attachments
+
+
+class FakeContext:
+    """Stand-in for the context a query command is invoked with."""
+
+    def __init__(self, message, command):
+        self.message = message
+        self.command = command
+        self.author = message.author
+        self.channel = message.channel
+        self.guild = message.guild
+
+    async def send(self, *args, **kwargs):
+        """Send a message straight to the channel, like ctx.send."""
+        await self.channel.send(*args, **kwargs)
+
+
+def percentile(values, pct):
+    """Get a percentile of a list of numbers using the nearest rank, or None if the list is empty."""
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))]
+
+
+def ms_to_string(seconds):
+    """Format a number of seconds as milliseconds for the report, or a dash if there isn't one."""
+    return "-" if seconds is None else f"{seconds * 1000:.0f}ms"
+
+
+def use_temporary_files(folder):
+    """Point every file the bots write at a temporary folder, so a load test can't change the real data."""
+    team_store.partitionsPath = os.path.join(folder, "partitions")
+    team_store.leaderboardChannelsPath = os.path.join(folder, "leaderboard_channels.csv")
+    reader_sessions.sessionJournalPath = os.path.join(folder, "reader_session_journal.csv")
+    watch_scheduler.watchSubscriptionsPath = os.path.join(folder, "watch_subscriptions.csv")
+    # !add_tz changes the shortcuts, so the test gets its own copy of them
+    shutil.copyfile(timezone_resolver.timezoneShortcutsPath, os.path.join(folder, "timezone_shortcuts.csv"))
+    timezone_resolver.timezoneShortcutsPath = os.path.join(folder, "timezone_shortcuts.csv")
+    # Forget the sessions that were loaded from the real journal when the reader bot was imported
+    reader_sessions.open_sessions.clear()
+    reader_sessions.closed_sessions.clear()
+
+
+def generate_scenario(screenshots_folder, users, queries, duration, seed):
+    """Make a scenario of a sweep being uploaded and processed while users send queries at random times."""
+    rng = random.Random(seed)
+    images = sorted(name for name in os.listdir(screenshots_folder) if name.lower().endswith(image_extensions))
+    team_names = [team["name"] for team in team_store.get_team_end_times(team_store.get_partition(guild_id, query_channel_id))]
+    # An empty spreadsheet still gets !team queries, they just won't find anything
+    team_names = team_names or ["Redd|IT"]
+    timezones = ["UTC"] + list(timezone_resolver.get_timezone_shortcuts())
+    events = [{"at": 0.0, "bot": "reader", "channel": reader_channel_id, "user": 1, "content": "!start 20:00 UTC"}]
+    # Upload the screenshots in messages of up to 10, a second apart, then end the sweep straight away
+    for i in range(0, len(images), attachments_per_message):
+        events.append({"at": 1.0 + i // attachments_per_message, "bot": "reader", "channel": reader_channel_id,
+                       "user": 1, "content": "", "attachments": images[i:i + attachments_per_message]})
+    end_time = 2.0 + len(images) // attachments_per_message
+    events.append({"at": end_time, "bot": "reader", "channel": reader_channel_id, "user": 1, "content": "!end"})
+    # Every user sends their queries at random times from the !end onwards, while the sweep is being processed
+    for user in range(users):
+        for _ in range(queries):
+            command = rng.choice(["time", "time", "team", "team", "upcoming"])
+            if command == "time":
+                content = f"!time {rng.randrange(24):02}:{rng.randrange(60):02} {rng.choice(timezones)}"
+            elif command == "team":
+                content = f"!team `{rng.choice(team_names)}` {rng.choice(timezones)}"
+            else:
+                content = f"!upcoming {rng.randrange(1, 7)} {rng.choice(timezones)}"
+            events.append({"at": round(end_time + rng.uniform(0, duration), 3), "bot": "query",
+                           "channel": query_channel_id + user, "user": 100 + user, "content": content})
+    events.sort(key=lambda event: event["at"])
+    return events
+
+
+async def start_attachment_server(folder):
+    """Serve the screenshots in a folder over HTTP for the attachment URLs. Return the server and its base URL."""
+    async def serve_attachment(request):
+        # Only files directly inside the folder are served
+        path = os.path.join(folder, os.path.basename(request.match_info["name"]))
+        if not os.path.isfile(path):
+            return web.Response(status=404)
+        return web.FileResponse(path)
+
+    app = web.Application()
+    app.router.add_get("/attachments/{name}", serve_attachment)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    # Let the computer choose a free port
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}/attachments/"
+
+
+async def watch_event_loop(lags):
+    """Check how late the event loop wakes up from each short sleep, forever. Anything late was blocked by other code."""
+    loop = asyncio.get_event_loop()
+    while True:
+        expected = loop.time() + loop_check_interval
+        await asyncio.sleep(loop_check_interval)
+        lags.append(max(0.0, loop.time() - expected))
+
+
+async def dispatch_query(message):
+    """Run a query command message through the query bot's command handler, the same as the bot would."""
+    name, _, arg = message.content[1:].partition(" ")
+    command = SSQueryBot.bot.get_command(name)
+    if command is None:
+        raise Exception(f"Unknown query command {name}")
+    ctx = FakeContext(message, command)
+    await SSQueryBot.start_command_timer(ctx)
+    try:
+        # Commands without an argument are called without one, the same as the commands framework does
+        if "arg" in inspect.signature(command.callback).parameters and arg:
+            await command.callback(ctx, arg=arg)
+        else:
+            await command.callback(ctx)
+    finally:
+        await SSQueryBot.stop_command_timer(ctx)
+
+
+async def run_event(event, start, speed, channels, attachment_url, results):
+    """Send one scenario message at its time and record how long it took to be handled and replied to."""
+    await asyncio.sleep(max(0.0, start + event["at"] / speed - perf_counter()))
+    channel = channels.setdefault(event["channel"], FakeChannel(event["channel"]))
+    attachments = [FakeAttachment(attachment_url + quote(name), name) for name in event.get("attachments", [])]
+    message = FakeMessage(event["content"], FakeUser(event.get("user", 1)), channel,
+                          FakeGuild(event.get("guild", guild_id)), attachments)
+    # Results are grouped by command, with screenshot uploads grouped together
+    label = event["content"].split(" ")[0] or "upload"
+    result = results.setdefault(label, {"handled": [], "replied": [], "errors": 0})
+
+    sent_at = perf_counter()
+    try:
+        if event["bot"] == "reader":
+            await SSReaderBot.on_message(message)
+        else:
+            await dispatch_query(message)
+    except Exception as e:
+        result["errors"] += 1
+        print(f"{label} failed: {e}")
+        return
+    result["handled"].append(perf_counter() - sent_at)
+
+    # The command's reply has been sent once the last embed waiting in the channel's outbox has been sent,
+    # since the outbox sends embeds in the order they were queued
+    outbox = message_sender._outboxes.get(channel.id)
+    if outbox is not None and len(outbox["embeds"]) > 0:
+        try:
+            replied_at = await asyncio.wait_for(channel.wait_for_embed(outbox["embeds"][-1]), reply_timeout)
+            result["replied"].append(replied_at - sent_at)
+        except asyncio.TimeoutError:
+            result["errors"] += 1
+            print(f"{label} wasn't replied to within {reply_timeout}s.")
+
+
+def print_report(results, elapsed, sweep_time, lags):
+    """Print the throughput, latency percentiles and event loop blocking of a load test."""
+    handled = sum(len(result["handled"]) for result in results.values())
+    print(f"\nHandled {handled} messages in {elapsed:.1f}s, {handled / max(elapsed, 1e-9):.1f} messages/s.")
+    print(f"{'command':<12}{'count':>7}{'errors':>8}{'handled p50':>13}{'p95':>8}{'p99':>8}{'max':>8}"
+          f"{'replied p50':>13}{'p95':>8}{'p99':>8}{'max':>8}")
+    for label, result in sorted(results.items()):
+        row = f"{label:<12}{len(result['handled']):>7}{result['errors']:>8}"
+        for key in ("handled", "replied"):
+            values = result[key]
+            row += f"{ms_to_string(percentile(values, 50)):>13}"
+            row += "".join(f"{ms_to_string(percentile(values, pct)):>8}" for pct in (95, 99))
+            row += f"{ms_to_string(max(values) if values else None):>8}"
+        print(row)
+
+    # Describe how the sweeps went
+    for job in reader_jobs.jobs.values():
+        print(reader_jobs.job_to_string(job))
+    if sweep_time is not None:
+        print(f"Sweeps finished {sweep_time:.1f}s after the last reply.")
+
+    # The event loop was blocked for however long each check woke up late by, when it was late enough to notice
+    blocks = [lag for lag in lags if lag >= loop_block_threshold]
+    print(f"Event loop blocked {len(blocks)} times for {sum(blocks):.2f}s in total "
+          f"({sum(blocks) / max(elapsed, 1e-9):.1%} of the test), longest {ms_to_string(max(lags) if lags else None)}, "
+          f"p99 lateness {ms_to_string(percentile(lags, 99))}.")
+    print(message_sender.stats_to_string())
+
+
+async def run_scenario(events, screenshots_folder, speed):
+    """Replay a scenario against both bots and print a report of how they coped."""
+    reader_jobs.start_workers(SSReaderBot.reader_workers)
+    runner, attachment_url = await start_attachment_server(screenshots_folder)
+    lags = []
+    monitor = asyncio.ensure_future(watch_event_loop(lags))
+    channels = {}
+    results = {}
+
+    start = perf_counter()
+    await asyncio.gather(*(run_event(event, start, speed, channels, attachment_url, results) for event in events))
+    elapsed = perf_counter() - start
+    # Wait for the sweeps started by !end to finish, which can be long after the last message
+    last_reply = perf_counter()
+    await reader_jobs.wait_until_idle()
+    sweep_time = perf_counter() - last_reply if len(reader_jobs.jobs) > 0 else None
+
+    monitor.cancel()
+    await runner.cleanup()
+    print_report(results, elapsed, sweep_time, lags)
+
+
+def main():
+    """Run or generate a load test scenario from the command line."""
+    parser = argparse.ArgumentParser(description="Replay scripted traffic against both bots without Discord.")
+    parser.add_argument("scenario", help="JSON file of the messages to send, each with its time in seconds (at), "
+                                         "bot (reader or query), channel, user, content and attachments")
+    parser.add_argument("--screenshots", default=".", help="folder the attachments are served from")
+    parser.add_argument("--speed", type=float, default=1.0, help="how many times faster than scheduled to send messages")
+    parser.add_argument("--generate", action="store_true",
+                        help="write a scenario of a sweep with queries from many users instead of running one")
+    parser.add_argument("--users", type=int, default=50, help="number of users sending queries in a generated scenario")
+    parser.add_argument("--queries", type=int, default=10, help="number of queries each user sends")
+    parser.add_argument("--duration", type=float, default=60, help="seconds the queries are spread over")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for a generated scenario")
+    args = parser.parse_args()
+    scenario_path = os.path.join(launch_dir, args.scenario)
+    screenshots_folder = os.path.join(launch_dir, args.screenshots)
+
+    with tempfile.TemporaryDirectory() as folder:
+        use_temporary_files(folder)
+        if args.generate:
+            events = generate_scenario(screenshots_folder, args.users, args.queries, args.duration, args.seed)
+            with open(scenario_path, mode='w', encoding="utf-8") as scenario_file:
+                json.dump(events, scenario_file, indent=1)
+            print(f"Wrote {len(events)} messages to {args.scenario}.")
+            return
+        with open(scenario_path, encoding="utf-8") as scenario_file:
+            events = json.load(scenario_file)
+        print(f"Replaying {len(events)} messages at {args.speed}x speed.")
+        # The bots' locks were made on the default event loop when they were imported, so the test runs on it too
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(run_scenario(events, screenshots_folder, args.speed))
+        # Stop the sweep workers and anything else the bots left running
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Outbound message sender for HCR2.
+
+Queues the embeds both bots send and packs the ones going to the same channel into as few messages as possible, up to
+Discord's limit of 10 embeds per message. Sends to each channel are spaced out to stay inside Discord's rate limit for
+that channel, rather than sending as fast as possible and being held back by the rate limit.
+"""
+
+import time
+import asyncio
+from collections import deque
+
+import discord
+
+# Discord's limits on the embeds in one message and the characters in one embed's description
+max_embeds_per_message = 10
+max_message_embed_chars = 6000
+max_description_chars = 4096
+# How long to wait for more embeds to the same channel before sending, so they can go in the same message
+coalesce_delay = 0.25
+# Discord lets a bot send this many messages to a channel in each period of this many seconds
+channel_bucket_size = 5
+channel_bucket_period = 5
+
+# Embeds waiting to be sent to each channel by channel ID, with the channel, the task sending them
+# and the times of the most recent sends
+_outboxes = {}
+# Counters for how many embeds have been sent and how many messages it took
+sender_stats = {"embeds": 0, "messages": 0, "failed": 0}
+
+
+def get_outbox(channel):
+    """Get the outbox for a channel, creating it if it doesn't exist yet."""
+    if channel.id not in _outboxes:
+        _outboxes[channel.id] = {"channel": channel, "embeds": deque(), "task": None, "sent times": deque()}
+    return _outboxes[channel.id]
+
+
+def embed_chars(embed):
+    """Count the characters in an embed that count towards Discord's limit for a message."""
+    return len(embed.title or "") + len(embed.description or "")
+
+
+def take_batch(embeds):
+    """Take as many embeds from the front of the queue as can be sent in one message."""
+    batch = [embeds.popleft()]
+    chars = embed_chars(batch[0])
+    while (len(embeds) > 0 and len(batch) < max_embeds_per_message
+           and chars + embed_chars(embeds[0]) <= max_message_embed_chars):
+        chars += embed_chars(embeds[0])
+        batch.append(embeds.popleft())
+    return batch
+
+
+async def wait_for_bucket(outbox):
+    """Wait until another message can be sent to the channel without going over its rate limit."""
+    sent_times = outbox["sent times"]
+    # Forget sends that are older than the rate limit period
+    while len(sent_times) > 0 and time.monotonic() - sent_times[0] >= channel_bucket_period:
+        sent_times.popleft()
+    # If the channel's limit has been used up, wait until the oldest send is out of the period
+    if len(sent_times) >= channel_bucket_size:
+        await asyncio.sleep(channel_bucket_period - (time.monotonic() - sent_times[0]))
+        sent_times.popleft()
+    sent_times.append(time.monotonic())
+
+
+async def flush_outbox(outbox):
+    """Send every embed queued for a channel, packing as many into each message as possible."""
+    # Give other embeds for this channel a moment to arrive so they can go in the same message
+    await asyncio.sleep(coalesce_delay)
+    while len(outbox["embeds"]) > 0:
+        batch = take_batch(outbox["embeds"])
+        await wait_for_bucket(outbox)
+        try:
+            await outbox["channel"].send(embeds=batch)
+            sender_stats["embeds"] += len(batch)
+            sender_stats["messages"] += 1
+        except discord.HTTPException as e:
+            # Carry on with the rest of the queue, one failed message shouldn't stop the others being sent
+            sender_stats["failed"] += len(batch)
+            print(f"Could not send {len(batch)} embeds to channel {outbox['channel'].id}: {e}")
+    outbox["task"] = None
+
+
+def queue_embed(channel, embed):
+    """Queue an embed to be sent to a channel, starting the channel's sending task if it isn't already running."""
+    outbox = get_outbox(channel)
+    outbox["embeds"].append(embed)
+    if outbox["task"] is None:
+        outbox["task"] = asyncio.ensure_future(flush_outbox(outbox))
+
+
+def queue_summary(channel, heading, lines, color):
+    """Queue a summary of several lines (like the problems found in each screenshot) as few embeds as possible."""
+    description = heading
+    for line in lines:
+        # Start another embed when the description would go over Discord's limit
+        if len(description) + len(line) + 1 > max_description_chars:
+            queue_embed(channel, discord.Embed(description=description, color=color))
+            description = ""
+        description += ("\n" if description else "") + line
+    queue_embed(channel, discord.Embed(description=description, color=color))
+
+
+def stats_to_string():
+    """Describe how many embeds have been sent and how many API calls were saved by packing them together."""
+    return (f"{sender_stats['embeds']} embeds sent in {sender_stats['messages']} messages, "
+            f"saving {sender_stats['embeds'] - sender_stats['messages']} API calls. "
+            f"{sender_stats['failed']} embeds could not be sent.")
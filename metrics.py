@@ -0,0 +1,144 @@
+"""
+Runtime metrics for HCR2.
+
+Collects counters, gauges and timing histograms from both bots and serves them over a local HTTP endpoint in the
+Prometheus text format, so dashboards and alerts can be built on them. The endpoint is off unless a port is set in
+the .env file, and collecting the metrics costs next to nothing when it's off.
+"""
+
+import time
+import asyncio
+import threading
+from contextlib import contextmanager
+
+# Upper bounds of the histogram buckets in seconds, covering everything from a file read to a whole sweep
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# Every metric by name, each holding its type, help text and values by label set
+_metrics = {}
+# Functions called just before the metrics are served, to update gauges that are cheaper to read when needed
+_collectors = []
+# Metrics are updated from executor threads as well as the event loop
+_metrics_lock = threading.Lock()
+# The HTTP server serving the metrics, once it has been started
+_server = None
+
+
+def describe(name, metric_type, help_text):
+    """Register a metric's type (counter, gauge or histogram) and help text."""
+    with _metrics_lock:
+        _metrics.setdefault(name, {"type": metric_type, "help": help_text, "values": {}})
+
+
+def label_key(labels):
+    """Turn a dictionary of labels into a hashable key that keeps them in a consistent order."""
+    return tuple(sorted((labels or {}).items()))
+
+
+def inc(name, labels=None, value=1):
+    """Add to a counter."""
+    with _metrics_lock:
+        values = _metrics[name]["values"]
+        key = label_key(labels)
+        values[key] = values.get(key, 0) + value
+
+
+def set_gauge(name, value, labels=None):
+    """Set a gauge to a value."""
+    with _metrics_lock:
+        _metrics[name]["values"][label_key(labels)] = value
+
+
+def observe(name, seconds, labels=None):
+    """Add a timing to a histogram."""
+    with _metrics_lock:
+        values = _metrics[name]["values"]
+        key = label_key(labels)
+        if key not in values:
+            values[key] = {"buckets": [0] * len(default_buckets), "sum": 0.0, "count": 0}
+        histogram = values[key]
+        for i, bound in enumerate(default_buckets):
+            if seconds <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+
+
+@contextmanager
+def timed(name, labels=None):
+    """Time the code inside a with block and add the timing to a histogram, even if the code raises an exception."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, labels)
+
+
+def register_collector(func):
+    """Add a function to be called just before the metrics are served."""
+    _collectors.append(func)
+
+
+def escape_label_value(value):
+    """Escape a label value so it can go inside quotes in the Prometheus text format."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(key, extra=()):
+    """Format a label key in the Prometheus text format, like {command="time"}."""
+    pairs = list(key) + list(extra)
+    if len(pairs) == 0:
+        return ""
+    # Backslashes, quotes and newlines in label values need escaping
+    return "{" + ",".join(f'{label}="{escape_label_value(value)}"' for label, value in pairs) + "}"
+
+
+def render():
+    """Get every metric in the Prometheus text format."""
+    for func in _collectors:
+        try:
+            func()
+        except Exception as e:
+            print(f"Metrics collector failed: {e}")
+    lines = []
+    with _metrics_lock:
+        for name, metric in _metrics.items():
+            lines.append(f"# HELP {name} {metric['help']}")
+            lines.append(f"# TYPE {name} {metric['type']}")
+            for key, value in metric["values"].items():
+                if metric["type"] == "histogram":
+                    # Prometheus buckets count every timing up to their bound, the same as they're stored
+                    for bound, count in zip(default_buckets, value["buckets"]):
+                        lines.append(f"{name}_bucket{format_labels(key, [('le', bound)])} {count}")
+                    lines.append(f"{name}_bucket{format_labels(key, [('le', '+Inf')])} {value['count']}")
+                    lines.append(f"{name}_sum{format_labels(key)} {value['sum']}")
+                    lines.append(f"{name}_count{format_labels(key)} {value['count']}")
+                else:
+                    lines.append(f"{name}{format_labels(key)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+async def handle_request(reader, writer):
+    """Answer an HTTP request with the metrics, whatever path was asked for."""
+    try:
+        # Read the request up to the end of its headers, nothing in it changes the response
+        await reader.readuntil(b"\r\n\r\n")
+        body = render().encode("utf-8")
+        writer.write(b"HTTP/1.1 200 OK\r\n"
+                     b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                     b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+                     b"Connection: close\r\n\r\n" + body)
+        await writer.drain()
+    except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_server(port, host="127.0.0.1"):
+    """Start serving the metrics on a local port, unless the port is 0 or the server has already been started."""
+    global _server
+    if port == 0 or _server is not None:
+        return
+    _server = await asyncio.start_server(handle_request, host, port)
+    print(f"Serving metrics on http://{host}:{port}/metrics")
@@ -0,0 +1,110 @@
+"""
+OCR backend for HCR2.
+
+Reads a single line of text from a binarised cell image with Tesseract. If tesserocr is installed, Tesseract runs
+inside the bot's process and is handed the cell's raw grayscale pixels from the NumPy array, without converting the
+colours, making a PIL image or encoding an image file for a separate Tesseract process to read. Otherwise (or if
+tesserocr can't load the languages) pytesseract is used, which runs tesseract.exe on a temporary image file for
+each cell like the bot always has.
+"""
+
+import threading
+
+import numpy as np
+
+import pytesseract
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+# Folder holding the Tesseract languages for tesserocr, or None for its default folder
+_tessdata_path = None
+# Set once tesserocr has failed to load, so every cell after that goes straight to pytesseract
+_tesserocr_failed = False
+# Each thread gets its own Tesseract for each config, since one can only read one image at a time
+_thread_apis = threading.local()
+
+
+def configure(tessdata_path):
+    """Set the folder tesserocr loads the Tesseract languages from, or None for its default folder."""
+    global _tessdata_path
+    _tessdata_path = tessdata_path
+
+
+def backend_name():
+    """Get the name of the backend cells are being read with."""
+    return "tesserocr" if tesserocr is not None and not _tesserocr_failed else "pytesseract"
+
+
+def parse_config(config):
+    """Split a Tesseract command line config into its language, page segmentation mode and variables.
+    Return None if it uses anything else, so the cell is read with pytesseract instead."""
+    lang = "eng"
+    psm = None
+    variables = {}
+    parts = config.split()
+    i = 0
+    while i < len(parts) - 1:
+        if parts[i] == "-l":
+            lang = parts[i + 1]
+        elif parts[i] == "--psm":
+            psm = int(parts[i + 1])
+        elif parts[i] == "-c" and "=" in parts[i + 1]:
+            name, value = parts[i + 1].split("=", 1)
+            variables[name] = value
+        else:
+            return None
+        i += 2
+    if i != len(parts):
+        return None
+    return lang, psm, variables
+
+
+def get_api(config):
+    """Get this thread's Tesseract for a config, loading it the first time. Return None if it can't be used."""
+    global _tesserocr_failed
+    if tesserocr is None or _tesserocr_failed:
+        return None
+    apis = getattr(_thread_apis, "apis", None)
+    if apis is None:
+        apis = _thread_apis.apis = {}
+    if config not in apis:
+        parsed = parse_config(config)
+        if parsed is None:
+            apis[config] = None
+            return None
+        lang, psm, variables = parsed
+        try:
+            if _tessdata_path is None:
+                api = tesserocr.PyTessBaseAPI(lang=lang)
+            else:
+                api = tesserocr.PyTessBaseAPI(path=_tessdata_path, lang=lang)
+        except RuntimeError as e:
+            # Usually the languages aren't in the tessdata folder, so pytesseract (with its own folder) is used instead
+            print(f"Could not load Tesseract in process ({e}), reading with pytesseract instead.")
+            _tesserocr_failed = True
+            return None
+        if psm is not None:
+            api.SetPageSegMode(psm)
+        for name, value in variables.items():
+            api.SetVariable(name, value)
+        apis[config] = api
+    return apis[config]
+
+
+def read_words(cell_img, config):
+    """Read a grayscale cell image and return its words as a list of (word, confidence 0-100)."""
+    api = get_api(config)
+    if api is None:
+        data = pytesseract.image_to_data(cell_img, config=config, output_type=pytesseract.Output.DICT)
+        # Entries with a negative confidence are the page, block and line entries rather than words
+        return [(word, float(conf)) for word, conf in zip(data["text"], data["conf"]) if float(conf) >= 0]
+    height, width = cell_img.shape[:2]
+    # The cell is usually a slice of a wider column, so its rows are packed together with no gaps for Tesseract,
+    # and kept in a variable until it has finished reading them since Tesseract doesn't copy them
+    pixels = np.ascontiguousarray(cell_img, dtype=np.uint8).tobytes()
+    api.SetImageBytes(pixels, width, height, 1, width)
+    api.Recognize()
+    return [(word, float(conf)) for word, conf in api.MapWordConfidences()]
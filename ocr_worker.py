@@ -0,0 +1,119 @@
+"""
+Remote OCR worker for HCR2.
+
+Connects to the reader bot and reads the screenshots it sends, using the same Tesseract set up and code as the bot,
+so sweeps can be spread over more computers. Several workers can run on the same computer for testing. The worker
+keeps reconnecting if the connection to the bot is lost, like when the bot restarts.
+
+Usage: python ocr_worker.py host:port [--slots count] [--threads count] [--name name]
+The token has to match the bot's OCR_WORKER_TOKEN, and is read from the .env file or given with --token.
+"""
+
+import os
+import socket
+import asyncio
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import SSReaderBot
+import ocr_workers
+import debug_artifacts
+
+# Seconds to wait before connecting again after the connection to the bot is lost, doubling each time up to the most
+reconnect_delay = 1
+max_reconnect_delay = 60
+
+
+def use_row_threads(count):
+    """Give a worker process its own small pool of threads for reading rows. Runs when each process starts."""
+    # The bot's pool has a thread for every CPU core, which is too many when every process has one
+    SSReaderBot.ocr_executor = ThreadPoolExecutor(max_workers=count)
+
+
+def extract(png_bytes, seen_strings, artifact_name=None, artifact_mode="off", sample_rate=0.0):
+    """Read the teams from a PNG encoded screenshot, skipping the rows already seen. Runs in a worker process.
+    The screenshot's debug images are saved on this computer with the bot's settings. Return the reply header for the bot."""
+    img = cv2.imdecode(np.frombuffer(png_bytes, np.uint8), 1)
+    if img is None:
+        return {"type": "error", "message": "Could not open the screenshot."}
+    seen_rows = ocr_workers.decode_row_hashes(seen_strings)
+    try:
+        # Only the space the images can take up is this computer's own setting
+        debug_artifacts.configure(artifact_mode, sample_rate, debug_artifacts.max_artifact_bytes)
+        rows, row_hashes = asyncio.run(SSReaderBot.SS_extract_text(img, seen_rows, artifact_name))
+    except Exception as e:
+        return {"type": "error", "message": str(e)}
+    # Each row's hash is sent back with it, the bot decides which rows are kept and remembered as seen
+    return {"type": "result", "rows": rows, "hashes": ocr_workers.encode_row_hashes(row_hashes)}
+
+
+async def handle_request(header, body, writer, pool):
+    """Read a screenshot from the bot in the process pool and send back the reply."""
+    loop = asyncio.get_event_loop()
+    try:
+        reply = await loop.run_in_executor(pool, extract, body, header.get("seen", []), header.get("artifact"),
+                                           header.get("debug", "off"), header.get("sample rate", 0.0))
+        reply["id"] = header["id"]
+        writer.write(ocr_workers.encode_message(reply))
+        await writer.drain()
+    except Exception as e:
+        # Nothing waits on this task, so the error is printed here, usually the connection closed while reading.
+        # The bot reads the screenshot itself once it notices the worker has gone
+        print(f"Could not reply to the bot for request {header.get('id')}: {e!r}")
+
+
+async def serve_bot(host, port, token, name, slots, pool):
+    """Register with the bot and read the screenshots it sends until the connection is closed."""
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(ocr_workers.encode_message({"type": "register", "token": token, "name": name, "slots": slots}))
+        header, _ = await ocr_workers.read_message(reader)
+        if header.get("type") != "registered":
+            raise Exception("The bot rejected the worker, check OCR_WORKER_TOKEN matches the bot's.")
+        print(f"Registered with the bot at {host}:{port} as {name}, reading {slots} screenshots at a time.")
+        while True:
+            header, body = await ocr_workers.read_message(reader)
+            if header.get("type") == "extract":
+                # Read each screenshot as its own task, so up to slots of them are read at the same time
+                asyncio.ensure_future(handle_request(header, body, writer, pool))
+    finally:
+        writer.close()
+
+
+async def run_worker(host, port, token, name, slots, threads):
+    """Serve the bot forever, connecting again whenever the connection is lost."""
+    loop = asyncio.get_event_loop()
+    delay = reconnect_delay
+    with ProcessPoolExecutor(max_workers=slots, initializer=use_row_threads, initargs=(threads,)) as pool:
+        while True:
+            connected_at = loop.time()
+            try:
+                await serve_bot(host, port, token, name, slots, pool)
+            except (OSError, asyncio.IncompleteReadError) as e:
+                # Start the delay from the beginning again if the connection had been working for a while
+                if loop.time() - connected_at > max_reconnect_delay:
+                    delay = reconnect_delay
+                print(f"Lost the connection to the bot ({e}), connecting again in {delay}s.")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_reconnect_delay)
+
+
+def main():
+    """Run a worker from the command line."""
+    parser = argparse.ArgumentParser(description="Read screenshots for the reader bot on this computer.")
+    parser.add_argument("bot", help="host:port the reader bot accepts OCR workers on (READER_OCR_PORT)")
+    parser.add_argument("--slots", type=int, default=os.cpu_count(), help="number of screenshots read at the same time")
+    parser.add_argument("--threads", type=int, default=1, help="number of rows of each screenshot read at the same time")
+    parser.add_argument("--name", default=f"{socket.gethostname()}-{os.getpid()}", help="name shown by the bot")
+    parser.add_argument("--token", default=os.getenv("OCR_WORKER_TOKEN", ""), help="the bot's OCR_WORKER_TOKEN")
+    args = parser.parse_args()
+    host, _, port = args.bot.rpartition(":")
+    asyncio.get_event_loop().run_until_complete(run_worker(host, int(port), args.token, args.name, max(1, args.slots),
+                                                           max(1, args.threads)))
+
+
+if __name__ == "__main__":
+    main()
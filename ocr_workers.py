@@ -0,0 +1,192 @@
+"""
+Remote OCR workers for HCR2.
+
+Lets the reader bot hand screenshots to OCR workers on other computers (or other processes on the same one), so
+sweeps from busy servers aren't all read by the one computer running the bot. Workers connect to the bot and register
+with a shared token, then the bot sends each screenshot to the worker with the fewest screenshots in progress for its
+size and gets the rows back. A screenshot is read locally instead if there aren't any workers, or if its worker
+disconnects or takes too long.
+
+Messages both ways are length prefixed: two 4 byte big endian lengths, then a JSON header of that first length and a
+binary body of the second length (the PNG encoded screenshot, for requests).
+"""
+
+import hmac
+import json
+import base64
+import struct
+import asyncio
+import itertools
+
+import cv2
+import numpy as np
+
+import metrics
+import debug_artifacts
+
+# Largest message that will be read, so a bad connection can't make the bot read gigabytes
+max_message_size = 64 * 1024 * 1024
+# Seconds to wait for a worker to read a screenshot, including any time waiting behind its other screenshots
+worker_timeout = 120
+# Seconds a new connection has to register in before it's closed
+register_timeout = 10
+
+# Registered workers by name, each holding its connection, how many screenshots it reads at the same time,
+# the screenshots it's reading and how many it has read
+_workers = {}
+_request_ids = itertools.count(1)
+# The server workers connect to, once it has been started
+_server = None
+# Token workers need to send to register
+_token = ""
+
+metrics.describe("hcr2_ocr_screenshots_total", "counter", "Screenshots read, by where they were read.")
+metrics.describe("hcr2_ocr_workers", "gauge", "Remote OCR workers registered with the reader bot.")
+
+
+def collect_metrics():
+    """Update the number of registered workers just before the metrics are served."""
+    metrics.set_gauge("hcr2_ocr_workers", len(_workers))
+
+
+metrics.register_collector(collect_metrics)
+
+
+def encode_message(header, body=b""):
+    """Turn a header dictionary and a binary body into a length prefixed message."""
+    header_bytes = json.dumps(header).encode("utf-8")
+    return struct.pack(">II", len(header_bytes), len(body)) + header_bytes + body
+
+
+async def read_message(reader):
+    """Read a length prefixed message and return its header dictionary and binary body."""
+    header_length, body_length = struct.unpack(">II", await reader.readexactly(8))
+    if header_length + body_length > max_message_size:
+        raise ConnectionError(f"Message of {header_length + body_length} bytes is too large")
+    header = json.loads((await reader.readexactly(header_length)).decode("utf-8"))
+    body = await reader.readexactly(body_length)
+    return header, body
+
+
+def encode_row_hashes(row_hashes):
+    """Turn a list of row hashes into strings that can go in a message header."""
+    return [base64.b64encode(hash_bits.tobytes()).decode("ascii") for hash_bits in row_hashes]
+
+
+def decode_row_hashes(strings):
+    """Turn the row hash strings from a message header back into row hashes."""
+    return [np.frombuffer(base64.b64decode(string), np.uint8) for string in strings]
+
+
+def choose_worker():
+    """Get the worker with the fewest screenshots in progress for how many it can read at once, or None if there aren't any."""
+    if len(_workers) == 0:
+        return None
+    return min(_workers.values(), key=lambda worker: len(worker["pending"]) / worker["slots"])
+
+
+def remove_worker(worker, reason):
+    """Forget a worker and close its connection, so the screenshots it was reading are read locally instead."""
+    if _workers.get(worker["name"]) is worker:
+        del _workers[worker["name"]]
+        print(f"OCR worker {worker['name']} removed: {reason}")
+    for future in worker["pending"].values():
+        if not future.done():
+            future.set_exception(ConnectionError(reason))
+    worker["writer"].close()
+
+
+async def handle_worker(reader, writer):
+    """Register a worker connecting to the bot, then pass its replies to the screenshots waiting for them."""
+    try:
+        header, _ = await asyncio.wait_for(read_message(reader), register_timeout)
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+        writer.close()
+        return
+    # Only workers with the right token can register, anyone else could send back made up teams
+    if header.get("type") != "register" or not hmac.compare_digest(str(header.get("token", "")), _token):
+        writer.write(encode_message({"type": "rejected"}))
+        writer.close()
+        return
+    name = str(header.get("name") or writer.get_extra_info("peername"))
+    worker = {"name": name, "writer": writer, "slots": max(1, int(header.get("slots", 1))), "pending": {}, "read": 0}
+    # A worker reconnecting under the same name replaces its old connection
+    if name in _workers:
+        remove_worker(_workers[name], "registered again")
+    _workers[name] = worker
+    writer.write(encode_message({"type": "registered"}))
+    print(f"OCR worker {name} registered, reading {worker['slots']} screenshots at a time.")
+
+    try:
+        while True:
+            header, _ = await read_message(reader)
+            future = worker["pending"].get(header.get("id"))
+            if future is not None and not future.done():
+                future.set_result(header)
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError) as e:
+        remove_worker(worker, f"disconnected ({e or 'connection closed'})")
+
+
+async def read_remotely(worker, img, seen_rows, artifact_name):
+    """Send a screenshot to a worker to be read and return its reply."""
+    request_id = next(_request_ids)
+    future = asyncio.get_event_loop().create_future()
+    worker["pending"][request_id] = future
+    try:
+        _, png = cv2.imencode(".png", img)
+        # The worker saves the screenshot's debug images on its own computer, with the bot's debug image settings
+        worker["writer"].write(encode_message({"type": "extract", "id": request_id,
+                                               "seen": encode_row_hashes(seen_rows),
+                                               "artifact": artifact_name,
+                                               "debug": debug_artifacts.artifact_mode,
+                                               "sample rate": debug_artifacts.sample_rate}, png.tobytes()))
+        await worker["writer"].drain()
+        return await asyncio.wait_for(future, worker_timeout)
+    finally:
+        worker["pending"].pop(request_id, None)
+
+
+async def extract_text(img, seen_rows, local_extract, artifact_name=None):
+    """Read the teams from a screenshot on a worker, or locally with local_extract (SS_extract_text) if that can't be
+    done. Rows in seen_rows are skipped, and the rows read are returned along with their hashes, the same as
+    SS_extract_text. artifact_name names the screenshot's debug images wherever it's read."""
+    worker = choose_worker()
+    if worker is None:
+        metrics.inc("hcr2_ocr_screenshots_total", {"where": "local"})
+        return await local_extract(img, seen_rows, artifact_name)
+    try:
+        reply = await read_remotely(worker, img, seen_rows, artifact_name)
+    except (asyncio.TimeoutError, ConnectionError, OSError) as e:
+        # A worker that has stopped answering is dropped, it can register again once it's working
+        if isinstance(e, asyncio.TimeoutError):
+            remove_worker(worker, f"took longer than {worker_timeout}s to read a screenshot")
+        print(f"OCR worker {worker['name']} couldn't read a screenshot, reading it locally instead.")
+        metrics.inc("hcr2_ocr_screenshots_total", {"where": "fallback"})
+        return await local_extract(img, seen_rows, artifact_name)
+    metrics.inc("hcr2_ocr_screenshots_total", {"where": "remote"})
+    worker["read"] += 1
+    # Problems with the screenshot itself are raised the same as if it had been read locally
+    if reply.get("type") == "error":
+        raise Exception(reply["message"])
+    return reply["rows"], decode_row_hashes(reply["hashes"])
+
+
+def workers_to_string():
+    """Describe the registered workers and how many screenshots each one has read."""
+    if len(_workers) == 0:
+        return "No OCR workers are registered, screenshots are read locally."
+    return "\n".join(f"OCR worker {worker['name']}: {len(worker['pending'])}/{worker['slots']} screenshots in progress, "
+                     f"{worker['read']} read." for worker in _workers.values())
+
+
+async def start_coordinator(port, host, token):
+    """Start listening for workers on a port, unless the port is 0 or the server has already been started."""
+    global _server, _token
+    if port == 0 or _server is not None:
+        return
+    if token == "":
+        print("Not accepting OCR workers, since no OCR_WORKER_TOKEN has been set.")
+        return
+    _token = token
+    _server = await asyncio.start_server(handle_worker, host, port)
+    print(f"Accepting OCR workers on {host}:{port}")
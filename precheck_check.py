@@ -0,0 +1,196 @@
+"""
+Screenshot pre-check calibration for HCR2.
+
+Measures screenshots the same way the screenshot pre-check does and shows the spread of each measurement for clear
+screenshots and for each kind of obstruction, so the thresholds can be set between them. Counts the clear screenshots
+that would be warned about and the obstructed ones that wouldn't be with the current thresholds, and fails if there
+are any. Runs on folders of real screenshots, on made up screenshots drawn like the game's leaderboard, or both.
+
+Usage: python precheck_check.py [--clear folder] [--obstructed folder] [--generate count] [--seed seed]
+"""
+
+import os
+import sys
+import random
+import argparse
+
+# Folders given on the command line are relative to where it was run from
+launch_dir = os.getcwd()
+
+import cv2
+import numpy as np
+
+import screenshot_precheck
+from screenshot_precheck import measure_screenshot, find_problems, top_trim_ratio
+
+# Screenshot file types that are read, anything else in the folder is ignored
+image_extensions = (".png", ".jpg", ".jpeg")
+# Kinds of obstruction the made up screenshots can have, each made as often as the clear ones
+obstructions = ("VIP chest", "navigation bar", "covered rows", "cropped")
+# Measurements shown for each kind of screenshot
+measurement_names = ("VIP chest", "navigation bar", "columns", "rows", "row spacing", "row height")
+# Shapes of phone and tablet screens the made up screenshots are drawn at (height / width)
+screen_ratios = (0.42, 0.45, 0.4615, 0.5, 0.5625, 0.625, 0.75)
+
+
+def random_name(rng):
+    """Make up a team name of random length."""
+    return "".join(rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789 _-")
+                   for _ in range(rng.randint(3, 15))).strip() or "Team"
+
+
+def draw_trophy(img, x, y, size):
+    """Draw a gold trophy with its top left corner at (x, y)."""
+    gold = (30, 190, 250)
+    cv2.ellipse(img, (x + size // 2, y + size // 3), (size // 2, size // 3), 0, 0, 180, gold, -1)
+    cv2.rectangle(img, (x + size * 2 // 5, y + size // 2), (x + size * 3 // 5, y + size * 4 // 5), gold, -1)
+    cv2.rectangle(img, (x + size // 4, y + size * 4 // 5), (x + size * 3 // 4, y + size), gold, -1)
+
+
+def make_screenshot(rng, obstruction=None):
+    """Draw a made up leaderboard screenshot at a random size and scroll position, with an obstruction if given."""
+    width = rng.randint(1280, 2560)
+    height = int(width * rng.choice(screen_ratios))
+    img = np.zeros((height, width, 3), np.uint8)
+    img[:] = (rng.randint(60, 80), rng.randint(30, 40), rng.randint(10, 20))
+    # The header is trimmed off before anything is measured, but it's drawn so the screenshot is complete
+    top = int(top_trim_ratio * height)
+    cv2.rectangle(img, (0, 0), (width, top // 3), (120, 60, 20), -1)
+    cv2.putText(img, "TEAM EVENT", (width // 3, top // 4), cv2.FONT_HERSHEY_DUPLEX, width / 1000, (255, 255, 255), 3)
+    # About 9 rows fit below the header, scrolled to a random point
+    pitch = (height - top) / 9.3 * rng.uniform(0.95, 1.05)
+    font_scale = 0.35 * pitch / 22
+    thickness = max(1, int(font_scale * 2))
+    font = rng.choice((cv2.FONT_HERSHEY_SIMPLEX, cv2.FONT_HERSHEY_DUPLEX))
+    badge_radius = int(0.3 * pitch)
+    badge_left = int(0.1 * width)
+    names_left = badge_left + 2 * badge_radius + int(0.05 * width)
+    first_position = rng.randint(1, 490)
+    row_top = top + rng.uniform(-0.5, 0.3) * pitch
+    row = 0
+    while row_top < height:
+        y = int(row_top)
+        baseline = int(row_top + 0.62 * pitch)
+        panel = (rng.randint(95, 125), rng.randint(50, 65), rng.randint(20, 35))
+        cv2.rectangle(img, (int(0.03 * width), y), (int(0.97 * width), int(row_top + 0.88 * pitch)), panel, -1)
+        # Positions are right aligned next to the team badge, so the reader sees them as one column
+        position = str(first_position + row)
+        position_width = cv2.getTextSize(position, font, font_scale, thickness)[0][0]
+        cv2.putText(img, position, (badge_left - int(0.008 * width) - position_width, baseline), font, font_scale,
+                    (255, 255, 255), thickness)
+        badge = (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255))
+        cv2.circle(img, (badge_left + badge_radius, int(row_top + 0.44 * pitch)), badge_radius, badge, -1)
+        cv2.putText(img, random_name(rng), (names_left, baseline), font, font_scale, (255, 255, 255), thickness)
+        draw_trophy(img, int(0.72 * width), int(row_top + 0.2 * pitch), int(0.45 * pitch))
+        cv2.putText(img, str(rng.randint(1000, 40000)), (int(0.78 * width), baseline), font, font_scale,
+                    (255, 255, 255), thickness)
+        row_top += pitch
+        row += 1
+
+    if obstruction == "VIP chest":
+        # A gold chest with brown bands in the top left of the leaderboard
+        chest_width = int(rng.uniform(0.1, 0.16) * width)
+        chest_height = int(rng.uniform(0.12, 0.2) * (height - top))
+        x = int(rng.uniform(0.02, 0.12) * width)
+        y = top + int(rng.uniform(0.0, 0.08) * (height - top))
+        cv2.rectangle(img, (x, y), (x + chest_width, y + chest_height), (20, 170, 235), -1)
+        cv2.ellipse(img, (x + chest_width // 2, y), (chest_width // 2, chest_height // 3), 0, 180, 360, (20, 170, 235), -1)
+        for band in (0.3, 0.7):
+            cv2.rectangle(img, (x + int(band * chest_width) - 4, y), (x + int(band * chest_width) + 4, y + chest_height),
+                          (20, 60, 120), -1)
+    elif obstruction == "navigation bar":
+        # A near black bar across the bottom with the three navigation buttons
+        bar_top = height - int(rng.uniform(0.05, 0.08) * height)
+        img[bar_top:] = rng.randint(0, 15)
+        bar_middle = (bar_top + height) // 2
+        button = (height - bar_top) // 4
+        for x in (width // 3, width // 2, width * 2 // 3):
+            cv2.circle(img, (x, bar_middle), button, (200, 200, 200), 2)
+    elif obstruction == "covered rows":
+        # A light notification banner over a few of the rows, across the names
+        left = int(rng.uniform(0.1, 0.3) * width)
+        banner_width = int(rng.uniform(0.4, 0.6) * width)
+        banner_top = top + int(rng.uniform(0.25, 0.55) * (height - top))
+        banner_height = int(rng.uniform(1.2, 2.5) * pitch)
+        cv2.rectangle(img, (left, banner_top), (left + banner_width, banner_top + banner_height), (235, 235, 235), -1)
+        cv2.putText(img, "New message", (left + 20, banner_top + banner_height // 2), cv2.FONT_HERSHEY_SIMPLEX,
+                    font_scale, (40, 40, 40), thickness)
+    elif obstruction == "cropped":
+        # Cut off on the right, losing the cup icons and cups
+        img = img[:, :int(rng.uniform(0.45, 0.7) * width)]
+
+    # Screenshots are usually sent compressed, which blurs the edges of the text a little
+    _, encoded = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, rng.randint(70, 95)])
+    return cv2.imdecode(encoded, 1)
+
+
+def read_folder(folder):
+    """Read every screenshot in a folder and its subfolders, returning them as a list of (name, OpenCV image)."""
+    images = []
+    for root, _, file_names in os.walk(folder):
+        for file_name in sorted(file_names):
+            if not file_name.lower().endswith(image_extensions):
+                continue
+            img = cv2.imread(os.path.join(root, file_name))
+            if img is None:
+                print(f"Could not open {file_name}.")
+                continue
+            images.append((os.path.relpath(os.path.join(root, file_name), folder), img))
+    return images
+
+
+def spread_string(values):
+    """Describe the spread of a measurement as its smallest, middle and largest values."""
+    values = sorted(value for value in values if value is not None)
+    if len(values) == 0:
+        return "-"
+    return f"{values[0]:.3g} / {values[len(values) // 2]:.3g} / {values[-1]:.3g}"
+
+
+def main():
+    """Measure the screenshots given on the command line and show how well the thresholds separate them."""
+    parser = argparse.ArgumentParser(description="Check the screenshot pre-check's thresholds against screenshots.")
+    parser.add_argument("--clear", help="folder of screenshots with nothing covering the leaderboard")
+    parser.add_argument("--obstructed", help="folder of screenshots with something covering the leaderboard")
+    parser.add_argument("--generate", type=int, default=0, help="number of made up screenshots of each kind to check")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the made up screenshots, so a run can be repeated")
+    args = parser.parse_args()
+    if args.clear is None and args.obstructed is None and args.generate == 0:
+        parser.error("Give a --clear folder, an --obstructed folder, a --generate count or any of them.")
+
+    # Each kind of screenshot has a list of (name, measurements, whether it's obstructed)
+    kinds = {}
+    for option, obstructed in ((args.clear, False), (args.obstructed, True)):
+        if option is not None:
+            kind = ("obstructed" if obstructed else "clear") + " (" + option + ")"
+            kinds[kind] = [(name, measure_screenshot(img), obstructed)
+                           for name, img in read_folder(os.path.join(launch_dir, option))]
+    rng = random.Random(args.seed)
+    for kind in (None,) + obstructions:
+        if args.generate > 0:
+            kinds[kind or "clear"] = [(f"{kind or 'clear'} {i}", measure_screenshot(make_screenshot(rng, kind)),
+                                       kind is not None) for i in range(args.generate)]
+
+    print("Smallest / middle / largest of each measurement, with the current thresholds:")
+    print(f"  thresholds: VIP chest > {screenshot_precheck.max_overlay_fraction}, navigation bar > "
+          f"{screenshot_precheck.max_navigation_bar_fraction}, columns < {screenshot_precheck.min_columns}, rows < "
+          f"{screenshot_precheck.min_rows}, row spacing > {screenshot_precheck.max_row_spacing_variation}, row height > "
+          f"{screenshot_precheck.max_row_height_ratio}")
+    wrong = 0
+    for kind, results in kinds.items():
+        print(f"{kind} ({len(results)} screenshots):")
+        for measurement in measurement_names:
+            print(f"  {measurement}: {spread_string([measurements[measurement] for _, measurements, _ in results])}")
+        # Clear screenshots shouldn't be warned about, and obstructed ones should be
+        missed = [(name, find_problems(measurements)) for name, measurements, obstructed in results
+                  if (len(find_problems(measurements)) > 0) != obstructed]
+        wrong += len(missed)
+        print(f"  {len(results) - len(missed)}/{len(results)} warned about correctly.")
+        for name, problems in missed[:5]:
+            print(f"    {name}: {' '.join(problems) or 'no warning'}")
+    if wrong > 0:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
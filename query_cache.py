@@ -0,0 +1,56 @@
+"""
+Query result cache for HCR2.
+
+Keeps the formatted responses to recent !time and !team queries, so the same question asked many times during a match
+rush only reads and formats the spreadsheet once. Each response is cached along with the version of the data it was
+made from, so a sweep or correction changing the spreadsheet means the next query is worked out again.
+"""
+
+import threading
+from collections import OrderedDict
+
+# Most responses kept in the cache at once, the least recently used is dropped when it's full
+query_cache_size = 256
+
+# Cached responses by key, with the most recently used last
+_cache = OrderedDict()
+# Counters for how well the cache is working
+cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+# Queries are worked out on a thread pool, so only one thread at a time can use the cache
+_cache_lock = threading.Lock()
+
+
+def get_cached(key):
+    """Get the cached response for a key, or None if it hasn't been cached."""
+    with _cache_lock:
+        if key in _cache:
+            cache_stats["hits"] += 1
+            # Mark the response as the most recently used
+            _cache.move_to_end(key)
+            return _cache[key]
+        cache_stats["misses"] += 1
+        return None
+
+
+def store(key, response):
+    """Cache a response, dropping the least recently used response if the cache is full."""
+    with _cache_lock:
+        _cache[key] = response
+        _cache.move_to_end(key)
+        if len(_cache) > query_cache_size:
+            _cache.popitem(last=False)
+            cache_stats["evictions"] += 1
+
+
+def clear():
+    """Remove every cached response."""
+    with _cache_lock:
+        _cache.clear()
+
+
+def stats_to_string():
+    """Describe the cache's counters in a readable string."""
+    lookups = cache_stats["hits"] + cache_stats["misses"]
+    hit_rate = 100 * cache_stats["hits"] / lookups if lookups > 0 else 0
+    return (f"{cache_stats['hits']} hits, {cache_stats['misses']} misses ({hit_rate:.1f}% hit rate), "
+            f"{cache_stats['evictions']} evictions, {len(_cache)}/{query_cache_size} responses cached.")
@@ -0,0 +1,120 @@
+"""
+Background sweep jobs for HCR2.
+
+Runs the screenshot sweeps started by !end on a queue of background workers, so the bot can reply straight away and
+keep handling messages while screenshots are processed. Each job keeps track of its progress for !status and can be
+stopped with !cancel.
+"""
+
+import asyncio
+
+# How many finished jobs are remembered for !status
+finished_job_limit = 20
+
+# Every job by its ID, in the order they were submitted
+jobs = {}
+_job_queue = None
+_workers = []
+_next_job_id = 1
+
+
+def new_job(channel_id, description):
+    """Create a job dictionary with all of its progress counters set to zero."""
+    global _next_job_id
+    job = {"id": _next_job_id,
+           "channel": channel_id,
+           "description": description,
+           "status": "queued",
+           "screenshots": 0,
+           "downloaded": 0,
+           "read": 0,
+           "merged": 0,
+           "task": None}
+    _next_job_id += 1
+    return job
+
+
+def forget_finished_jobs():
+    """Remove the oldest finished jobs so only the most recent ones are kept."""
+    finished = [job_id for job_id, job in jobs.items() if job["status"] in ("done", "cancelled", "failed")]
+    for job_id in finished[:max(0, len(finished) - finished_job_limit)]:
+        del jobs[job_id]
+
+
+async def worker():
+    """Take jobs off the queue and run them one at a time, forever."""
+    while True:
+        job, job_func, on_failure = await _job_queue.get()
+        # Skip jobs that were cancelled while still waiting in the queue
+        if job["status"] == "queued":
+            job["status"] = "running"
+            # Run the job as its own task so it can be cancelled without stopping the worker
+            job["task"] = asyncio.ensure_future(job_func(job))
+            try:
+                await job["task"]
+                job["status"] = "done"
+            except asyncio.CancelledError:
+                job["status"] = "cancelled"
+            except Exception as e:
+                job["status"] = "failed"
+                print(f"Job {job['id']} failed: {e}")
+                # Let whoever started the job know, rather than it only showing as failed in !status
+                if on_failure is not None:
+                    on_failure(job, e)
+            job["task"] = None
+        forget_finished_jobs()
+        _job_queue.task_done()
+
+
+def start_workers(count):
+    """Start the given number of workers, unless they have already been started."""
+    global _job_queue
+    if _job_queue is not None:
+        return
+    _job_queue = asyncio.Queue()
+    for _ in range(max(1, count)):
+        _workers.append(asyncio.ensure_future(worker()))
+
+
+def submit_job(channel_id, description, job_func, on_failure=None):
+    """Add a job to the queue, where job_func is an async function taking the job dictionary. on_failure is called
+    with the job and the exception if job_func raises one. Return the job."""
+    job = new_job(channel_id, description)
+    jobs[job["id"]] = job
+    _job_queue.put_nowait((job, job_func, on_failure))
+    return job
+
+
+def cancel_job(job_id):
+    """Cancel a queued or running job, returning False if there isn't an unfinished job with that ID."""
+    job = jobs.get(job_id)
+    if job is None or job["status"] not in ("queued", "running"):
+        return False
+    if job["status"] == "queued":
+        job["status"] = "cancelled"
+    else:
+        job["task"].cancel()
+    return True
+
+
+async def wait_until_idle():
+    """Wait until every job that has been submitted has finished."""
+    if _job_queue is not None:
+        await _job_queue.join()
+
+
+def get_queue_depth():
+    """Get the number of jobs waiting in the queue, including cancelled ones that haven't been taken off it yet."""
+    return _job_queue.qsize() if _job_queue is not None else 0
+
+
+def get_channel_jobs(channel_id):
+    """Get every job remembered for a channel, oldest first."""
+    return [job for job in jobs.values() if job["channel"] == channel_id]
+
+
+def job_to_string(job):
+    """Describe a job and its progress in a readable string."""
+    return (f"Job {job['id']} ({job['description']}): {job['status']}, "
+            f"{job['downloaded']}/{job['screenshots']} screenshots downloaded, "
+            f"{job['read']}/{job['screenshots']} read, {job['merged']} teams merged.")
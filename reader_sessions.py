@@ -0,0 +1,128 @@
+"""
+Screenshot session tracking for HCR2.
+
+Keeps track of each channel's open !start session and the screenshots uploaded to it as the messages arrive, so
+everything needed for a sweep is already known when !end is sent and the channel history never needs to be read.
+Every change is written to a journal file so that open sessions survive the bot restarting.
+"""
+
+import os
+import csv
+
+# Change the session journal file location here if necessary
+sessionJournalPath = "reader_session_journal.csv"
+
+# The session that is currently open in each channel, keyed by channel ID
+open_sessions = {}
+# The last session that was ended in each channel, kept so it can be reopened if its !end message is deleted
+closed_sessions = {}
+
+
+def apply_event(event, channel_id, message_id, data):
+    """Update the sessions with a single event, used both for new messages and for replaying the journal."""
+    if event == "start":
+        # A new !start replaces any session that was already open in the channel
+        open_sessions[channel_id] = {"start": message_id, "start content": data, "attachments": [], "end": None}
+    elif event == "attachment":
+        # Screenshots are only part of a session if they're uploaded after !start
+        if channel_id in open_sessions:
+            open_sessions[channel_id]["attachments"].append((message_id, data))
+    elif event == "end":
+        if channel_id in open_sessions:
+            session = open_sessions.pop(channel_id)
+            session["end"] = message_id
+            closed_sessions[channel_id] = session
+    elif event == "delete":
+        session = open_sessions.get(channel_id)
+        closed = closed_sessions.get(channel_id)
+        # Deleting the !start message means there's no longer a start to the session
+        if session is not None and session["start"] == message_id:
+            del open_sessions[channel_id]
+        # Deleting the !end message reopens its session so the !end can be sent again,
+        # unless a newer session has been started since
+        elif session is None and closed is not None and closed["end"] == message_id:
+            closed["end"] = None
+            open_sessions[channel_id] = closed_sessions.pop(channel_id)
+        # Otherwise, remove any screenshots from the deleted message
+        for affected in (session, closed):
+            if affected is not None:
+                affected["attachments"] = [attachment for attachment in affected["attachments"]
+                                           if attachment[0] != message_id]
+
+
+def write_journal_rows(rows, mode='a'):
+    """Write event rows to the session journal, either appending to it or overwriting it."""
+    # Write the table headings if the file is new or being overwritten
+    write_headings = mode == 'w' or not os.path.exists(sessionJournalPath)
+    with open(sessionJournalPath, mode=mode, newline='', encoding="utf-8") as journal:
+        journal_writer = csv.writer(journal, delimiter=',')
+        if write_headings:
+            journal_writer.writerow(["event", "channel", "message", "data"])
+        for row in rows:
+            journal_writer.writerow(row)
+
+
+def record_event(event, channel_id, message_id, data=""):
+    """Apply an event to the sessions and add it to the end of the journal."""
+    apply_event(event, channel_id, message_id, data)
+    write_journal_rows([[event, channel_id, message_id, data]])
+
+
+def compact_journal():
+    """Rewrite the journal with only the events needed to rebuild the current sessions."""
+    rows = []
+    for sessions in (closed_sessions, open_sessions):
+        for channel_id, session in sessions.items():
+            rows.append(["start", channel_id, session["start"], session["start content"]])
+            for message_id, url in session["attachments"]:
+                rows.append(["attachment", channel_id, message_id, url])
+            if session["end"] is not None:
+                rows.append(["end", channel_id, session["end"], ""])
+    write_journal_rows(rows, mode='w')
+
+
+def load_sessions():
+    """Rebuild the sessions by replaying the journal from file."""
+    open_sessions.clear()
+    closed_sessions.clear()
+    if not os.path.exists(sessionJournalPath):
+        return
+    with open(sessionJournalPath, newline='', encoding="utf-8") as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            apply_event(row["event"], int(row["channel"]), int(row["message"]), row["data"])
+
+
+def start_session(channel_id, message_id, content):
+    """Open a new session in the channel for the !start message."""
+    record_event("start", channel_id, message_id, content)
+
+
+def add_attachment(channel_id, message_id, url):
+    """Add a screenshot to the channel's open session, returning False if there isn't an open session."""
+    if channel_id not in open_sessions:
+        return False
+    record_event("attachment", channel_id, message_id, url)
+    return True
+
+
+def get_open_session(channel_id):
+    """Get the channel's open session, or None if there isn't one."""
+    return open_sessions.get(channel_id)
+
+
+def end_session(channel_id, message_id):
+    """Close the channel's open session with the !end message."""
+    apply_event("end", channel_id, message_id, "")
+    # The journal only needs to hold the current sessions, so it's rewritten rather than left to keep growing
+    compact_journal()
+
+
+def delete_message(channel_id, message_id):
+    """Update the sessions for a deleted message, which may be a !start, !end or screenshot message."""
+    # Nothing needs recording if the message isn't part of any session
+    for session in (open_sessions.get(channel_id), closed_sessions.get(channel_id)):
+        if session is not None and (message_id in (session["start"], session["end"])
+                                    or any(attachment[0] == message_id for attachment in session["attachments"])):
+            record_event("delete", channel_id, message_id)
+            return
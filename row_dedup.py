@@ -0,0 +1,51 @@
+"""
+Row deduplication for HCR2.
+
+Screenshots taken while scrolling through the leaderboard often overlap, so the same rows are captured more than
+once. Each row is given a perceptual hash so rows already read earlier in the same sweep can be skipped before OCR.
+"""
+
+import numpy as np
+import cv2
+
+# Size (width, height) of the difference hash for the cups, names and positions cells of a row.
+# Every cell is hashed on its own so a single different digit in a narrow column still changes a lot of bits
+cell_hash_sizes = ((48, 12), (128, 12), (24, 12))
+# Largest fraction of bits that can differ in every cell for two rows to still count as the same row
+max_hash_distance = 0.04
+
+# Where each cell's bits start in the full row hash, used to count the differences per cell
+_cell_bit_counts = [width * height for width, height in cell_hash_sizes]
+_cell_bit_starts = np.cumsum([0] + _cell_bit_counts[:-1])
+
+
+def cell_hash(cell_img, size):
+    """Get the difference hash of a binarised cell image, trimmed to its ink, as a boolean array."""
+    # Trim the cell to the width of its ink so small differences in where the column was cropped don't matter
+    ink_cols = np.flatnonzero((cell_img < 128).any(axis=0))
+    if len(ink_cols) > 0:
+        cell_img = cell_img[:, ink_cols[0]:ink_cols[-1] + 1]
+    width, height = size
+    small = cv2.resize(cell_img, (width + 1, height), interpolation=cv2.INTER_AREA).astype(np.int16)
+    # Each bit is whether the brightness goes up from one pixel to the next along the cell
+    return (small[:, 1:] > small[:, :-1]).ravel()
+
+
+def row_hash(cups_cell, names_cell, positions_cell):
+    """Get the perceptual hash of a row from its binarised cells as a packed array of bits."""
+    cells = (cups_cell, names_cell, positions_cell)
+    # Trim every cell to the height of the row's ink, so rows cropped with slightly different padding still match
+    ink_rows = np.flatnonzero(np.any([(cell < 128).any(axis=1) for cell in cells], axis=0))
+    if len(ink_rows) > 0:
+        cells = [cell[ink_rows[0]:ink_rows[-1] + 1] for cell in cells]
+    return np.packbits(np.concatenate([cell_hash(cell, size) for cell, size in zip(cells, cell_hash_sizes)]))
+
+
+def is_seen_row(hash_bits, seen_rows):
+    """Check if a row hash is close enough, in every cell, to any of the row hashes already seen in the sweep."""
+    if len(seen_rows) == 0:
+        return False
+    # Count the differing bits of each cell against every seen row at once
+    differences = np.unpackbits(np.bitwise_xor(np.array(seen_rows), hash_bits), axis=1)
+    cell_distances = np.add.reduceat(differences, _cell_bit_starts, axis=1) / _cell_bit_counts
+    return bool((cell_distances <= max_hash_distance).all(axis=1).any())
@@ -0,0 +1,42 @@
+"""
+Row segmenter for HCR2.
+
+Finds the rows of the leaderboard with projection profiles, once per screenshot, so that every column can be
+cropped into the same rows and each row's cells can be read on their own.
+"""
+
+import numpy as np
+
+# Ink separated by a gap smaller than this many pixels is treated as the same row (7 px was chosen through testing)
+row_merge_gap = 7
+# Rows shorter than this fraction of the strip's height are noise rather than a row of text
+min_row_height_ratio = 0.02
+# Extra pixels added above and below each row when cropping so characters aren't touching the edges
+row_pad = 3
+
+
+def find_bands(profile, min_size=1, merge_gap=0):
+    """Return the (start, end) index pairs of every run of non-zero values in a projection profile."""
+    # Pad with zeros either side so every run has both a rising and a falling edge
+    inked = np.concatenate(([0], (profile > 0).astype(np.int8), [0]))
+    edges = np.flatnonzero(np.diff(inked)).reshape(-1, 2)
+
+    bands = []
+    for start, end in edges:
+        # Join this run onto the previous one if the gap between them is small enough
+        if len(bands) > 0 and start - bands[-1][1] < merge_gap:
+            bands[-1] = (bands[-1][0], end)
+        else:
+            bands.append((start, end))
+    # Drop runs that are too small to be anything useful
+    return [(int(start), int(end)) for start, end in bands if end - start >= min_size]
+
+
+def find_row_bands(strip, merge_gap=row_merge_gap):
+    """Find the (top, bottom) bounds of every row in a binarised strip with black text on a white background."""
+    height = strip.shape[0]
+    # Count the ink in each pixel row of the strip with a single reduction
+    profile = (strip < 128).sum(axis=1)
+    bands = find_bands(profile, min_size=max(1, int(min_row_height_ratio * height)), merge_gap=merge_gap)
+    # Pad every row slightly, without going outside of the strip
+    return [(max(0, top - row_pad), min(height, bottom + row_pad)) for top, bottom in bands]
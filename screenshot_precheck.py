@@ -0,0 +1,123 @@
+"""
+Screenshot quality pre-check for HCR2.
+
+Runs a few cheap checks on a downsampled copy of a screenshot to find obstructions (like the VIP chest overlay or
+the navigation bar) and badly cropped screenshots, so the user can be warned about them. The thresholds sit
+between the measurements of clear and obstructed screenshots from precheck_check.py, which should be run
+again on folders of real screenshots when they're available. The check can still be wrong, so the problems found
+are only ever warnings, and the screenshot is still read.
+"""
+
+import numpy as np
+import cv2
+
+from row_segmenter import find_bands, find_row_bands, row_merge_gap
+from column_detector import column_merge_radius
+
+# Width the screenshot is shrunk down to before checking, which is plenty for finding columns and rows
+precheck_width = 360
+# Same top trim and binarisation threshold as the main image processing
+top_trim_ratio = 0.337
+binary_threshold = 110
+
+# The leaderboard has cups, cup icon, names and positions columns
+min_columns = 4
+# Fewest rows that should be found (clear screenshots have 8 or more), how far the spacing between rows can be from
+# the usual spacing (up to 0.15 of it when clear) and how much taller than usual a row can be (up to 1.25 times when
+# clear, and at least 1.8 times when something covers the names)
+min_rows = 6
+max_row_spacing_variation = 0.3
+max_row_height_ratio = 1.5
+
+# HSV colour ranges of known overlays (the gold VIP chest) and the part of the screenshot they appear in,
+# as fractions (left, top, right, bottom) of the trimmed screenshot
+overlay_regions = (
+    ("VIP chest", (0.0, 0.0, 0.3, 0.2), (15, 120, 150), (35, 255, 255)),
+)
+# Fraction of an overlay region that needs to be the overlay's colour for a warning
+# (up to 0.06 without the VIP chest, from the gold team badges, and at least 0.22 with it)
+max_overlay_fraction = 0.14
+# The navigation bar is a strip of near-black pixels across the bottom of the screenshot
+# (up to 0.03 of the strip is near black without it, and at least 0.97 of it with it)
+navigation_bar_height_ratio = 0.05
+navigation_bar_max_value = 30
+max_navigation_bar_fraction = 0.5
+
+
+def shrink_screenshot(imgcv):
+    """Shrink a screenshot down to the pre-check width and trim its top off. Return the small copy and its scale."""
+    height, width = imgcv.shape[:2]
+    # Shrink the screenshot down, keeping its aspect ratio
+    scale = precheck_width / width
+    small = cv2.resize(imgcv, (precheck_width, max(1, int(height * scale))), interpolation=cv2.INTER_AREA)
+    # Trim the top off, the same as the main image processing does
+    return small[int(top_trim_ratio * small.shape[0]):], scale
+
+
+def measure_screenshot(imgcv):
+    """Take the measurements the pre-check is based on from an OpenCV screenshot. Return them as a dictionary of the
+    fraction of each overlay's region in its colour, the fraction of the bottom strip that's near black, the number of
+    columns and rows, and how much the spacing between rows varies (None if there are too few rows to tell)."""
+    small, scale = shrink_screenshot(imgcv)
+    small_height, small_width = small.shape[:2]
+    measurements = {}
+
+    # Measure known overlays by the fraction of their region that is the overlay's colour
+    hsv = cv2.cvtColor(small, cv2.COLOR_BGR2HSV)
+    for overlay_name, (left, top, right, bottom), lower, upper in overlay_regions:
+        region = hsv[int(top * small_height):int(bottom * small_height), int(left * small_width):int(right * small_width)]
+        measurements[overlay_name] = cv2.inRange(region, lower, upper).mean() / 255 if region.size > 0 else 0.0
+
+    # Measure the navigation bar by how much of the bottom strip is near black
+    bar = hsv[small_height - max(1, int(navigation_bar_height_ratio * small_height)):, :, 2]
+    measurements["navigation bar"] = float((bar < navigation_bar_max_value).mean())
+
+    # Binarise the screenshot the same way as the main image processing, giving black text on a white background
+    gray = cv2.cvtColor(cv2.bitwise_not(small), cv2.COLOR_BGR2GRAY)
+    _, binary = cv2.threshold(gray, binary_threshold, 255, cv2.THRESH_BINARY)
+
+    # Count the columns from the vertical ink profile, joining up the gaps the column detector would join at full size
+    columns = find_bands((binary < 128).sum(axis=0), merge_gap=max(1, int((2 * column_merge_radius + 1) * scale)))
+    measurements["columns"] = len(columns)
+
+    # The rows are found in the names column, the widest one, since the other columns have gaps that can hide
+    # a broken up row and the badges and cup icons can join rows together
+    left, right = max(columns, key=lambda column: column[1] - column[0]) if len(columns) > 0 else (0, small_width)
+    rows = find_row_bands(binary[:, left:right], merge_gap=max(1, int(row_merge_gap * scale)))
+    measurements["rows"] = len(rows)
+    measurements["row spacing"] = None
+    measurements["row height"] = None
+    if len(rows) >= min_rows:
+        # Something covering the names joins onto the rows it touches, giving one row much taller than the rest
+        heights = np.array([bottom - top for top, bottom in rows])
+        measurements["row height"] = float(heights.max() / np.median(heights))
+        # Ignore the first and last rows, since they can be cut off by the edges of the screenshot
+        centres = np.array([(top + bottom) / 2 for top, bottom in rows])
+        spacing = np.diff(centres)[1:-1] if len(rows) > 3 else np.diff(centres)
+        # A covered or missing row shows up as one spacing far from the rest, so the largest difference is used
+        median_spacing = np.median(spacing)
+        measurements["row spacing"] = float(np.abs(spacing - median_spacing).max() / median_spacing)
+    return measurements
+
+
+def find_problems(measurements):
+    """Compare a screenshot's measurements with the thresholds, returning a list of the problems found."""
+    problems = []
+    for overlay_name, _, _, _ in overlay_regions:
+        if measurements[overlay_name] > max_overlay_fraction:
+            problems.append(f"The {overlay_name} seems to be covering part of the leaderboard.")
+    if measurements["navigation bar"] > max_navigation_bar_fraction:
+        problems.append("The navigation bar seems to be covering the bottom of the leaderboard.")
+    if measurements["columns"] < min_columns:
+        problems.append(f"Only {measurements['columns']} of the {min_columns} leaderboard columns could be found.")
+    # An obstruction breaks up the rows, so there are too few of them or they're unevenly spaced
+    if measurements["rows"] < min_rows:
+        problems.append(f"Only {measurements['rows']} leaderboard rows could be found.")
+    elif measurements["row spacing"] > max_row_spacing_variation or measurements["row height"] > max_row_height_ratio:
+        problems.append("The leaderboard rows are unevenly spaced, something may be covering them.")
+    return problems
+
+
+def precheck_screenshot(imgcv):
+    """Check an OpenCV screenshot for anything that would stop it from being read, returning a list of problems."""
+    return find_problems(measure_screenshot(imgcv))
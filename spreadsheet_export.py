@@ -0,0 +1,85 @@
+"""
+Spreadsheet exports for HCR2.
+
+Writes the teams in a leaderboard's spreadsheet that match the !get_spreadsheet options to a CSV or JSON Lines file,
+gzip compressed if asked for, so anyone keeping their own copy of the data only needs to download what has changed.
+The spreadsheet is read and written one row at a time, so a large spreadsheet never needs to be held in memory.
+"""
+
+import csv
+import json
+import gzip
+
+# File formats teams can be exported in
+export_formats = ("csv", "jsonl")
+
+
+def new_export_options():
+    """Create the export options for the whole spreadsheet as a CSV file, which are changed by each option given."""
+    return {"since": None, "previous positions": None, "positions": None, "name": None, "format": "csv", "gzip": False}
+
+
+def changed_since(team, options):
+    """Check if a team's cups or position changed, or it joined the leaderboard, at or after the since time."""
+    # The timestamps are UTC strings so they sort by time
+    if team["timestamp changed"] != "N/A" and team["timestamp changed"] >= options["since"]:
+        return True
+    # Teams only have a prior timestamp once they've been in a second sweep, and never a changed one until their cups do
+    if team["timestamp prior"] == "N/A" and team["timestamp checked"] >= options["since"]:
+        return True
+    # Without any team history to compare with, only teams new in their latest sweep can be found
+    if options["previous positions"] is None or team["timestamp checked"] < options["since"]:
+        return False
+    # Teams that weren't in the last sweep before since have joined the leaderboard, the rest may have moved
+    return options["previous positions"].get(team["name"]) != team["position"]
+
+
+def team_matches(team, options):
+    """Check if a team from the spreadsheet matches every filter in the export options."""
+    # Only teams that changed at or after the time given
+    if options["since"] is not None and not changed_since(team, options):
+        return False
+    if options["positions"] is not None:
+        first, last = options["positions"]
+        if not team["position"].isdigit() or not first <= int(team["position"]) <= last:
+            return False
+    if options["name"] is not None and options["name"] not in team["name"].lower():
+        return False
+    return True
+
+
+def open_export_file(path, compress):
+    """Open a file to write the export to as text, compressing it as it's written if needed."""
+    if compress:
+        return gzip.open(path, mode='wt', newline='', encoding="utf-8")
+    return open(path, mode='w', newline='', encoding="utf-8")
+
+
+def export_file_name(options):
+    """Get the file name the export is sent as, showing whether it's the whole spreadsheet or only some teams."""
+    filtered = options["since"] is not None or options["positions"] is not None or options["name"] is not None
+    name = "team_end_times" + ("_filtered" if filtered else "") + "." + options["format"]
+    return name + ".gz" if options["gzip"] else name
+
+
+def export_teams(spreadsheet_path, export_path, options):
+    """Write the teams in a spreadsheet file that match the export options to the export file, one row at a time.
+    Return the number of teams written."""
+    count = 0
+    with open(spreadsheet_path, newline='', encoding="utf-8") as csvfile, \
+            open_export_file(export_path, options["gzip"]) as export_file:
+        reader = csv.DictReader(csvfile)
+        if options["format"] == "csv":
+            export_writer = csv.DictWriter(export_file, fieldnames=reader.fieldnames)
+            # Write the table headings
+            export_writer.writeheader()
+        for team in reader:
+            if not team_matches(team, options):
+                continue
+            # JSON Lines has each team as a JSON object on its own line
+            if options["format"] == "csv":
+                export_writer.writerow(team)
+            else:
+                export_file.write(json.dumps(team, ensure_ascii=False) + "\n")
+            count += 1
+    return count
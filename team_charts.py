@@ -0,0 +1,110 @@
+"""
+Team history charts for HCR2.
+
+Draws a team's cups and position over time from the leaderboard's team history as a PNG image for !chart. Charts are
+drawn in a separate process, so drawing one never holds up the bot, and the drawn images are cached along with the
+version of the data they were drawn from, so the same chart asked for again before the next sweep is sent straight away.
+matplotlib is only needed for charts, the bot works without it and !chart says it isn't available.
+"""
+
+import io
+import asyncio
+import threading
+from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import pytz
+
+try:
+    import matplotlib
+    # Draw straight to images, there's no screen to show them on
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
+    from matplotlib.ticker import MaxNLocator
+except ImportError:
+    plt = None
+
+# Format the timestamps are stored in within the team history
+datetime_format = "%Y-%m-%dT%H:%M"
+# Most chart images kept in the cache at once, the least recently used is dropped when it's full
+chart_cache_size = 32
+
+# Cached chart images by key, with the most recently used last
+_cache = OrderedDict()
+# Counters for how well the cache is working
+cache_stats = {"hits": 0, "misses": 0}
+# Charts are looked up from the event loop and stored after being drawn, so only one thread at a time can use the cache
+_cache_lock = threading.Lock()
+# Process the charts are drawn in, started the first time a chart is needed
+_chart_executor = None
+
+
+def charts_available():
+    """Check if matplotlib is installed, so charts can be drawn."""
+    return plt is not None
+
+
+def get_cached_chart(key):
+    """Get the cached chart image for a key, or None if it hasn't been cached."""
+    with _cache_lock:
+        if key in _cache:
+            cache_stats["hits"] += 1
+            # Mark the chart as the most recently used
+            _cache.move_to_end(key)
+            return _cache[key]
+        cache_stats["misses"] += 1
+        return None
+
+
+def store_chart(key, png):
+    """Cache a chart image, dropping the least recently used chart if the cache is full."""
+    with _cache_lock:
+        _cache[key] = png
+        _cache.move_to_end(key)
+        if len(_cache) > chart_cache_size:
+            _cache.popitem(last=False)
+
+
+def draw_chart(team_name, history, tz_string):
+    """Draw a team's cups and position over time and return the chart as PNG bytes. Runs in the chart process."""
+    tz = pytz.timezone(tz_string)
+    # The matplotlib dates are given in the chosen timezone, so the axis labels are in it too
+    times = [pytz.utc.localize(datetime.strptime(timestamp, datetime_format)).astimezone(tz).replace(tzinfo=None)
+             for timestamp, _, _ in history]
+    figure, (cups_axes, position_axes) = plt.subplots(2, 1, sharex=True, figsize=(8, 6), dpi=100)
+    cups_axes.plot(times, [cups for _, _, cups in history], marker="o", markersize=3, color="#29AB29")
+    cups_axes.set_ylabel("Cups")
+    cups_axes.set_title(f"{team_name} ({tz_string})")
+    position_axes.plot(times, [position for _, position, _ in history], marker="o", markersize=3, color="#FF9900")
+    position_axes.set_ylabel("Position")
+    # Position 1 is the best, so it goes at the top, and there aren't any positions in between whole numbers
+    position_axes.invert_yaxis()
+    position_axes.yaxis.set_major_locator(MaxNLocator(integer=True))
+    position_axes.xaxis.set_major_formatter(mdates.DateFormatter("%m-%d %H:%M"))
+    for axes in (cups_axes, position_axes):
+        axes.grid(True, alpha=0.3)
+    figure.autofmt_xdate()
+    figure.tight_layout()
+    png = io.BytesIO()
+    figure.savefig(png, format="png")
+    plt.close(figure)
+    return png.getvalue()
+
+
+async def render_chart(team_name, history, tz_string):
+    """Draw a chart in the chart process without holding up the event loop, and return it as PNG bytes."""
+    global _chart_executor
+    if _chart_executor is None:
+        _chart_executor = ProcessPoolExecutor(max_workers=1)
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(_chart_executor, draw_chart, team_name, history, tz_string)
+
+
+def stats_to_string():
+    """Describe the chart cache's counters in a readable string."""
+    lookups = cache_stats["hits"] + cache_stats["misses"]
+    hit_rate = 100 * cache_stats["hits"] / lookups if lookups > 0 else 0
+    return (f"Charts: {cache_stats['hits']} hits, {cache_stats['misses']} misses ({hit_rate:.1f}% hit rate), "
+            f"{len(_cache)}/{chart_cache_size} charts cached.")
@@ -0,0 +1,399 @@
+"""
+Team data store for HCR2.
+
+Splits the spreadsheet and name corrections into partitions, one for each leaderboard tracked in each Discord server,
+so several communities or leaderboards (like different seasons or events) can be tracked by the same bots. Each
+partition's files are only read when needed and kept in a small cache that drops the least recently used partition.
+Teams that haven't been seen for a number of sweeps are moved out of the spreadsheet into an archive, so the
+spreadsheet only holds teams that are still on the leaderboard.
+"""
+
+import os
+import re
+import csv
+import shutil
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+import metrics
+
+# Change the spreadsheet and name corrections file names here if necessary.
+# The files in the bots' folder are used as the starting point for the legacy server's partitions.
+nameCorrectionPath = "team_name_corrections.csv"
+nameCorrectionContainsPath = "team_name_contains_corrections.csv"
+nameCorrectionRegexPath = "team_name_regex_corrections.csv"
+teamEndTimesPath = "team_end_times.csv"
+# Teams that have dropped out of the leaderboard, and the timestamps of every sweep merged into the spreadsheet
+teamArchivePath = "team_archive.csv"
+sweepHistoryPath = "sweep_history.csv"
+# Every team's position and cups in every sweep, used for charts
+teamHistoryPath = "team_history.csv"
+# Folder holding a folder for each partition, and the file choosing which leaderboard each channel is for
+partitionsPath = "partitions"
+leaderboardChannelsPath = "leaderboard_channels.csv"
+
+# Leaderboard used by any channel that isn't listed in the leaderboard channels file
+default_leaderboard = "default"
+# Most partitions kept loaded in memory at once
+partition_cache_size = 16
+# Server the bots tracked before every server had its own files, which carries on from the files in the bots' folder,
+# or None if there isn't one. Set by the bots from LEGACY_GUILD_ID.
+legacy_guild_id = None
+# The headings of the name correction files, for partitions that start out without any corrections
+name_correction_headings = ["Identified name", "Correct name"]
+name_correction_regex_headings = ["Pattern", "Correct name"]
+
+# The columns of the spreadsheet in order
+team_end_times_headings = ["position", "name", "cups", "match against",
+                           "cup change", "timestamp prior", "timestamp checked", "timestamp changed"]
+
+# Loaded partitions by (guild ID, leaderboard), with the most recently used last
+_partitions = OrderedDict()
+# Locks are kept separately from the cache so a partition being dropped can't give two sweeps different locks
+_partition_locks = {}
+# Cached copy of the leaderboard channels file and its modified time
+_leaderboard_channels = (None, {})
+
+metrics.describe("hcr2_file_io_seconds", "histogram", "Time taken to read or write a data file.")
+metrics.describe("hcr2_team_table_size", "gauge", "Number of teams in a leaderboard's spreadsheet or archive.")
+
+
+def get_leaderboard(guild_id, channel_id):
+    """Find which leaderboard a channel is for from the leaderboard channels file."""
+    global _leaderboard_channels
+    if not os.path.exists(leaderboardChannelsPath):
+        return default_leaderboard
+    # Only read the file again if it's been changed since it was last read
+    mtime = os.stat(leaderboardChannelsPath).st_mtime_ns
+    if _leaderboard_channels[0] != mtime:
+        channels = {}
+        with open(leaderboardChannelsPath, newline='', encoding="utf-8") as csvfile:
+            reader = csv.DictReader(csvfile)
+            for row in reader:
+                channels[(row["guild"], row["channel"])] = row["leaderboard"]
+        _leaderboard_channels = (mtime, channels)
+    return _leaderboard_channels[1].get((str(guild_id), str(channel_id)), default_leaderboard)
+
+
+def configure(legacy_guild):
+    """Set the server whose partitions start off with the files in the bots' folder, or None if no server should."""
+    global legacy_guild_id
+    legacy_guild_id = legacy_guild
+
+
+def write_empty_corrections(path, headings, delimiter=','):
+    """Write a name corrections file with only its headings."""
+    with open(path, mode='w', newline='', encoding="utf-8") as csvfile:
+        csv.writer(csvfile, delimiter=delimiter).writerow(headings)
+
+
+def create_partition_files(partition):
+    """Create a new partition's folder. Only the legacy server's partitions start off with a copy of the files in the
+    bots' folder, every other server starts out with an empty spreadsheet and no name corrections."""
+    os.makedirs(partition["folder"], exist_ok=True)
+    legacy = legacy_guild_id is not None and partition["key"][0] == str(legacy_guild_id)
+    # Name corrections apply to every leaderboard in the legacy server, so they're copied over for each one
+    if legacy:
+        for path in (nameCorrectionPath, nameCorrectionContainsPath, nameCorrectionRegexPath):
+            shutil.copyfile(path, os.path.join(partition["folder"], path))
+    else:
+        write_empty_corrections(partition["nameCorrectionPath"], name_correction_headings)
+        write_empty_corrections(partition["nameCorrectionContainsPath"], name_correction_headings)
+        write_empty_corrections(partition["nameCorrectionRegexPath"], name_correction_regex_headings, delimiter='¦')
+    # The legacy server's default leaderboard carries on from the existing spreadsheet, anything else starts out empty
+    if legacy and partition["leaderboard"] == default_leaderboard:
+        shutil.copyfile(teamEndTimesPath, partition["teamEndTimesPath"])
+    else:
+        write_team_end_times(partition, [])
+
+
+def get_partition(guild_id, channel_id):
+    """Get the partition for the leaderboard a channel is for, loading it into the cache if needed."""
+    # Direct messages don't have a server, so they use a partition of their own
+    if guild_id is None:
+        guild_id = 0
+    leaderboard = get_leaderboard(guild_id, channel_id)
+    key = (str(guild_id), leaderboard)
+    if key in _partitions:
+        # Mark the partition as the most recently used
+        _partitions.move_to_end(key)
+        return _partitions[key]
+
+    # Only keep characters that are safe to use in a folder name
+    folder = os.path.join(partitionsPath, key[0], re.sub(r"[^\w\- ]", "_", leaderboard))
+    partition = {"key": key,
+                 "leaderboard": leaderboard,
+                 "folder": folder,
+                 "teamEndTimesPath": os.path.join(folder, teamEndTimesPath),
+                 "nameCorrectionPath": os.path.join(folder, nameCorrectionPath),
+                 "nameCorrectionContainsPath": os.path.join(folder, nameCorrectionContainsPath),
+                 "nameCorrectionRegexPath": os.path.join(folder, nameCorrectionRegexPath),
+                 "teamArchivePath": os.path.join(folder, teamArchivePath),
+                 "sweepHistoryPath": os.path.join(folder, sweepHistoryPath),
+                 "teamHistoryPath": os.path.join(folder, teamHistoryPath),
+                 # Cached file contents, each stored with the modified time of the file they were read from
+                 "team end times": (None, []),
+                 "team archive": (None, []),
+                 "corrections": (None, None)}
+    if not os.path.exists(folder):
+        create_partition_files(partition)
+    _partitions[key] = partition
+    # Drop the least recently used partition if there are too many loaded
+    if len(_partitions) > partition_cache_size:
+        _partitions.popitem(last=False)
+    return partition
+
+
+def get_partition_lock(partition):
+    """Get the read/write lock for a partition, which lets many tasks read its data at once but only one change it."""
+    if partition["key"] not in _partition_locks:
+        _partition_locks[partition["key"]] = {"condition": asyncio.Condition(),
+                                              "readers": 0,
+                                              "writing": False,
+                                              "writers waiting": 0}
+    return _partition_locks[partition["key"]]
+
+
+@asynccontextmanager
+async def reading(partition):
+    """Hold the partition's lock while reading its data, alongside any other tasks that are reading it."""
+    lock = get_partition_lock(partition)
+    async with lock["condition"]:
+        # Waiting writers go first, so a steady stream of queries can't hold up a correction forever
+        await lock["condition"].wait_for(lambda: not lock["writing"] and lock["writers waiting"] == 0)
+        lock["readers"] += 1
+    try:
+        yield
+    finally:
+        async with lock["condition"]:
+            lock["readers"] -= 1
+            lock["condition"].notify_all()
+
+
+@asynccontextmanager
+async def writing(partition):
+    """Hold the partition's lock while changing its data, so nothing else can read or change it at the same time."""
+    lock = get_partition_lock(partition)
+    async with lock["condition"]:
+        lock["writers waiting"] += 1
+        try:
+            await lock["condition"].wait_for(lambda: not lock["writing"] and lock["readers"] == 0)
+        finally:
+            lock["writers waiting"] -= 1
+            # Let readers carry on if this writer stopped waiting, or let them see it's now writing
+            lock["condition"].notify_all()
+        lock["writing"] = True
+    try:
+        yield
+    finally:
+        async with lock["condition"]:
+            lock["writing"] = False
+            lock["condition"].notify_all()
+
+
+def get_mtime(path):
+    """Get the modified time of a file, used to know when a cached copy of it is out of date."""
+    return os.stat(path).st_mtime_ns
+
+
+def read_team_file(partition, cache_key, path):
+    """Get a spreadsheet file's data as a list of dictionaries, using the partition's cached copy if it's up to date."""
+    # A missing file (like an archive that nothing has been moved to yet) has no teams in it
+    if not os.path.exists(path):
+        return []
+    mtime = get_mtime(path)
+    # Only read the file again if it's been changed since it was last read, by this bot or the other one
+    if partition[cache_key][0] != mtime:
+        teams = []
+        with metrics.timed("hcr2_file_io_seconds", {"operation": "read", "file": os.path.basename(path)}):
+            with open(path, newline='', encoding="utf-8") as csvfile:
+                reader = csv.DictReader(csvfile)
+                for row in reader:
+                    teams.append({heading: row[heading] for heading in team_end_times_headings})
+        partition[cache_key] = (mtime, teams)
+        metrics.set_gauge("hcr2_team_table_size", len(teams), {"partition": "/".join(partition["key"]), "table": cache_key})
+    # Return a copy so changes aren't made to the cached data
+    return [dict(team) for team in partition[cache_key][1]]
+
+
+def write_team_file(partition, cache_key, path, teams):
+    """Write a list of team dictionaries to a spreadsheet file, overwriting the old data."""
+    # Write to a temporary file first and swap it in, so the other bot never reads a half written file
+    temp_path = path + ".tmp"
+    with metrics.timed("hcr2_file_io_seconds", {"operation": "write", "file": os.path.basename(path)}):
+        with open(temp_path, mode='w', newline='', encoding="utf-8") as team_data:
+            team_writer = csv.writer(team_data, delimiter=',')
+            # Write the table headings
+            team_writer.writerow(team_end_times_headings)
+            # Write the table data for each row
+            for row in teams:
+                team_writer.writerow([row[heading] for heading in team_end_times_headings])
+        os.replace(temp_path, path)
+    metrics.set_gauge("hcr2_team_table_size", len(teams), {"partition": "/".join(partition["key"]), "table": cache_key})
+    # Keep a copy of what was written, so it doesn't need to be read straight back in
+    partition[cache_key] = (get_mtime(path), [dict(team) for team in teams])
+
+
+def get_data_version(partition):
+    """Get a value that changes whenever the partition's spreadsheet or archive is changed, by either bot."""
+    # The size is included too, in case the file system only stores modified times to the nearest second
+    return tuple((os.stat(path).st_mtime_ns, os.stat(path).st_size) if os.path.exists(path) else None
+                 for path in (partition["teamEndTimesPath"], partition["teamArchivePath"]))
+
+
+def get_team_end_times(partition):
+    """Get the partition's spreadsheet data as a list of dictionaries, which the caller is free to change."""
+    return read_team_file(partition, "team end times", partition["teamEndTimesPath"])
+
+
+def write_team_end_times(partition, teamEndTimes):
+    """Write the new updated data to the partition's spreadsheet, overwriting the old data."""
+    write_team_file(partition, "team end times", partition["teamEndTimesPath"], teamEndTimes)
+
+
+def get_archived_teams(partition):
+    """Get the teams that have dropped out of the partition's leaderboard as a list of dictionaries."""
+    return read_team_file(partition, "team archive", partition["teamArchivePath"])
+
+
+def write_archived_teams(partition, archivedTeams):
+    """Write the teams that have dropped out of the partition's leaderboard to the archive, overwriting the old data."""
+    write_team_file(partition, "team archive", partition["teamArchivePath"], archivedTeams)
+
+
+def get_sweep_history(partition):
+    """Get the timestamps of every sweep merged into the partition's spreadsheet, oldest first."""
+    if not os.path.exists(partition["sweepHistoryPath"]):
+        return []
+    with open(partition["sweepHistoryPath"], newline='', encoding="utf-8") as csvfile:
+        reader = csv.DictReader(csvfile)
+        return [row["timestamp"] for row in reader]
+
+
+def record_sweep(partition, timestamp):
+    """Add a sweep's timestamp to the end of the partition's sweep history."""
+    # Write the table headings if the file is new
+    write_headings = not os.path.exists(partition["sweepHistoryPath"])
+    with open(partition["sweepHistoryPath"], mode='a', newline='', encoding="utf-8") as csvfile:
+        sweep_writer = csv.writer(csvfile, delimiter=',')
+        if write_headings:
+            sweep_writer.writerow(["timestamp"])
+        sweep_writer.writerow([timestamp])
+
+
+def record_team_history(partition, team_list, timestamp):
+    """Add every team read in a sweep to the end of the partition's team history, with its position and cups."""
+    # Write the table headings if the file is new
+    write_headings = not os.path.exists(partition["teamHistoryPath"])
+    with open(partition["teamHistoryPath"], mode='a', newline='', encoding="utf-8") as csvfile:
+        history_writer = csv.writer(csvfile, delimiter=',')
+        if write_headings:
+            history_writer.writerow(["timestamp", "position", "name", "cups"])
+        for team in team_list:
+            history_writer.writerow([timestamp, team["position"], team["name"], team["cups"]])
+
+
+def get_team_history(partition, team_name, since):
+    """Get a team's position and cups in every sweep from the since timestamp onwards, ignoring the case of its name.
+    Return the name it was last seen with and a list of (timestamp, position, cups), oldest first."""
+    if not os.path.exists(partition["teamHistoryPath"]):
+        return team_name, []
+    history = []
+    # The history holds every team in every sweep, so it's read a row at a time rather than all at once
+    with open(partition["teamHistoryPath"], newline='', encoding="utf-8") as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            if row["name"].lower() == team_name.lower() and row["timestamp"] >= since:
+                team_name = row["name"]
+                history.append((row["timestamp"], int(row["position"]), int(row["cups"])))
+    history.sort()
+    return team_name, history
+
+
+def get_positions_before(partition, before):
+    """Get every team's position in the partition's last sweep before the before timestamp, from the team history.
+    Return a dictionary of team name to position, or None if there's no team history to look in."""
+    if not os.path.exists(partition["teamHistoryPath"]):
+        return None
+    positions = {}
+    latest = None
+    # Only the teams of one sweep are kept at a time while reading through the history
+    with open(partition["teamHistoryPath"], newline='', encoding="utf-8") as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            if row["timestamp"] >= before:
+                continue
+            if latest is None or row["timestamp"] > latest:
+                latest = row["timestamp"]
+                positions = {}
+            if row["timestamp"] == latest:
+                positions[row["name"]] = row["position"]
+    return positions
+
+
+def reactivate_archived_teams(team_list, teamEndTimes, archivedTeams):
+    """Move archived teams that are back on the leaderboard into the spreadsheet, so they carry on from their old data.
+    Return the remaining archived teams."""
+    active_names = {team["name"] for team in teamEndTimes}
+    seen_names = {team["name"] for team in team_list} - active_names
+    reactivated_names = set()
+    remaining = []
+    for team in archivedTeams:
+        if team["name"] in seen_names:
+            # Only the most recent archived record for a name is brought back, any older ones are dropped
+            if team["name"] not in reactivated_names:
+                teamEndTimes.append(team)
+                reactivated_names.add(team["name"])
+        elif team["name"] not in active_names:
+            remaining.append(team)
+    return remaining
+
+
+def compact_team_end_times(teamEndTimes, sweep_history, retention_sweeps):
+    """Split out the teams that haven't been seen in the last retention_sweeps sweeps, to be moved into the archive.
+    Return the kept teams and the dropped teams."""
+    # Nothing can be out of date until there have been enough sweeps
+    if len(sweep_history) < retention_sweeps:
+        return teamEndTimes, []
+    # Timestamps are stored in a format that sorts in time order, so they can be compared as strings.
+    # Teams last checked before the oldest of the most recent sweeps have missed all of them.
+    oldest_kept = sorted(sweep_history)[-retention_sweeps]
+    kept = [team for team in teamEndTimes if team["timestamp checked"] >= oldest_kept]
+    dropped = [team for team in teamEndTimes if team["timestamp checked"] < oldest_kept]
+    return kept, dropped
+
+
+def get_name_corrections(partition):
+    """Get the partition's name corrections as a dictionary of exact, contains and regex corrections."""
+    paths = (partition["nameCorrectionPath"], partition["nameCorrectionContainsPath"], partition["nameCorrectionRegexPath"])
+    mtimes = tuple(get_mtime(path) for path in paths)
+    # Only read the files again if any have been changed since they were last read
+    if partition["corrections"][0] != mtimes:
+        corrections = {"exact": {}, "contains": {}, "regex": []}
+        with open(partition["nameCorrectionPath"], newline='', encoding="utf-8") as csvfile:
+            reader = csv.DictReader(csvfile)
+            for row in reader:
+                corrections["exact"][row["Identified name"]] = row["Correct name"]
+        with open(partition["nameCorrectionContainsPath"], newline='', encoding="utf-8") as csvfile:
+            reader = csv.DictReader(csvfile)
+            for row in reader:
+                corrections["contains"][row["Identified name"]] = row["Correct name"]
+        with open(partition["nameCorrectionRegexPath"], newline='', encoding="utf-8") as csvfile:
+            reader = csv.DictReader(csvfile, delimiter='¦')
+            for row in reader:
+                corrections["regex"].append((row["Pattern"], row["Correct name"]))
+        partition["corrections"] = (mtimes, corrections)
+    return partition["corrections"][1]
+
+
+def add_name_correction(partition, correction_type, wrong_name, correct_name):
+    """Add a name correction of the given type (exact, contains or regex) to the end of the partition's file."""
+    path = {"exact": partition["nameCorrectionPath"],
+            "contains": partition["nameCorrectionContainsPath"],
+            "regex": partition["nameCorrectionRegexPath"]}[correction_type]
+    # RegEx patterns can contain commas, so that file uses a reserved character instead
+    delimiter = '¦' if correction_type == "regex" else ','
+    with open(path, mode='a', newline='', encoding="utf-8") as csvfile:
+        correction_writer = csv.writer(csvfile, delimiter=delimiter)
+        correction_writer.writerow([wrong_name, correct_name])
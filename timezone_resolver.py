@@ -0,0 +1,101 @@
+"""
+Timezone resolver for HCR2.
+
+Turns the timezones and shortcuts given in commands into timezone objects for both bots. The shortcuts are kept in
+memory and only read from file again when the file changes, official timezone names are looked up in a set rather than
+searched for in a list, and timezone objects are only created once. When a timezone can't be found, the closest
+matching names are suggested so the user can fix a typo.
+"""
+
+import os
+import csv
+import difflib
+from functools import lru_cache
+
+import pytz
+
+# Change the timezone shortcuts file location here if necessary
+timezoneShortcutsPath = "timezone_shortcuts.csv"
+
+# Most close matches suggested for a timezone that can't be found, and how close they need to be (0 to 1)
+max_suggestions = 3
+suggestion_cutoff = 0.6
+
+# Every official timezone name, for quick lookups
+official_timezones = set(pytz.all_timezones)
+# Official timezone names by their lowercase name, so suggestions can ignore case
+_lowercase_timezones = {name.lower(): name for name in pytz.all_timezones}
+# Cached copy of the timezone shortcuts file and its modified time
+_shortcuts = (None, {})
+
+
+def get_timezone_shortcuts():
+    """Return a dictionary of timezone name shortcuts, only reading the file again if it has changed."""
+    global _shortcuts
+    mtime = os.stat(timezoneShortcutsPath).st_mtime_ns
+    if _shortcuts[0] != mtime:
+        # Read from the csv file for timezone shortcuts and add to the dictionary
+        shortcut = {}
+        with open(timezoneShortcutsPath, newline='', encoding="utf-8") as csvfile:
+            reader = csv.DictReader(csvfile)
+            for row in reader:
+                shortcut[row["shortcut"]] = row["timezone"]
+        _shortcuts = (mtime, shortcut)
+    # Return a copy so changes aren't made to the cached shortcuts
+    return dict(_shortcuts[1])
+
+
+def write_timezone_shortcuts(tz_shortcuts):
+    """Write the whole dictionary of timezone shortcuts to file, overwriting the old shortcuts."""
+    global _shortcuts
+    # Write to a temporary file first and swap it in, so a query never reads a half written file
+    with open(timezoneShortcutsPath + ".tmp", mode='w', newline='', encoding="utf-8") as tz_data:
+        tz_writer = csv.writer(tz_data, delimiter=',')
+        # Write the table headings
+        tz_writer.writerow(["shortcut", "timezone"])
+        # Write the table data for each row
+        for key, value in tz_shortcuts.items():
+            tz_writer.writerow([key, value])
+    os.replace(timezoneShortcutsPath + ".tmp", timezoneShortcutsPath)
+    # Keep a copy of what was written, so it doesn't need to be read straight back in
+    _shortcuts = (os.stat(timezoneShortcutsPath).st_mtime_ns, dict(tz_shortcuts))
+
+
+@lru_cache(maxsize=None)
+def get_tz_object(official_tz):
+    """Get the pytz object for an official timezone name, creating it only the first time it's needed."""
+    return pytz.timezone(official_tz)
+
+
+def get_official_tz(user_tz):
+    """Take a timezone string and return a pytz object for use with datetime."""
+    official_tz = user_tz
+    # Get the saved shortcuts
+    tz_shortcuts = get_timezone_shortcuts()
+    # Replace the timezone string with what's saved as the official string for that shortcut
+    if official_tz in tz_shortcuts:
+        official_tz = tz_shortcuts[user_tz]
+
+    # Return the timezone object if it exists in pytz
+    if official_tz in official_timezones:
+        return get_tz_object(official_tz)
+    # Return False if it doesn't exist in pytz
+    return False
+
+
+def suggest_timezones(user_tz):
+    """Get a list of the shortcuts and official timezones closest to a timezone string that couldn't be found."""
+    # Compare in lowercase so a timezone in the wrong case is still found
+    candidates = dict(_lowercase_timezones)
+    for shortcut in get_timezone_shortcuts():
+        candidates[shortcut.lower()] = shortcut
+    matches = difflib.get_close_matches(user_tz.lower(), candidates.keys(), n=max_suggestions, cutoff=suggestion_cutoff)
+    return [candidates[match] for match in matches]
+
+
+def suggestion_string(user_tz):
+    """Get a sentence suggesting timezones close to one that couldn't be found, or an empty string if there aren't any."""
+    suggestions = suggest_timezones(user_tz)
+    if len(suggestions) == 0:
+        return ""
+    return " Did you mean " + " or ".join(suggestions) + "?"
@@ -0,0 +1,81 @@
+"""
+Upcoming match end schedule for HCR2.
+
+Keeps a list of every team's predicted next match end time for each leaderboard, sorted by time, so the teams ending
+in any period can be found with a binary search instead of checking every team. When the spreadsheet changes, only
+the teams whose end times have changed are moved in the list.
+"""
+
+import threading
+from bisect import bisect_left, insort
+from datetime import datetime
+
+import pytz
+
+# Format the timestamps are stored in within the spreadsheet
+datetime_format = "%Y-%m-%dT%H:%M"
+
+# Schedules by partition key, each holding the data version it was built from,
+# the sorted (predicted end, team name) entries and each team's entry and spreadsheet row by name
+_schedules = {}
+# Queries are worked out on a thread pool, so only one thread at a time can update a schedule
+_schedule_lock = threading.Lock()
+
+
+def parse_timestamp(timestamp):
+    """Turn a UTC timestamp from the spreadsheet into a datetime object, or None if it's not available."""
+    try:
+        return pytz.utc.localize(datetime.strptime(timestamp, datetime_format))
+    except ValueError:
+        return None
+
+
+def get_entry(team, match_length):
+    """Get a team's schedule entry of its predicted next end time and name, or None if it can't be predicted."""
+    end_time = parse_timestamp(team["timestamp changed"])
+    # Without the previous check, it isn't known how long before the end time the match actually ended
+    if end_time is None or parse_timestamp(team["timestamp prior"]) is None:
+        return None
+    return (end_time + match_length, team["name"])
+
+
+def update_schedule(schedule, teamEndTimes, match_length):
+    """Bring a schedule up to date with the spreadsheet, only moving the entries of teams that have changed."""
+    teams = {team["name"]: team for team in teamEndTimes}
+    # Remove the teams that aren't in the spreadsheet anymore
+    for name in list(schedule["entries by name"]):
+        if name not in teams:
+            remove_entry(schedule, name)
+    for name, team in teams.items():
+        entry = get_entry(team, match_length)
+        # Only move the team in the schedule if its predicted end time has changed
+        if schedule["entries by name"].get(name) != entry:
+            remove_entry(schedule, name)
+            if entry is not None:
+                insort(schedule["entries"], entry)
+                schedule["entries by name"][name] = entry
+    schedule["teams"] = teams
+
+
+def remove_entry(schedule, name):
+    """Remove a team from a schedule, if it's in it."""
+    entry = schedule["entries by name"].pop(name, None)
+    if entry is not None:
+        index = bisect_left(schedule["entries"], entry)
+        del schedule["entries"][index]
+
+
+def get_upcoming(partition_key, data_version, get_team_end_times, match_length, start, end):
+    """Get the spreadsheet rows of the teams predicted to end between the start and end datetimes, in time order.
+    get_team_end_times is only called to get the spreadsheet data if the schedule is out of date with the data version."""
+    with _schedule_lock:
+        schedule = _schedules.setdefault(partition_key, {"version": None, "entries": [],
+                                                         "entries by name": {}, "teams": {}})
+        if schedule["version"] != data_version:
+            update_schedule(schedule, get_team_end_times(), match_length)
+            schedule["version"] = data_version
+        # Find the part of the schedule in the period with two binary searches and take it in one slice
+        entries = schedule["entries"]
+        first = bisect_left(entries, (start, ""))
+        last = bisect_left(entries, (end, ""))
+        return [schedule["teams"][name] for _, name in entries[first:last]]
@@ -0,0 +1,213 @@
+"""
+Team end time watch scheduler for HCR2.
+
+Keeps the !watch subscriptions and a heap of timers for the predicted end times of the watched teams, so subscribers
+can be notified shortly before a team is due to end without anything checking the spreadsheet every minute. Timers are
+only changed when a sweep or correction changes a watched team's end time, which is found by checking the spreadsheet
+file's modified time every few minutes and only reading the file when it has changed.
+"""
+
+import os
+import csv
+import heapq
+import asyncio
+import itertools
+from datetime import datetime, timedelta
+
+import pytz
+
+import team_store
+
+# Change the watch subscriptions file location here if necessary
+watchSubscriptionsPath = "watch_subscriptions.csv"
+
+# Format the timestamps are stored in within the spreadsheet
+datetime_format = "%Y-%m-%dT%H:%M"
+# How long before a team's predicted end time the subscribers are notified
+watch_notice = timedelta(minutes=15)
+# How often to check whether the spreadsheets with watched teams have changed, in seconds
+watch_refresh_interval = 180
+
+# Subscribers by partition key and then team name, each subscriber holding their server, channel, user and timezone
+subscriptions = {}
+# Partitions with watched teams and the data version the timers were last worked out from, by partition key
+_watched_partitions = {}
+# Heap of timers, each holding the time to notify, a counter to keep the order of timers at the same time,
+# the partition key, the team name and the predicted end period
+_timers = []
+_timer_counter = itertools.count()
+# The predicted end period each watched team's current timer is for, by partition key and team name.
+# Timers in the heap for any other period are out of date and are skipped when they come up.
+_scheduled = {}
+# Set to wake up the scheduler when a timer is added, in case it's earlier than the one being waited for
+_wake_event = None
+
+
+def parse_timestamp(timestamp):
+    """Turn a UTC timestamp from the spreadsheet into a datetime object, or None if it's not available."""
+    try:
+        return pytz.utc.localize(datetime.strptime(timestamp, datetime_format))
+    except ValueError:
+        return None
+
+
+def get_predicted_end(team, match_length):
+    """Get the period a team's next match is predicted to end in, or None if it can't be predicted."""
+    prior = parse_timestamp(team["timestamp prior"])
+    changed = parse_timestamp(team["timestamp changed"])
+    if prior is None or changed is None:
+        return None
+    # The last match ended between the check before the cups changed and the check that found the change
+    return (prior + match_length, changed + match_length)
+
+
+def schedule_team(partition_key, team, match_length):
+    """Add a timer for a watched team's predicted end, if it has changed since the team's current timer was added."""
+    predicted_end = get_predicted_end(team, match_length)
+    if predicted_end is None or _scheduled.get((partition_key, team["name"])) == predicted_end:
+        return
+    _scheduled[(partition_key, team["name"])] = predicted_end
+    # Don't bother with a timer if the predicted end has already passed, the next sweep will give a new one
+    if predicted_end[1] < pytz.utc.localize(datetime.utcnow()):
+        return
+    heapq.heappush(_timers, (predicted_end[0] - watch_notice, next(_timer_counter),
+                             partition_key, team["name"], predicted_end))
+    if _wake_event is not None:
+        _wake_event.set()
+
+
+async def refresh_partition(partition, match_length):
+    """Reschedule the partition's watched teams if its spreadsheet has changed since they were last scheduled."""
+    watched = _watched_partitions[partition["key"]]
+    # Checking the data version only needs the files' modified times, the spreadsheet is only read if it has changed
+    data_version = team_store.get_data_version(partition)
+    if watched["version"] == data_version:
+        return
+    # Read the spreadsheet on the executor as it's file work, but keep the timers on the event loop
+    loop = asyncio.get_event_loop()
+    teamEndTimes = await loop.run_in_executor(None, team_store.get_team_end_times, partition)
+    watched["version"] = data_version
+    teams = subscriptions.get(partition["key"], {})
+    for team in teamEndTimes:
+        if team["name"] in teams:
+            schedule_team(partition["key"], team, match_length)
+
+
+def find_team_name(partition, team_name):
+    """Find the spreadsheet's name for a team, ignoring case, or None if it isn't in the spreadsheet."""
+    for team in team_store.get_team_end_times(partition):
+        if team["name"].lower() == team_name.lower():
+            return team["name"]
+    return None
+
+
+def write_subscriptions():
+    """Write every subscription to file, overwriting the old subscriptions."""
+    with open(watchSubscriptionsPath, mode='w', newline='', encoding="utf-8") as watch_data:
+        watch_writer = csv.writer(watch_data, delimiter=',')
+        # Write the table headings
+        watch_writer.writerow(["guild", "channel", "user", "team", "timezone"])
+        # Write the table data for each subscription
+        for teams in subscriptions.values():
+            for team_name, subscribers in teams.items():
+                for subscriber in subscribers:
+                    watch_writer.writerow([subscriber["guild"], subscriber["channel"], subscriber["user"],
+                                           team_name, subscriber["timezone"]])
+
+
+def add_subscription(guild_id, channel_id, user_id, team_name, tz_string):
+    """Add a subscription to a team for a user, replacing any they already had to the team in the same leaderboard."""
+    partition = team_store.get_partition(guild_id, channel_id)
+    # Forget the data version the partition was last checked at, so the new team is scheduled on the next refresh
+    _watched_partitions[partition["key"]] = {"partition": partition, "version": None}
+    subscribers = subscriptions.setdefault(partition["key"], {}).setdefault(team_name, [])
+    subscribers[:] = [subscriber for subscriber in subscribers if subscriber["user"] != user_id]
+    subscribers.append({"guild": guild_id, "channel": channel_id, "user": user_id, "timezone": tz_string})
+    return partition
+
+
+def remove_subscription(guild_id, channel_id, user_id, team_name):
+    """Remove a user's subscription to a team, returning False if they weren't subscribed to it."""
+    partition = team_store.get_partition(guild_id, channel_id)
+    teams = subscriptions.get(partition["key"], {})
+    for name in teams:
+        if name.lower() == team_name.lower() and any(subscriber["user"] == user_id for subscriber in teams[name]):
+            teams[name] = [subscriber for subscriber in teams[name] if subscriber["user"] != user_id]
+            # Stop the team's timers if nobody is watching it anymore
+            if len(teams[name]) == 0:
+                del teams[name]
+                _scheduled.pop((partition["key"], name), None)
+            write_subscriptions()
+            return True
+    return False
+
+
+def get_user_subscriptions(guild_id, channel_id, user_id):
+    """Get the names of the teams a user is watching in a channel's leaderboard."""
+    partition = team_store.get_partition(guild_id, channel_id)
+    return [name for name, subscribers in subscriptions.get(partition["key"], {}).items()
+            if any(subscriber["user"] == user_id for subscriber in subscribers)]
+
+
+def load_subscriptions():
+    """Load every subscription from file."""
+    subscriptions.clear()
+    if not os.path.exists(watchSubscriptionsPath):
+        return
+    with open(watchSubscriptionsPath, newline='', encoding="utf-8") as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            guild_id = int(row["guild"]) if row["guild"] not in ("", "None") else None
+            add_subscription(guild_id, int(row["channel"]), int(row["user"]), row["team"], row["timezone"])
+
+
+async def run_scheduler(notify, match_length):
+    """Notify the subscribers of each watched team when its timer comes up, forever.
+    notify is an async function taking the list of subscribers, the team name and the predicted end period."""
+    loop = asyncio.get_event_loop()
+    next_refresh = loop.time()
+    while True:
+        # Check for changes to the spreadsheets of watched teams every few minutes
+        if loop.time() >= next_refresh:
+            for watched in list(_watched_partitions.values()):
+                # A partition that can't be read this time is tried again at the next refresh,
+                # without stopping the notifications for every other team
+                try:
+                    await refresh_partition(watched["partition"], match_length)
+                except Exception as e:
+                    print(f"Could not refresh the watched teams of the {watched['partition']['leaderboard']} leaderboard "
+                          f"in server {watched['partition']['key'][0]}: {e}")
+            next_refresh = loop.time() + watch_refresh_interval
+
+        # Notify the subscribers of every timer that has come up
+        now = pytz.utc.localize(datetime.utcnow())
+        while len(_timers) > 0 and _timers[0][0] <= now:
+            _, _, partition_key, team_name, predicted_end = heapq.heappop(_timers)
+            subscribers = subscriptions.get(partition_key, {}).get(team_name, [])
+            # Skip timers that have been replaced by a newer prediction or whose team isn't watched anymore
+            if _scheduled.get((partition_key, team_name)) != predicted_end or len(subscribers) == 0:
+                continue
+            try:
+                await notify(list(subscribers), team_name, predicted_end)
+            except Exception as e:
+                print(f"Could not notify the subscribers of {team_name}: {e}")
+
+        # Sleep until the next timer or refresh, or until a new timer is added
+        wait = next_refresh - loop.time()
+        if len(_timers) > 0:
+            wait = min(wait, (_timers[0][0] - now).total_seconds())
+        _wake_event.clear()
+        try:
+            await asyncio.wait_for(_wake_event.wait(), timeout=max(0, wait))
+        except asyncio.TimeoutError:
+            pass
+
+
+def start_scheduler(notify, match_length):
+    """Load the subscriptions and start the scheduler, unless it has already been started."""
+    global _wake_event
+    if _wake_event is not None:
+        return
+    _wake_event = asyncio.Event()
+    load_subscriptions()
+    asyncio.ensure_future(run_scheduler(notify, match_length))